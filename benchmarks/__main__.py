@@ -0,0 +1,39 @@
+"""
+Замеры производительности загрузки и расчётов на dev-базе.
+
+Запуск из корня репозитория:
+    python -m benchmarks loader [--scale 20] [--repeat 3]
+    python -m benchmarks coerce
+    python -m benchmarks chunks [--rows 300000] [--sizes 0,20000,100000]
+    python -m benchmarks upsert [--scale 1000] [--repeat 3]
+    python -m benchmarks partitions [--rows 50000] [--background 2000000] [--repeat 3]
+    python -m benchmarks parallel [--registrars 200] [--rows 50] [--workers 4]
+    python -m benchmarks formats [--registrars 200] [--rows 200] [--repeat 3]
+    python -m benchmarks recalc [--months 12] [--transfers 200] [--goods 10] [--general 20] [--workers 1,4]
+                                [--publish delete,swap]
+    python -m benchmarks incremental [--months 12] [--transfers 200] [--goods 10] [--general 20]
+    python -m benchmarks weights [--months 3] [--transfers 200] [--goods 10] [--general 20]
+    python -m benchmarks general [--expenses 20,80] [--transfers 200,800] [--goods 10]
+    python -m benchmarks location [--transfers 200] [--goods 10] [--background 1000000] [--repeat 3]
+
+Замеры пишут в целевые таблицы синтетические строки и удаляют их по окончании,
+поэтому запускать их нужно только на dev/test-базе. Замеры со сверкой результата
+(recalc, incremental, weights, general, location) при расхождении
+завершаются с кодом 1.
+"""
+import argparse
+
+from benchmarks import ingest, package, recalc, shares
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for module in (ingest, package, recalc, shares):
+        module.add_commands(sub)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Общее для замеров: фикстуры tests/testData, лучшее время из повторов, вывод таблиц и сверка."""
+import json
+import uuid
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from src.utils import timed
+
+TEST_DATA_PATH = Path(__file__).resolve().parents[1] / "tests" / "testData"
+
+
+def load_fixture(file_name: str) -> dict[str, list[dict]]:
+    """{НаименованиеМетаданных: строки} из файла tests/testData."""
+    with open(TEST_DATA_PATH / file_name, encoding="utf-8-sig") as f:
+        return {t["НаименованиеМетаданных"]: t["Данные"] for t in json.load(f)}
+
+
+def scale_rows(rows: list[dict], scale: int, key_alias: str) -> list[dict]:
+    """Размножает строки, подменяя ключ скоупа на новые UUID (каждая копия — свой скоуп)."""
+    out = []
+    for _ in range(scale):
+        new_keys: dict[str, str] = {}
+        for row in rows:
+            copy = dict(row)
+            copy[key_alias] = new_keys.setdefault(row[key_alias], str(uuid.uuid4()))
+            out.append(copy)
+    return out
+
+
+def best_of(repeat: int, func: Callable, *args, before: Callable | None = None, **kwargs) -> tuple[float, Any]:
+    """Лучшее время из repeat вызовов и результат последнего; before — подготовка перед каждым вызовом."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        result, sec = timed(func, *args, **kwargs)
+        best = min(best, sec)
+    return best, result
+
+
+def print_table(title: str, header: list[str], rows: list[list]) -> None:
+    print(f"\n{title}")
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows, strict=True)]
+    for line in [header, *rows]:
+        print("  ".join(str(x).rjust(w) for x, w in zip(line, widths, strict=True)))
+
+
+def require_same(label: str, same: bool) -> None:
+    """Итог сверки вариантов: при расхождении замер завершается с кодом 1."""
+    print(f"{label}:", same)
+    if not same:
+        raise SystemExit(1)
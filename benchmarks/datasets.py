@@ -0,0 +1,211 @@
+"""
+Синтетические данные замеров: валидные строки регистров и пакеты из них, набор для
+пересчёта расходов (перемещения, товары, склады, расходы за месяцы RECALC_YEAR)
+и выборки распределения по нему. Набор пересчёта используют и замеры, и tests/.
+"""
+import random
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from src.db.db import engine
+from src.db.registry import REGISTRY
+
+# регистры с общим скоупом по регистратору — разные целевые таблицы одного пакета
+PACKAGE_REGISTERS = ("МестонахождениеТовара", "ПрямыеЗатраты", "ОбщиеЗатраты", "СкладскиеЗатраты", "ТЗСтоимостьИОплатаТоваров")
+
+BENCH_BG_TYPE = "bench-background"  # registrar_type фоновых строк, удаляются по нему
+
+RECALC_YEAR = 2026  # месяцы этого года заняты синтетикой замера пересчёта
+
+
+def valid_value(rnd: random.Random, field):
+    tp = str if issubclass(field.type_, str) else field.type_
+    if tp is uuid.UUID:
+        return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+    if tp is datetime:
+        return f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T{rnd.randint(0, 23):02d}:00:00"
+    if tp is Decimal:
+        return rnd.randint(1, 100000) / 100
+    if tp is bool:
+        return rnd.random() < 0.5
+    if tp is int:
+        return rnd.randint(0, 1000)
+    if tp is float:
+        return rnd.random() * 100
+    return "Тест"[:field.field_info.max_length or 4]
+
+
+def synthetic_package(registrars: int, rows: int, seed: int) -> tuple[list[dict], set[str]]:
+    """Пакет из PACKAGE_REGISTERS: по шаблону на регистр и регистратора, валидные случайные строки."""
+    rnd = random.Random(seed)
+    keys = {str(uuid.UUID(int=rnd.getrandbits(128), version=4)) for _ in range(registrars)}
+    package = []
+    for key in sorted(keys):
+        for name_meta in PACKAGE_REGISTERS:
+            fields = [f for f in REGISTRY[name_meta].__fields__.values() if f.name != "created_at"]
+            data = []
+            for _ in range(rows):
+                row = {f.alias: valid_value(rnd, f) for f in fields}
+                row["Регистратор"] = key
+                data.append(row)
+            package.append({"НаименованиеМетаданных": name_meta, "Данные": data})
+    return package, keys
+
+
+def iter_synthetic_rows(name_meta: str, rows: int, per_registrar: int, seed: int, keys: list[str]):
+    """Генератор валидных строк регистра (ключи регистраторов дописываются в keys)."""
+    rnd = random.Random(seed)
+    fields = [f for f in REGISTRY[name_meta].__fields__.values() if f.name != "created_at"]
+    for i in range(rows):
+        if i % per_registrar == 0:
+            keys.append(str(uuid.UUID(int=rnd.getrandbits(128), version=4)))
+        row = {f.alias: valid_value(rnd, f) for f in fields}
+        row["Регистратор"] = keys[-1]
+        yield row
+
+
+def bench_id(kind: str, expr: str = "g") -> str:
+    """Детерминированный uuid строки синтетики: удаляется тем же выражением, без списка ключей."""
+    return f"md5('bench-recalc:{kind}:' || {expr})::uuid"
+
+
+# синтетика для пересчёта: страны/подразделения/склады, перемещения из Китая с товарами,
+# местонахождение (отправление), прямые/складские/общие расходы за каждый месяц.
+# Суммы зависят от :seed; у пар товаров суммы равны, часть прямых расходов — сторно,
+# складские — с долями копейки, у регистратора общих расходов две статьи затрат
+_RECALC_FILL_SQL = [
+    f"""INSERT INTO ref_countries (id, name) VALUES ({bench_id("country", "1")}, 'КИТАЙ'), ({bench_id("country", "2")}, 'bench')""",
+    f"""INSERT INTO ref_departments (id, name) SELECT {bench_id("dep")}, 'bench' FROM generate_series(1, 5) g""",
+    f"""INSERT INTO ref_warehouses (id, name, department_id, country_id)
+        SELECT {bench_id("wh")}, 'bench', {bench_id("dep", "((g - 1) % 5 + 1)")},
+               CASE WHEN g <= 5 THEN {bench_id("country", "1")} ELSE {bench_id("country", "2")} END
+        FROM generate_series(1, 10) g""",
+    f"""INSERT INTO doc_transfers (id, date, type_transfer, out_warehouse_id, in_warehouse_id)
+        SELECT {bench_id("tr")}, make_timestamp(:year, (g - 1) / :transfers + 1, g % 27 + 1, 0, 0, 0),
+               'Погрузка в машину', {bench_id("wh", "(g % 5 + 1)")}, {bench_id("wh", "(g % 5 + 6)")}
+        FROM generate_series(1, :months * :transfers) g""",
+    f"""INSERT INTO ref_goods (id, amount)
+        SELECT {bench_id("goods")}, ((g + g % 2) * 7919 + :seed) % 100000 / 100.0 + 1 FROM generate_series(1, :months * :transfers * :goods) g""",
+    f"""INSERT INTO doc_link_goods_transfers (transfer_id, goods_id)
+        SELECT {bench_id("tr", "((g - 1) / :goods + 1)")}, {bench_id("goods")}
+        FROM generate_series(1, :months * :transfers * :goods) g""",
+    f"""INSERT INTO reg_goods_location (registrar_id, date, goods_id, registrar_type, sender_warehouse_id, goods_status)
+        SELECT tr.id, tr.date, gt.goods_id, 'bench', tr.out_warehouse_id, 2
+        FROM doc_transfers tr JOIN doc_link_goods_transfers gt ON gt.transfer_id = tr.id
+        WHERE tr.id IN (SELECT {bench_id("tr")} FROM generate_series(1, :months * :transfers) g)""",
+    f"""INSERT INTO reg_direct_expenses (registrar_id, goods_doc_id, date, registrar_type, cost_category_id, amount)
+        SELECT {bench_id("de")}, tr.id, tr.date, 'bench', {bench_id("cc", "(g % 2 + 1)")},
+               (g * 104729 + :seed) % 1000000 / 100.0 * CASE WHEN g % 11 = 0 THEN -1 ELSE 1 END
+        FROM generate_series(1, :months * :transfers * 2) g
+        JOIN doc_transfers tr ON tr.id = {bench_id("tr", "((g - 1) / 2 + 1)")}""",
+    f"""INSERT INTO reg_warehouse_expenses (registrar_id, date, cost_category_id, department_id, amount)
+        SELECT {bench_id("we")}, make_timestamp(:year, (g - 1) / 50 + 1, 15, 0, 0, 0), {bench_id("cc", "3")},
+               {bench_id("dep", "(g % 5 + 1)")}, (g * 7907 + :seed) % 10000000 / 1000.0
+        FROM generate_series(1, :months * 50) g""",
+    f"""INSERT INTO reg_general_expenses (registrar_id, date, cost_category_id, amount)
+        SELECT {bench_id("ge", "((g + 1) / 2)")}, make_timestamp(:year, (g - 1) / :general + 1, 20, 0, 0, 0),
+               {bench_id("cc", "(g % 2 + 4)")}, (g * 7883 + :seed) % 10000000 / 100.0
+        FROM generate_series(1, :months * :general) g""",
+]
+
+# (таблица, колонка, вид ключа, сколько ключей)
+_RECALC_KEYS = [
+    ("reg_general_expenses", "registrar_id", "ge", ":months * :general"),
+    ("reg_warehouse_expenses", "registrar_id", "we", ":months * 50"),
+    ("reg_direct_expenses", "registrar_id", "de", ":months * :transfers * 2"),
+    ("reg_goods_location", "registrar_id", "tr", ":months * :transfers"),
+    ("doc_link_goods_transfers", "transfer_id", "tr", ":months * :transfers"),
+    ("ref_goods", "id", "goods", ":months * :transfers * :goods"),
+    ("doc_transfers", "id", "tr", ":months * :transfers"),
+    ("ref_warehouses", "id", "wh", "10"),
+    ("ref_departments", "id", "dep", "5"),
+    ("ref_countries", "id", "country", "2"),
+]
+
+# строки распределения синтетики за RECALC_YEAR (по регистраторам расходов набора)
+_ALLOC_WHERE = f"""
+    WHERE date >= make_date(:year, 1, 1) AND date < make_date(:year + 1, 1, 1)
+      AND registrar_id IN (
+          SELECT {bench_id("de")} FROM generate_series(1, :months * :transfers * 2) g
+          UNION ALL SELECT {bench_id("we")} FROM generate_series(1, :months * 50) g
+          UNION ALL SELECT {bench_id("ge")} FROM generate_series(1, :months * :general) g)
+"""
+
+
+def recalc_params(months: int, transfers: int, goods: int, general: int, seed: int = 0) -> dict:
+    return {
+        "year": RECALC_YEAR, "months": months, "transfers": transfers, "goods": goods, "general": general, "seed": seed,
+    }
+
+
+def add_dataset_args(p, months: int) -> None:
+    """Аргументы командной строки размера набора пересчёта (см. recalc_params)."""
+    p.add_argument("--months", type=int, default=months)
+    p.add_argument("--transfers", type=int, default=200, help="перемещений в месяц")
+    p.add_argument("--goods", type=int, default=10, help="товаров в перемещении")
+    p.add_argument("--general", type=int, default=20, help="строк общих расходов в месяц")
+
+
+def recalc_period(params: dict) -> tuple[date, date]:
+    """Первый и последний месяц набора (для iter_months)."""
+    return date(params["year"], 1, 1), date(params["year"], params["months"], 1)
+
+
+def clean_recalc_dataset(params: dict) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM dm_goods_expense_alloc {_ALLOC_WHERE}"), params)
+        for table, column, kind, count in _RECALC_KEYS:
+            conn.execute(text(
+                f"DELETE FROM {table} WHERE {column} IN (SELECT {bench_id(kind)} FROM generate_series(1, {count}) g)"
+            ), params)
+
+
+def fill_recalc_dataset(params: dict) -> None:
+    clean_recalc_dataset(params)
+    with engine.begin() as conn:
+        for sql in _RECALC_FILL_SQL:
+            conn.execute(text(sql), params)
+    with engine.begin() as conn:
+        for table, *_ in _RECALC_KEYS:
+            conn.exec_driver_sql(f"ANALYZE {table}")
+
+
+@contextmanager
+def recalc_dataset(months: int, transfers: int, goods: int, general: int, seed: int = 0) -> Iterator[dict]:
+    """Набор пересчёта на время блока (и его распределение) — удаляется при выходе; отдаёт params для SQL."""
+    params = recalc_params(months, transfers, goods, general, seed)
+    try:
+        fill_recalc_dataset(params)
+        yield params
+    finally:
+        clean_recalc_dataset(params)
+
+
+def alloc_digest(params: dict) -> dict[str, tuple]:
+    """Строки, сумма и md5 распределения синтетики по типам расходов — для сверки вариантов."""
+    with engine.begin() as conn:
+        rows = conn.execute(text(f"""
+            SELECT type_expense, count(*), sum(amount),
+                   md5(string_agg(concat_ws('|', registrar_id, goods_id, cost_category_id, department_id, date, amount),
+                                  ',' ORDER BY registrar_id, goods_id, cost_category_id, department_id, date))
+            FROM dm_goods_expense_alloc
+            {_ALLOC_WHERE}
+            GROUP BY type_expense ORDER BY type_expense
+        """), params).all()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def alloc_rows(params: dict) -> dict[tuple, str]:
+    """Строки распределения синтетики: ключ строки -> сумма текстом (с её масштабом)."""
+    with engine.begin() as conn:
+        rows = conn.execute(text(f"""
+            SELECT type_expense, registrar_id, goods_id, cost_category_id, department_id, date, amount::text
+            FROM dm_goods_expense_alloc
+            {_ALLOC_WHERE}
+        """), params).all()
+    return {tuple(row[:-1]): row[-1] for row in rows}
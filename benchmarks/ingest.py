@@ -0,0 +1,252 @@
+"""Загрузка шаблона в регистр: заливка TEMP, нормализация строк, части, upsert, месячные партиции."""
+import json
+import multiprocessing
+import resource
+
+from sqlalchemy import MetaData, Table, text
+from sqlalchemy import delete as sa_delete
+
+from benchmarks.common import TEST_DATA_PATH, load_fixture, print_table, scale_rows
+from benchmarks.datasets import BENCH_BG_TYPE, iter_synthetic_rows
+from src.db import db as db_module
+from src.db.coercers import compile_coercer
+from src.db.db import INSERT_BATCH_SIZE, REPLACE_CHUNK_ROWS, engine, iter_batches, load_temp, replace_scope
+from src.db.registry import REGISTRY
+from src.utils import timed
+
+
+def bench_loader(scale: int, repeat: int) -> None:
+    """COPY против executemany при заливке TEMP в replace_scope на ПрямыеРасходы.json."""
+    name_meta = "ПрямыеЗатраты"
+    dataModel = REGISTRY[name_meta]
+    rows = scale_rows(load_fixture("ПрямыеРасходы.json")[name_meta], scale, "Регистратор")
+    coerce = compile_coercer(dataModel)
+    normalized = [coerce(r) for r in rows]
+    columns = list(normalized[0].keys())
+    registrars = {r["registrar_id"] for r in normalized}
+
+    result = []
+    try:
+        for loader in ("insert", "copy"):
+            fill, full = [], []
+            for _ in range(repeat):
+                # только заливка TEMP
+                with engine.begin() as conn:
+                    conn.exec_driver_sql(f"CREATE TEMP TABLE bench_tmp (LIKE {dataModel.__tablename__} INCLUDING DEFAULTS) ON COMMIT DROP")
+                    temp_tbl = Table("bench_tmp", MetaData(), autoload_with=conn)
+                    _, sec = timed(
+                        load_temp, conn, temp_tbl, "bench_tmp", columns, iter_batches(normalized, INSERT_BATCH_SIZE), loader,
+                    )
+                    fill.append(sec)
+
+                # replace_scope целиком (включая валидацию, DELETE и INSERT ... SELECT)
+                _, sec = timed(replace_scope, dataModel, rows, loader=loader)
+                full.append(sec)
+
+            result.append([
+                loader, len(rows),
+                f"{len(rows) / min(fill):,.0f}",
+                f"{len(rows) / min(full):,.0f}",
+            ])
+    finally:
+        with engine.begin() as conn:
+            conn.execute(sa_delete(dataModel).where(dataModel.registrar_id.in_(registrars)))
+
+    print_table(
+        f"replace_scope({name_meta}), лучший из {repeat}",
+        ["loader", "rows", "TEMP rows/s", "replace_scope rows/s"],
+        result,
+    )
+
+
+def bench_coerce() -> None:
+    """Скорость скомпилированной нормализации против pydantic (паритет — tests/test_coercers.py)."""
+    name_meta = "ПрямыеЗатраты"
+    dataModel = REGISTRY[name_meta]
+    rows = load_fixture("ПрямыеРасходы.json")[name_meta]
+
+    def coerce_all(coerce) -> None:
+        for raw in rows:
+            coerce(raw)
+
+    result = []
+    for title, coerce in (
+        ("pydantic", lambda raw: dataModel.model_validate(raw).dict(by_alias=False, exclude_unset=True)),
+        ("compiled", compile_coercer(dataModel)),
+    ):
+        _, elapsed = timed(coerce_all, coerce)
+        result.append([title, len(rows), f"{elapsed * 1e6 / len(rows):.1f}", f"{len(rows) / elapsed:,.0f}"])
+
+    print_table(f"Нормализация строк {name_meta}", ["path", "rows", "us/row", "rows/s"], result)
+
+
+def _delete_registrars(dataModel, keys) -> None:
+    with engine.begin() as conn:
+        for batch in iter_batches(keys, 10000):
+            conn.execute(sa_delete(dataModel).where(dataModel.registrar_id.in_(batch)))
+
+
+def _run_chunked(name_meta: str, rows: int, chunk_rows: int) -> tuple[float, int, int]:
+    """В отдельном процессе: (секунды, RSS до загрузки, пиковый RSS) в КБ."""
+    dataModel = REGISTRY[name_meta]
+    keys: list[str] = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        _, elapsed = timed(
+            replace_scope, dataModel, iter_synthetic_rows(name_meta, rows, 50, 1, keys), chunk_rows=chunk_rows,
+        )
+    finally:
+        _delete_registrars(dataModel, keys)
+    return elapsed, rss_before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_chunks(rows: int, sizes: list[int]) -> None:
+    """Пиковая память и скорость replace_scope по частям (каждый замер — в новом процессе)."""
+    name_meta = "МестонахождениеТовара"
+    ctx = multiprocessing.get_context("spawn")
+    result = []
+    for chunk_rows in sizes:
+        with ctx.Pool(1) as pool:
+            elapsed, rss_before, rss_peak = pool.apply(_run_chunked, (name_meta, rows, chunk_rows))
+        result.append([
+            chunk_rows or "весь шаблон", rows, f"{elapsed:.1f}", f"{rows / elapsed:,.0f}",
+            f"{rss_before / 1024:.0f}", f"{rss_peak / 1024:.0f}",
+        ])
+
+    print_table(
+        f"replace_scope({name_meta}) по частям (по умолчанию REPLACE_CHUNK_ROWS={REPLACE_CHUNK_ROWS})",
+        ["chunk_rows", "rows", "sec", "rows/s", "RSS до, МБ", "пик RSS, МБ"],
+        result,
+    )
+
+
+def _wal_lsn(conn) -> int:
+    return conn.exec_driver_sql("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')").scalar()
+
+
+def bench_upsert(scale: int, repeat: int) -> None:
+    """replace (DELETE + INSERT) против upsert (ON CONFLICT DO UPDATE) на справочнике городов из фикстуры."""
+    dataModel = REGISTRY["Справочник.тп_Города"]
+    with open(TEST_DATA_PATH / "Дополнительные справочники.json", encoding="utf-8-sig") as f:
+        fixture = next(t["Данные"] for t in json.load(f) if t["НаименованиеМетаданных"] == "Справочники.тп_Города")
+    rows = scale_rows(fixture, scale, "Ссылка")
+    changed = [dict(r, Наименование=f"{r['Наименование']} (изм.)") if i % 10 == 0 else r for i, r in enumerate(rows)]
+    ids = [r["Ссылка"] for r in rows]
+    cols = ", ".join(c.name for c in dataModel.__table__.columns if c.name != "created_at")
+    digest_sql = f"""
+        SELECT md5(string_agg(t::text, '|' ORDER BY t::text))
+        FROM (SELECT {cols} FROM {dataModel.__tablename__} WHERE id = ANY(%(ids)s::uuid[])) t
+    """
+
+    def clean():
+        with engine.begin() as conn:
+            for batch in iter_batches(ids, 10000):
+                conn.execute(sa_delete(dataModel).where(dataModel.id.in_(batch)))
+
+    result, digests = [], {}
+    try:
+        for strategy, skip in (("replace", False), ("replace", True), ("upsert", False), ("upsert", True)):
+            for title, payload in (("новые", rows), ("повтор", rows), ("10% изменено", changed)):
+                times, wal = [], []
+                for _ in range(repeat):
+                    if title == "новые":
+                        clean()
+                    elif title == "10% изменено":
+                        replace_scope(dataModel, rows, strategy=strategy, skip_unchanged=skip)
+                    with engine.begin() as conn:
+                        lsn = _wal_lsn(conn)
+                    stats, sec = timed(replace_scope, dataModel, payload, strategy=strategy, skip_unchanged=skip)
+                    times.append(sec)
+                    with engine.begin() as conn:
+                        wal.append(_wal_lsn(conn) - lsn)
+                with engine.begin() as conn:
+                    digest = conn.exec_driver_sql(digest_sql, {"ids": ids}).scalar()
+                same = digests.setdefault(title, digest) == digest
+                result.append([
+                    strategy, "да" if skip else "нет", title, len(payload), f"{min(times):.2f}",
+                    f"{len(payload) / min(times):,.0f}", f"{min(wal) / 1024 / 1024:.1f}",
+                    f"{stats.inserted}/{stats.updated}/{stats.skipped}", same,
+                ])
+    finally:
+        clean()
+
+    print_table(
+        f"{dataModel.__tablename__}: replace vs upsert, лучший из {repeat}",
+        ["strategy", "skip", "пакет", "rows", "sec", "rows/s", "WAL, МБ", "ins/upd/skip", "same result"],
+        result,
+    )
+
+
+def _fill_background(dataModel, rows: int) -> None:
+    """Фоновые строки чужих регистраторов по всем месяцам 2025 (в проде партиции не пустые)."""
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {dataModel.__tablename__} (registrar_id, goods_doc_id, date, registrar_type, cost_category_id, amount)
+            SELECT gen_random_uuid(), gen_random_uuid(),
+                   timestamp '2025-01-01' + (g % 365) * interval '1 day', :t, gen_random_uuid(), g % 1000
+            FROM generate_series(1, :n) g
+        """), {"t": BENCH_BG_TYPE, "n": rows})
+        conn.exec_driver_sql(f"ANALYZE {dataModel.__tablename__}")
+
+
+def bench_partitions(rows: int, background: int, repeat: int) -> None:
+    """replace_scope в RANGE(date)-регистр: через родителя против маршрутизации по месячным партициям."""
+    name_meta = "ПрямыеЗатраты"
+    dataModel = REGISTRY[name_meta]
+    keys: list[str] = []
+    data = list(iter_synthetic_rows(name_meta, rows, 20, 1, keys))
+    routing_default = db_module.PARTITION_ROUTING
+    result = []
+    try:
+        _fill_background(dataModel, background)
+        for routing in (False, True):
+            db_module.PARTITION_ROUTING = routing
+            load_best = rewrite_best = float("inf")
+            for _ in range(repeat):
+                _delete_registrars(dataModel, keys)
+                _, sec = timed(replace_scope, dataModel, data)
+                load_best = min(load_best, sec)
+                # повторная полная замена тех же скоупов: DELETE + INSERT
+                _, sec = timed(replace_scope, dataModel, data, skip_unchanged=False)
+                rewrite_best = min(rewrite_best, sec)
+            result.append([
+                "партиции" if routing else "родитель", rows,
+                f"{load_best:.2f}", f"{rows / load_best:,.0f}", f"{rewrite_best:.2f}", f"{rows / rewrite_best:,.0f}",
+            ])
+    finally:
+        db_module.PARTITION_ROUTING = routing_default
+        _delete_registrars(dataModel, keys)
+        with engine.begin() as conn:
+            conn.execute(sa_delete(dataModel).where(dataModel.registrar_type == BENCH_BG_TYPE))
+
+    print_table(
+        f"replace_scope({name_meta}), строки за 12 месяцев, в таблице ещё {background} строк, лучший из {repeat}",
+        ["маршрут", "rows", "новые, сек", "rows/s", "замена, сек", "rows/s"],
+        result,
+    )
+
+
+def add_commands(sub) -> None:
+    p = sub.add_parser("loader", help="COPY vs INSERT при заливке TEMP")
+    p.add_argument("--scale", type=int, default=20, help="во сколько раз размножить фикстуру")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_loader(a.scale, a.repeat))
+
+    p = sub.add_parser("coerce", help="скорость compile_coercer против pydantic")
+    p.set_defaults(run=lambda a: bench_coerce())
+
+    p = sub.add_parser("chunks", help="память и скорость replace_scope по частям")
+    p.add_argument("--rows", type=int, default=300_000)
+    p.add_argument("--sizes", default="0,20000,100000", help="chunk_rows через запятую, 0 — без частей")
+    p.set_defaults(run=lambda a: bench_chunks(a.rows, [int(x) for x in a.sizes.split(",")]))
+
+    p = sub.add_parser("upsert", help="replace vs upsert на справочнике из фикстуры")
+    p.add_argument("--scale", type=int, default=1000, help="во сколько раз размножить фикстуру")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_upsert(a.scale, a.repeat))
+
+    p = sub.add_parser("partitions", help="replace_scope через родителя vs напрямую в месячные партиции")
+    p.add_argument("--rows", type=int, default=50_000)
+    p.add_argument("--background", type=int, default=2_000_000, help="фоновых строк в таблице на время замера")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_partitions(a.rows, a.background, a.repeat))
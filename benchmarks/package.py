@@ -0,0 +1,133 @@
+"""Пакет целиком: параллельная загрузка по таблицам (с 2PC и без) и форматы тела пакета."""
+import json
+import zlib
+
+from sqlalchemy import delete as sa_delete
+from sqlalchemy import func, select
+
+from benchmarks.common import best_of, print_table
+from benchmarks.datasets import PACKAGE_REGISTERS, synthetic_package
+from src.db.coercers import get_coercer
+from src.db.db import engine
+from src.db.registry import REGISTRY
+from src.handlers.handel_message import PACKAGE_PARSERS, handle_json_stream
+from src.handlers.row_stream import COLUMNS_KEY, msgpack
+
+
+def _package_counts(keys: set[str]) -> dict[str, int]:
+    out = {}
+    with engine.begin() as conn:
+        for name_meta in PACKAGE_REGISTERS:
+            model = REGISTRY[name_meta]
+            out[name_meta] = conn.execute(
+                select(func.count()).select_from(model).where(model.registrar_id.in_(keys))
+            ).scalar()
+    return out
+
+
+def _delete_package(keys: set[str]) -> None:
+    with engine.begin() as conn:
+        for name_meta in PACKAGE_REGISTERS:
+            model = REGISTRY[name_meta]
+            conn.execute(sa_delete(model).where(model.registrar_id.in_(keys)))
+
+
+def bench_parallel(registrars: int, rows: int, workers: int, repeat: int) -> None:
+    """Последовательная загрузка пакета против параллельной по таблицам (с 2PC и без)."""
+    package, keys = synthetic_package(registrars, rows, seed=1)
+    body = json.dumps(package, ensure_ascii=False).encode("utf-8")
+    total = registrars * rows * len(PACKAGE_REGISTERS)
+
+    result, expected = [], None
+    try:
+        for title, parallel, atomic in (
+            ("sequential", 1, True),
+            (f"parallel x{workers}", workers, False),
+            (f"parallel x{workers}, 2PC", workers, True),
+        ):
+            best, _ = best_of(
+                repeat, handle_json_stream, (body,), parallel=parallel, atomic=atomic,
+                before=lambda: _delete_package(keys),
+            )
+            counts = _package_counts(keys)
+            expected = expected or counts
+            result.append([title, total, f"{best:.2f}", f"{total / best:,.0f}", counts == expected])
+    finally:
+        _delete_package(keys)
+
+    print_table(
+        f"Пакет: {len(package)} шаблонов, {len(PACKAGE_REGISTERS)} таблиц, лучший из {repeat}",
+        ["mode", "rows", "sec", "rows/s", "same result"],
+        result,
+    )
+
+
+def columnar_records(package: list[dict]) -> list:
+    """Пакет в построчном виде row_stream: заголовок с алиасами колонок и строки-массивы."""
+    records = []
+    for template in package:
+        data = template["Данные"]
+        columns = list(data[0]) if data else []
+        records.append({"НаименованиеМетаданных": template["НаименованиеМетаданных"], COLUMNS_KEY: columns})
+        records.extend([row[c] for c in columns] for row in data)
+    return records
+
+
+def iter_batches_bytes(body: bytes, size: int = 64 * 1024):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def _parse_package(body: bytes, package_format: str, coerce_rows: bool) -> int:
+    """Разбор (и нормализация) строк без записи в БД; возвращает число строк."""
+    n = 0
+    for name_meta, items in PACKAGE_PARSERS[package_format](iter_batches_bytes(body)):
+        coerce = get_coercer(REGISTRY[name_meta]) if coerce_rows else None
+        for raw in items:
+            if coerce is not None:
+                coerce(raw)
+            n += 1
+    return n
+
+
+def bench_formats(registrars: int, rows: int, repeat: int) -> None:
+    """Размер тела и скорость разбора+нормализации: JSON-массив, NDJSON и msgpack с колонками."""
+    package, _ = synthetic_package(registrars, rows, seed=1)
+    records = columnar_records(package)
+    bodies = {
+        "json": json.dumps(package, ensure_ascii=False).encode("utf-8"),
+        "ndjson": "\n".join(json.dumps(r, ensure_ascii=False) for r in records).encode("utf-8"),
+    }
+    if msgpack is not None:
+        bodies["msgpack"] = b"".join(msgpack.packb(r) for r in records)
+
+    table = []
+    base_parse = base_total = None
+    for package_format, body in bodies.items():
+        parse_sec, n = best_of(repeat, _parse_package, body, package_format, coerce_rows=False)
+        total_sec, _ = best_of(repeat, _parse_package, body, package_format, coerce_rows=True)
+        base_parse, base_total = base_parse or parse_sec, base_total or total_sec
+        table.append([
+            package_format, len(body) // 1024, len(zlib.compress(body, 6)) // 1024, n,
+            f"{parse_sec:.2f}", f"{base_parse / parse_sec:.2f}x",
+            f"{total_sec:.2f}", f"{base_total / total_sec:.2f}x",
+        ])
+    print_table(
+        f"Форматы пакета: {len(package)} шаблонов, лучший из {repeat} (без записи в БД)",
+        ["формат", "КБ", "КБ gzip", "строк", "разбор, с", "ускорение", "+нормализация, с", "ускорение"], table,
+    )
+
+
+def add_commands(sub) -> None:
+    p = sub.add_parser("parallel", help="последовательная vs параллельная по таблицам загрузка пакета")
+    p.add_argument("--registrars", type=int, default=200)
+    p.add_argument("--rows", type=int, default=50, help="строк на шаблон")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_parallel(a.registrars, a.rows, a.workers, a.repeat))
+
+    p = sub.add_parser("formats", help="JSON-массив vs NDJSON/msgpack с колонками: размер и разбор")
+    p.add_argument("--registrars", type=int, default=200)
+    p.add_argument("--rows", type=int, default=200, help="строк на шаблон")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_formats(a.registrars, a.rows, a.repeat))
@@ -0,0 +1,121 @@
+"""Пересчёт распределения расходов: период целиком (пул соединений, способ публикации) и по отметкам загрузки."""
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from benchmarks.common import print_table, require_same
+from benchmarks.datasets import add_dataset_args, alloc_digest, bench_id, recalc_dataset, recalc_period
+from src.db.dags import ALLOC_SQL_BY_TYPE, recalc_dirty, recalc_units
+from src.db.db import engine, replace_scope
+from src.db.registry import REGISTRY
+from src.utils import iter_months, timed
+
+
+def _alloc_dead_tuples(year: int) -> int:
+    """Мёртвые строки в месячных партициях dm_goods_expense_alloc за год (по pg_stat_user_tables)."""
+    time.sleep(1.5)  # статистика других соединений сбрасывается не чаще раза в секунду
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_stat_clear_snapshot()"))
+        return conn.execute(
+            text("SELECT coalesce(sum(n_dead_tup), 0) FROM pg_stat_user_tables WHERE relname LIKE :pattern"),
+            {"pattern": f"dm\\_goods\\_expense\\_alloc\\_{year}\\___"},
+        ).scalar()
+
+
+def bench_recalc(months: int, transfers: int, goods: int, general: int, workers: list[int], publish: list[str]) -> None:
+    """Пересчёт периода на синтетике: последовательно и пулом соединений, DELETE или подменой партиций, со сверкой."""
+    table, digests = [], {}
+    with recalc_dataset(months, transfers, goods, general) as params:
+        units = [(m, t) for m, _ in iter_months(*recalc_period(params)) for t in ALLOC_SQL_BY_TYPE]
+        for mode in publish:
+            for n in workers:
+                _, sec = timed(recalc_units, engine, units, workers=n, publish=mode)
+                digests[(mode, n)] = alloc_digest(params)
+                rows = sum(d[0] for d in digests[(mode, n)].values())
+                table.append([
+                    mode, n, len(units), rows, f"{sec:.2f}", f"{rows / sec:,.0f}", _alloc_dead_tuples(params["year"]),
+                ])
+
+    print_table(
+        f"Пересчёт {months} мес.: {transfers} перемещений/мес. по {goods} товаров, {general} общих расходов/мес.",
+        ["публикация", "соединений", "пар (месяц, тип)", "строк распределения", "сек", "строк/с", "мёртвых строк"],
+        table,
+    )
+    base = digests[(publish[0], workers[0])]
+    print("строки и суммы по типам совпадают:", all(
+        {k: v[:2] for k, v in d.items()} == {k: v[:2] for k, v in base.items()} for d in digests.values()
+    ))
+    require_same("построчно совпадает", all(d == base for d in digests.values()))
+
+
+def _package_rows(dataModel, rows) -> list[dict]:
+    """Строки таблицы в виде строк пакета 1С: алиасы полей, значения как в JSON."""
+    aliases = {f.name: f.alias for f in dataModel.__fields__.values() if f.name != "created_at"}
+
+    def value(v):
+        if isinstance(v, datetime):
+            return v.isoformat()
+        return v if v is None or isinstance(v, (bool, int, str)) else str(v)
+
+    return [{aliases[k]: value(v) for k, v in row.items() if k in aliases} for row in rows]
+
+
+# (сценарий, шаблон, SQL строк, которые приходят в пакете заново с суммой + 1)
+_INCREMENTAL_CASES = [
+    ("документ прямых расходов", "ПрямыеЗатраты",
+     f"SELECT * FROM reg_direct_expenses WHERE registrar_id = {bench_id('de', '1')}"),
+    ("документ общих расходов", "ОбщиеЗатраты",
+     f"SELECT * FROM reg_general_expenses WHERE registrar_id = {bench_id('ge', '1')}"),
+    ("сумма товара", "Товары", f"SELECT id, amount FROM ref_goods WHERE id = {bench_id('goods', '1')}"),
+]
+
+
+def bench_incremental(months: int, transfers: int, goods: int, general: int) -> None:
+    """
+    Пересчёт после изменения одного документа: recalc_dirty по отметкам загрузки
+    (регистраторы или месяцы целиком) против полного пересчёта периода, со сверкой.
+    """
+    table = []
+    with recalc_dataset(months, transfers, goods, general) as params:
+        units = [(m, t) for m, _ in iter_months(*recalc_period(params)) for t in ALLOC_SQL_BY_TYPE]
+        recalc_units(engine, units)
+        recalc_dirty(engine)  # отметки, накопленные до замера
+        for label, name_meta, sql in _INCREMENTAL_CASES:
+            dataModel = REGISTRY[name_meta]
+            with engine.begin() as conn:
+                rows = [dict(r) for r in conn.execute(text(sql)).mappings()]
+            for row in rows:
+                row["amount"] += 1
+
+            _, load_sec = timed(replace_scope, dataModel, _package_rows(dataModel, rows))
+            reports, dirty_sec = timed(recalc_dirty, engine)
+            incremental = alloc_digest(params)
+            _, full_sec = timed(recalc_units, engine, units)
+
+            scope = [n if n is not None else "месяц" for r in reports for n in r["registrars"].values()]
+            table.append([
+                label, ", ".join(str(x) for x in scope), f"{load_sec:.3f}", f"{dirty_sec:.3f}", f"{full_sec:.2f}",
+                incremental == alloc_digest(params),
+            ])
+
+    print_table(
+        f"Изменение одного документа, {months} мес.: {transfers} перемещений/мес. по {goods} товаров",
+        ["сценарий", "регистраторов по парам", "загрузка, сек", "recalc_dirty, сек", "полный пересчёт, сек", "совпадает"],
+        table,
+    )
+    require_same("совпадает с полным пересчётом", all(row[-1] for row in table))
+
+
+def add_commands(sub) -> None:
+    p = sub.add_parser("recalc", help="пересчёт расходов за период: последовательно vs пулом соединений")
+    add_dataset_args(p, months=12)
+    p.add_argument("--workers", default="1,4", help="размеры пула через запятую")
+    p.add_argument("--publish", default="delete,swap", help="способы публикации через запятую (RECALC_PUBLISH)")
+    p.set_defaults(run=lambda a: bench_recalc(
+        a.months, a.transfers, a.goods, a.general, [int(x) for x in a.workers.split(",")], a.publish.split(","),
+    ))
+
+    p = sub.add_parser("incremental", help="пересчёт отмеченных регистраторов vs полный после правки документа")
+    add_dataset_args(p, months=12)
+    p.set_defaults(run=lambda a: bench_incremental(a.months, a.transfers, a.goods, a.general))
@@ -0,0 +1,212 @@
+"""Доли распределения за месяц: соединения по исходным таблицам против общих весов месяца и отбор отправлений."""
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from benchmarks.common import print_table, require_same
+from benchmarks.datasets import BENCH_BG_TYPE, RECALC_YEAR, add_dataset_args, recalc_dataset, recalc_period
+from src.db.dags import ALLOC_SQL_BY_TYPE, REGISTRAR_ALLOC_SQL_BY_TYPE, _alloc_params, build_goods_weight
+from src.db.db import engine
+from src.db.dirty_months import GENERAL_EXPENSES, WAREHOUSE_EXPENSES
+from src.db.sql_query import DELETE_GOODS_WEIGHT_SQL, GOODS_WEIGHT_LOCATIONS_SQL
+from src.db.utils.online_partition import convert_to_partitioned
+from src.utils import iter_months, next_month, timed
+
+
+def _shares_sum(shares_sql: str, params: dict) -> tuple[int, Decimal]:
+    """Число строк и сумма долей без записи распределения — замер соединений и окон."""
+    with engine.begin() as conn:
+        return tuple(conn.execute(text(f"SELECT count(*), sum(s.amount) FROM ({shares_sql}) s"), params).one())
+
+
+def _shares_digest(shares_sql: str, params: dict) -> str:
+    """md5 строк долей — для построчной сверки."""
+    with engine.begin() as conn:
+        return conn.execute(
+            text(f"SELECT md5(string_agg(s::text, ',' ORDER BY s::text)) FROM ({shares_sql}) s"), params,
+        ).scalar()
+
+
+def _month_shares(sql_by_type: dict[str, str], mstart: date, mnext: date) -> list[tuple[int, Decimal]]:
+    return [_shares_sum(sql, _alloc_params(t, mstart, mnext)) for t, sql in sql_by_type.items()]
+
+
+def _same_shares(type_expense: str, alloc_params: dict) -> bool:
+    """Доли типа по исходным таблицам и по весам месяца совпадают построчно."""
+    return (
+        _shares_digest(REGISTRAR_ALLOC_SQL_BY_TYPE[type_expense], alloc_params)
+        == _shares_digest(ALLOC_SQL_BY_TYPE[type_expense], alloc_params)
+    )
+
+
+def bench_weights(months: int, transfers: int, goods: int, general: int) -> None:
+    """
+    Доли трёх типов расходов за месяц: каждый тип соединяет товары, перемещения и склады
+    сам (REGISTRAR_ALLOC_SQL_BY_TYPE без отбора) против общих весов месяца
+    (build_goods_weight + ALLOC_SQL_BY_TYPE). Только SELECT долей, без записи распределения.
+    """
+    table, same = [], True
+    with recalc_dataset(months, transfers, goods, general) as params:
+        try:
+            for mstart, _ in iter_months(*recalc_period(params)):
+                mnext = next_month(mstart)
+                joined, joined_sec = timed(_month_shares, REGISTRAR_ALLOC_SQL_BY_TYPE, mstart, mnext)
+                weight_rows, build_sec = timed(build_goods_weight, engine, mstart, mnext)
+                shared, shares_sec = timed(_month_shares, ALLOC_SQL_BY_TYPE, mstart, mnext)
+
+                month_same = joined == shared and all(
+                    _same_shares(t, _alloc_params(t, mstart, mnext)) for t in ALLOC_SQL_BY_TYPE
+                )
+                same &= month_same
+                table.append([
+                    mstart.strftime("%Y-%m"), sum(n for n, _ in joined), f"{joined_sec:.2f}", weight_rows,
+                    f"{build_sec:.2f}", f"{shares_sec:.2f}", f"{build_sec + shares_sec:.2f}", month_same,
+                ])
+        finally:
+            with engine.begin() as conn:
+                conn.execute(
+                    text("DELETE FROM stg_goods_weight WHERE month >= make_date(:year, 1, 1) AND month < make_date(:year + 1, 1, 1)"),
+                    params,
+                )
+
+    print_table(
+        f"Доли трёх типов за месяц: {transfers} перемещений/мес. по {goods} товаров, {general} общих расходов/мес.",
+        ["месяц", "строк долей", "соединения по типам, сек", "строк весов", "веса, сек", "доли по весам, сек",
+         "итого по весам, сек", "совпадает"],
+        table,
+    )
+    require_same("доли совпадают", same)
+
+
+def bench_general(expenses: list[int], transfers: list[int], goods: int) -> None:
+    """
+    Доли общих расходов за месяц при разном числе строк расходов и перемещений из Китая:
+    соединение каждой строки со всеми перемещениями и странами (исходные таблицы) против
+    набора товаров месяца kind = 'china' с готовой суммой (build_goods_weight + доли по весам).
+    """
+    mstart = date(RECALC_YEAR, 1, 1)
+    mnext = next_month(mstart)
+    alloc_params = _alloc_params(GENERAL_EXPENSES, mstart, mnext)
+    table, same = [], True
+    for n_general in expenses:
+        for n_transfers in transfers:
+            with recalc_dataset(1, n_transfers, goods, n_general):
+                try:
+                    joined, joined_sec = timed(_shares_sum, REGISTRAR_ALLOC_SQL_BY_TYPE[GENERAL_EXPENSES], alloc_params)
+                    _, build_sec = timed(build_goods_weight, engine, mstart, mnext)
+                    shared, shares_sec = timed(_shares_sum, ALLOC_SQL_BY_TYPE[GENERAL_EXPENSES], alloc_params)
+
+                    case_same = joined == shared and _same_shares(GENERAL_EXPENSES, alloc_params)
+                    same &= case_same
+                    table.append([
+                        n_general, n_transfers, joined[0], f"{joined_sec:.2f}", f"{build_sec:.2f}", f"{shares_sec:.2f}",
+                        f"{joined_sec / (build_sec + shares_sec):.1f}x", case_same,
+                    ])
+                finally:
+                    with engine.begin() as conn:
+                        conn.execute(text(DELETE_GOODS_WEIGHT_SQL), {"mstart": mstart})
+
+    print_table(
+        f"Доли общих расходов за месяц, {goods} товаров в перемещении",
+        ["строк общих", "перемещений", "строк долей", "по исходным, сек", "веса месяца, сек", "доли по набору, сек",
+         "ускорение", "совпадает"],
+        table,
+    )
+    require_same("доли совпадают", same)
+
+
+_BENCH_PLAIN_GL = "bench_goods_location_plain"  # копия reg_goods_location без партиций и частичного индекса
+
+
+def _location_queries_sec(table: str, alloc_params: dict, repeat: int) -> tuple[float, float, tuple]:
+    """
+    Лучшее время отбора отправлений месяца из table: доли складских расходов по исходным
+    таблицам и веса kind = 'location' (INSERT откатывается). Плюс число строк и сумма долей.
+    """
+    shares_sql = REGISTRAR_ALLOC_SQL_BY_TYPE[WAREHOUSE_EXPENSES].replace("reg_goods_location", table)
+    weights_sql = GOODS_WEIGHT_LOCATIONS_SQL.replace("reg_goods_location", table)
+    shares_best = weights_best = float("inf")
+    for _ in range(repeat):
+        shares, sec = timed(_shares_sum, shares_sql, alloc_params)
+        shares_best = min(shares_best, sec)
+        with engine.connect() as conn:
+            trans = conn.begin()
+            _, sec = timed(conn.execute, text(weights_sql), alloc_params)
+            weights_best = min(weights_best, sec)
+            trans.rollback()
+    return shares_best, weights_best, shares
+
+
+def bench_location(transfers: int, goods: int, background: int, repeat: int) -> None:
+    """
+    Отбор отправлений месяца со складов (раскладка складских расходов): reg_goods_location
+    с месячными партициями и частичным индексом против той же таблицы без них, при
+    background фоновых строк за 2025–2026 год. Заодно — время convert_to_partitioned
+    на копии без партиций.
+    """
+    mstart = date(RECALC_YEAR, 1, 1)
+    alloc_params = _alloc_params(WAREHOUSE_EXPENSES, mstart, next_month(mstart))
+    table = []
+    with recalc_dataset(1, transfers, goods, 20):
+        try:
+            with engine.begin() as conn:
+                # фон: другие склады и статусы, каждый месяц двух лет
+                conn.execute(text("""
+                    INSERT INTO reg_goods_location (registrar_id, date, goods_id, registrar_type, sender_warehouse_id, goods_status)
+                    SELECT gen_random_uuid(), timestamp '2025-01-01' + (g % 730) * interval '1 day', gen_random_uuid(),
+                           :t, md5('bench-bg-wh:' || g % 500)::uuid, g % 4
+                    FROM generate_series(1, :n) g
+                """), {"t": BENCH_BG_TYPE, "n": background})
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {_BENCH_PLAIN_GL}")
+                conn.exec_driver_sql(f"CREATE TABLE {_BENCH_PLAIN_GL} (LIKE reg_goods_location INCLUDING DEFAULTS)")
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {_BENCH_PLAIN_GL} ADD PRIMARY KEY (registrar_id, date, goods_id, registrar_type)"
+                )
+                conn.exec_driver_sql(f"INSERT INTO {_BENCH_PLAIN_GL} SELECT * FROM reg_goods_location")
+            with engine.begin() as conn:
+                conn.exec_driver_sql("ANALYZE reg_goods_location")
+                conn.exec_driver_sql(f"ANALYZE {_BENCH_PLAIN_GL}")
+
+            rows = [["без партиций", *_location_queries_sec(_BENCH_PLAIN_GL, alloc_params, repeat)]]
+            rows.append(["партиции + индекс", *_location_queries_sec("reg_goods_location", alloc_params, repeat)])
+            for name, shares_sec, weights_sec, shares in rows:
+                table.append([name, shares[0], f"{shares_sec:.3f}", f"{weights_sec:.3f}", shares == rows[0][3]])
+
+            converted, convert_sec = timed(convert_to_partitioned, engine, _BENCH_PLAIN_GL)
+        finally:
+            with engine.begin() as conn:
+                conn.execute(text("DELETE FROM reg_goods_location WHERE registrar_type = :t"), {"t": BENCH_BG_TYPE})
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {_BENCH_PLAIN_GL}")
+
+    print_table(
+        f"Отправления месяца: {transfers} перемещений по {goods} товаров, фон {background} строк, лучший из {repeat}",
+        ["reg_goods_location", "строк долей", "доли складских, сек", "веса location, сек", "совпадает"],
+        table,
+    )
+    print(
+        f"convert_to_partitioned копии: {convert_sec:.1f} сек, партиций {converted['partitions']}, "
+        f"строк {converted['copied']}"
+    )
+    require_same("доли совпадают", all(row[-1] for row in table))
+
+
+def add_commands(sub) -> None:
+    p = sub.add_parser("weights", help="доли трёх типов: соединения в каждом типе vs общие веса месяца")
+    add_dataset_args(p, months=3)
+    p.set_defaults(run=lambda a: bench_weights(a.months, a.transfers, a.goods, a.general))
+
+    p = sub.add_parser("general", help="доли общих расходов: соединение с перемещениями vs набор товаров месяца")
+    p.add_argument("--expenses", default="20,80", help="строк общих расходов в месяц через запятую")
+    p.add_argument("--transfers", default="200,800", help="перемещений в месяц через запятую")
+    p.add_argument("--goods", type=int, default=10, help="товаров в перемещении")
+    p.set_defaults(run=lambda a: bench_general(
+        [int(x) for x in a.expenses.split(",")], [int(x) for x in a.transfers.split(",")], a.goods,
+    ))
+
+    p = sub.add_parser("location", help="отправления месяца: reg_goods_location с партициями и индексом vs без")
+    p.add_argument("--transfers", type=int, default=200, help="перемещений в месяце")
+    p.add_argument("--goods", type=int, default=10, help="товаров в перемещении")
+    p.add_argument("--background", type=int, default=1_000_000, help="фоновых строк за два года")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=lambda a: bench_location(a.transfers, a.goods, a.background, a.repeat))
@@ -12,6 +12,12 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_NAME: str
     LOGGER_LEVEL: str
+    INGEST_WORKERS: int = 1  # воркеры очереди загрузки; 1 — пакеты применяются строго в порядке поступления
+    INGEST_PARALLEL_TABLES: int = 1  # параллельных соединений на таблицы внутри пакета; 1 — последовательно
+    INGEST_ATOMIC: bool = True  # параллельный пакет фиксируется целиком (двухфазный коммит)
+    INGEST_DEDUP_TTL_HOURS: int = 24  # сколько часов повтор пакета подтверждается без загрузки; 0 — выключено
+    RECALC_WORKERS: int = 4  # параллельных соединений пересчёта расходов (месяц, тип расхода); 1 — последовательно
+    RECALC_PUBLISH: str = "delete"  # публикация пересчёта месяца: delete (DELETE + INSERT) или swap (подмена партиции)
 
     @property
     def DATABASE_URL(self):
@@ -0,0 +1,52 @@
+"""Чекпоинты первичной загрузки файлов (таблица load_checkpoint)."""
+from sqlalchemy import Connection, text
+
+from src.db.db import engine
+
+FILE_DONE = -1  # template_index строки "файл загружен целиком"
+
+
+def get_file_checkpoints(file_name: str, file_size: int, file_mtime: float) -> set[int] | None:
+    """
+    Индексы уже записанных шаблонов файла (FILE_DONE среди них — файл загружен).
+    Если файл с тем же именем изменился (размер/время), его чекпоинты сбрасываются.
+    """
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text("select template_index, file_size, file_mtime from load_checkpoint where file_name = :f"),
+            {"f": file_name},
+        ).all()
+        if any(size != file_size or mtime != file_mtime for _, size, mtime in rows):
+            reset_file(file_name, conn)
+            return set()
+        return {index for index, _, _ in rows}
+
+
+def reset_file(file_name: str, conn: Connection | None = None) -> None:
+    q = text("delete from load_checkpoint where file_name = :f")
+    if conn is not None:
+        conn.execute(q, {"f": file_name})
+        return
+    with engine.begin() as conn:
+        conn.execute(q, {"f": file_name})
+
+
+def save_checkpoint(
+        conn: Connection,
+        file_name: str,
+        file_size: int,
+        file_mtime: float,
+        template_index: int,
+        name_metadata: str | None = None,
+        rows: int = 0,
+) -> None:
+    """Пишется в той же транзакции, что и данные шаблона."""
+    conn.execute(text("""
+        insert into load_checkpoint(file_name, template_index, file_size, file_mtime, name_metadata, rows)
+        values (:f, :i, :size, :mtime, :name, :rows)
+        on conflict (file_name, template_index) do update
+        set rows = excluded.rows, name_metadata = excluded.name_metadata, finished_at = now()
+    """), {
+        "f": file_name, "i": template_index, "size": file_size, "mtime": file_mtime,
+        "name": name_metadata, "rows": rows,
+    })
@@ -0,0 +1,203 @@
+"""
+Быстрая нормализация строк из 1С.
+
+replace_scope раньше делал для каждой строки model_validate(raw).dict(by_alias=False, exclude_unset=True):
+на каждую строку строились два объекта и по каждому полю проходила цепочка валидаторов pydantic.
+Здесь модель один раз "компилируется" в список (алиас, колонка, конвертер), и строка приводится
+за один проход по полям.
+
+Конвертеры покрывают только типичный вид значений из JSON 1С (строка UUID, ISO-дата без зоны,
+число и т.п.). Всё остальное (неожиданный тип, невалидное значение, отсутствующее обязательное
+поле) отдаётся pydantic — целиком для этой строки, поэтому и результат, и ошибки совпадают
+с прежним путём.
+"""
+import re
+import uuid
+from collections.abc import Callable
+from datetime import datetime
+from decimal import Decimal, DecimalException
+
+from sqlmodel import SQLModel
+
+
+class _Fallback(Exception):
+    """Значение не покрыто быстрым путём — строку валидирует pydantic."""
+
+
+_DATETIME_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?")
+
+
+def _to_uuid(v):
+    if type(v) is str:
+        try:
+            return uuid.UUID(v)
+        except ValueError:
+            raise _Fallback from None
+    if type(v) is uuid.UUID:
+        return v
+    raise _Fallback
+
+
+def _to_datetime(v):
+    if type(v) is str:
+        m = _DATETIME_RE.fullmatch(v)
+        if m:
+            year, month, day, hour, minute, second, micro = m.groups()
+            try:
+                return datetime(
+                    int(year), int(month), int(day), int(hour), int(minute), int(second),
+                    int(micro.ljust(6, "0")) if micro else 0,
+                )
+            except ValueError:
+                pass
+    elif type(v) is datetime:
+        return v
+    raise _Fallback
+
+
+def _to_decimal(v):
+    t = type(v)
+    if t is Decimal:
+        return v
+    if t is int or t is float or t is str:
+        try:
+            d = Decimal(str(v).strip())
+        except (DecimalException, ValueError):
+            raise _Fallback from None
+        if d.is_finite():
+            return d
+    raise _Fallback
+
+
+def _to_bool(v):
+    if v is True or v is False:
+        return v
+    raise _Fallback
+
+
+def _to_int(v):
+    if type(v) is int:
+        return v
+    raise _Fallback
+
+
+def _to_float(v):
+    t = type(v)
+    if t is float:
+        return v
+    if t is int:
+        return float(v)
+    raise _Fallback
+
+
+def _str_converter(max_length: int | None) -> Callable:
+    def _to_str(v):
+        if type(v) is str and (max_length is None or len(v) <= max_length):
+            return v
+        raise _Fallback
+
+    return _to_str
+
+
+# цепочки валидаторов pydantic, которые мы умеем воспроизводить
+_STR_CHAIN = ("str_validator",)
+_CONSTR_CHAIN = (
+    "str_validator", "constr_strip_whitespace", "constr_upper", "constr_lower", "constr_length_validator", "validate",
+)
+_CONVERTERS: dict[tuple[type, tuple[str, ...]], Callable] = {
+    (uuid.UUID, ("uuid_validator",)): _to_uuid,
+    (datetime, ("parse_datetime",)): _to_datetime,
+    (Decimal, ("decimal_validator",)): _to_decimal,
+    (bool, ("bool_validator",)): _to_bool,
+    (int, ("int_validator",)): _to_int,
+    (float, ("float_validator",)): _to_float,
+}
+
+_EMPTY_TO_NONE = "_uuid_empty_to_none"
+
+
+def _field_converter(field) -> Callable | None:
+    validators = tuple(getattr(v, "__name__", "") for v in field.validators or ())
+    pre = [getattr(v, "__name__", "") for v in field.pre_validators or ()]
+    if pre not in ([], [_EMPTY_TO_NONE]) or field.post_validators or field.shape != 1:
+        return None
+
+    if field.type_ is str and validators == _STR_CHAIN:
+        return _str_converter(None)
+    if validators == _CONSTR_CHAIN and issubclass(field.type_, str):
+        ti = field.type_
+        if (ti.strip_whitespace or ti.to_upper or ti.to_lower or ti.strict or ti.regex is not None
+                or ti.curtail_length is not None or (ti.min_length or 0) > 0):
+            return None
+        return _str_converter(ti.max_length)
+    return _CONVERTERS.get((field.type_, validators))
+
+
+def _slow_path(dataModel: type[SQLModel]) -> Callable[[dict], dict]:
+    def coerce(raw):
+        return dataModel.model_validate(raw).dict(by_alias=False, exclude_unset=True)
+
+    return coerce
+
+
+def compile_coercer(dataModel: type[SQLModel]) -> Callable[[dict], dict]:
+    """
+    Строит функцию raw-строка 1С -> dict {колонка: значение},
+    эквивалентную model_validate(raw).dict(by_alias=False, exclude_unset=True).
+    """
+    slow = _slow_path(dataModel)
+    config = dataModel.__config__
+    if (dataModel.__pre_root_validators__ or dataModel.__post_root_validators__
+            or config.min_anystr_length or config.max_anystr_length is not None):
+        return slow
+
+    plan = []
+    for field in dataModel.__fields__.values():
+        conv = _field_converter(field)
+        if conv is None:
+            return slow
+        # как и pydantic: сначала алиас, затем имя поля (allow_population_by_field_name)
+        alt_name = field.name if config.allow_population_by_field_name and field.alt_alias else None
+        empty_to_none = bool(field.pre_validators)
+        plan.append((field.alias, alt_name, field.name, conv, field.required, field.allow_none, empty_to_none))
+    plan = tuple(plan)
+
+    def coerce(raw):
+        if type(raw) is not dict:
+            return slow(raw)
+        out = {}
+        try:
+            for alias, alt_name, key, conv, required, allow_none, empty_to_none in plan:
+                if alias in raw:
+                    v = raw[alias]
+                elif alt_name is not None and alt_name in raw:
+                    v = raw[alt_name]
+                elif required:
+                    raise _Fallback
+                else:
+                    continue
+
+                if empty_to_none and type(v) is str and not v.strip():
+                    v = None
+                if v is None:
+                    if not allow_none:
+                        raise _Fallback
+                    out[key] = None
+                else:
+                    out[key] = conv(v)
+        except _Fallback:
+            return slow(raw)
+        return out
+
+    return coerce
+
+
+_COERCERS: dict[type[SQLModel], Callable[[dict], dict]] = {}
+
+
+def get_coercer(dataModel: type[SQLModel]) -> Callable[[dict], dict]:
+    """Скомпилированный нормализатор модели (строится один раз на модель)."""
+    coercer = _COERCERS.get(dataModel)
+    if coercer is None:
+        coercer = _COERCERS[dataModel] = compile_coercer(dataModel)
+    return coercer
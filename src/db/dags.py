@@ -1,23 +1,65 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from decimal import Decimal
-from typing import Optional
+from typing import Callable, Optional
 
-from sqlalchemy import text, Engine, Connection, inspect
+from sqlalchemy import text, Connection, Engine
 from src.db.sql_query import (
-    CREATE_VIEWS_SQL,
-    UPDATE_WITH_VIEWS_SQL,
-    DROP_VIEWS_SQL,
+    ALLOC_EXPENSES_SQL,
     DELETE_ALLOC_EXPENSES_SQL,
-    INSERT_ALLOC_EXPENSES_SQL,
-    ALLOC_DIRECT_EXPENSES_SQL,
-    ALLOC_WAREHOUSE_EXPENSES_SQL,
-    ALLOC_GENERAL_EXPENSES_SQL,
+    DELETE_GOODS_WEIGHT_SQL,
+    GOODS_WEIGHT_CHINA_SQL,
+    GOODS_WEIGHT_LOCATIONS_SQL,
+    GOODS_WEIGHT_TRANSFERS_SQL,
+    DIRECT_EXPENSES_SHARES_SQL,
+    WAREHOUSE_EXPENSES_SHARES_SQL,
+    GENERAL_EXPENSES_SHARES_SQL,
+    DIRECT_EXPENSES_REGISTRAR_SHARES_SQL,
+    WAREHOUSE_EXPENSES_REGISTRAR_SHARES_SQL,
+    GENERAL_EXPENSES_REGISTRAR_SHARES_SQL,
 )
-from src.utils import iter_months
+from src.db.dirty_months import DIRECT_EXPENSES, GENERAL_EXPENSES, WAREHOUSE_EXPENSES, clear_dirty, read_dirty
+from src.db.utils.partition_manager import (
+    PARTITIONS_SCHEMA,
+    create_parent_indexes,
+    drop_retired_partitions,
+    month_partition_name,
+    swap_month_partition,
+)
+from src.config import settings
+from src.utils import iter_months, next_month, timed
+
+log = logging.getLogger("app")
+
+ALLOC_TABLE = "dm_goods_expense_alloc"
+PUBLISH_DELETE = "delete"
+PUBLISH_SWAP = "swap"
 
 PRECISION = 2  # количество знаков после запятой
 INC = Decimal(1) / (Decimal(10) ** PRECISION)  # шаг инкремента (0.01 при PRECISION=2)
 
+# тип расхода (таблица регистра затрат) -> SQL долей за месяц по весам stg_goods_weight, в порядке пересчёта
+ALLOC_SQL_BY_TYPE = {
+    DIRECT_EXPENSES: DIRECT_EXPENSES_SHARES_SQL,
+    WAREHOUSE_EXPENSES: WAREHOUSE_EXPENSES_SHARES_SQL,
+    GENERAL_EXPENSES: GENERAL_EXPENSES_SHARES_SQL,
+}
+
+# тип расхода -> SQL долей отобранных регистраторов по исходным таблицам (без весов месяца)
+REGISTRAR_ALLOC_SQL_BY_TYPE = {
+    DIRECT_EXPENSES: DIRECT_EXPENSES_REGISTRAR_SHARES_SQL,
+    WAREHOUSE_EXPENSES: WAREHOUSE_EXPENSES_REGISTRAR_SHARES_SQL,
+    GENERAL_EXPENSES: GENERAL_EXPENSES_REGISTRAR_SHARES_SQL,
+}
+
+# тип расхода -> type_expense строк dm_goods_expense_alloc
+TYPE_EXPENSE = {
+    DIRECT_EXPENSES: "Прямые расходы",
+    WAREHOUSE_EXPENSES: "Складские расходы",
+    GENERAL_EXPENSES: "Общие расходы",
+}
+
 
 def get_last_success(engine: Engine, job_name: str) -> Optional[datetime]:
     q = text("select last_success_at from etl_job_status where job_name = :job")
@@ -36,87 +78,281 @@ def mark_success(engine: Engine, job_name: str, ts: Optional[datetime] = None) -
         conn.execute(q, {"job": job_name, "ts": ts or datetime.now()})
 
 
-def create_temp_table_key(conn: Connection, table_name: str, mstart: date, mnext: date) -> None:
-    insp = inspect(conn)
-    cols = {c["name"] for c in insp.get_columns(table_name)}
-    has_doc = "goods_doc_id" in cols
-
-    doc_expr = "goods_doc_id" if has_doc else "NULL::uuid"
-
-    sql = f"""
-        CREATE TEMP TABLE tmp_de_key_amount ON COMMIT DROP AS
-        SELECT
-            registrar_id,
-            cost_category_id,
-            {doc_expr} AS goods_doc_id,
-            date,
-            SUM(amount)::numeric AS total_amount
-        FROM {table_name}
-        WHERE date >= :mstart AND date < :mnext
-        GROUP BY
-            registrar_id,
-            cost_category_id,
-            {doc_expr},    
-            date
-    """
-    conn.execute(text(sql), {"mstart": mstart, "mnext": mnext})
+def _alloc_params(table_name: str, mstart: date, mnext: date, registrars: Optional[list] = None) -> dict:
+    return {
+        "mstart": mstart, "mnext": mnext, "type_expense": TYPE_EXPENSE[table_name],
+        "precision": PRECISION, "inc": str(INC),
+        "registrars": None if registrars is None else [str(r) for r in registrars],
+    }
+
 
+def _lock_month(conn: Connection, table_name: str, mstart: date) -> None:
+    """Один (месяц, тип) не пересчитывается двумя соединениями сразу: advisory-блокировка до конца транзакции."""
+    conn.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:job), :month)"),
+        {"job": f"recalc:{table_name}", "month": mstart.year * 100 + mstart.month},
+    )
 
-def delete_temp_tables(engine: Engine) -> None:
-    q = text("DROP TABLE IF EXISTS tmp_table")
+
+def build_goods_weight(engine: Engine, mstart: date, mnext: date) -> int:
+    """
+    Пересобирает веса товаров месяца в stg_goods_weight (GOODS_WEIGHT_*_SQL) — общую часть
+    долей всех типов расходов, которую читают ALLOC_SQL_BY_TYPE. Строки месяца заменяются
+    в одной транзакции, поэтому параллельный пересчёт того же месяца видит старые или новые
+    веса целиком. Возвращает число строк весов.
+    """
+    params = {"mstart": mstart, "mnext": mnext}
     with engine.begin() as conn:
-        conn.execute(q, {})
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:job), :month)"),
+            {"job": "recalc:stg_goods_weight", "month": mstart.year * 100 + mstart.month},
+        )
+        conn.execute(text(DELETE_GOODS_WEIGHT_SQL), params)
+        rows = conn.execute(text(GOODS_WEIGHT_TRANSFERS_SQL), params).rowcount
+        rows += conn.execute(text(GOODS_WEIGHT_CHINA_SQL), params).rowcount
+        rows += conn.execute(text(GOODS_WEIGHT_LOCATIONS_SQL), params).rowcount
+    return rows
 
 
-def replace_allocations_for_month(engine: Engine, table_name: str, create_sql_month: str, mstart: date, mnext: date,):
+def replace_allocations_for_month(
+        engine: Engine, table_name: str, shares_sql: str, mstart: date, mnext: date,
+        registrars: Optional[list] = None,
+) -> int:
     """
     Запускает один цикл для ОДНОГО месяца:
-        создаёт TEMP таблицу с уникальным ключом затраты и ее суммой
-        создаёт TEMP tmp_table c расчётом только за [mstart, mnext)
-        прибавляет погрешность при разделении самому дорогому товару
+        берёт advisory-блокировку (тип, месяц) до конца транзакции
         удаляет старые данные этого типа за месяц
-        вставка агрегата
+        одним запросом считает доли shares_sql за [mstart, mnext), раскладывает
+        погрешность округления и вставляет агрегат (ALLOC_EXPENSES_SQL)
         фиксация успех прогона
+    registrars — пересчитать только строки этих регистраторов расходов (None — весь месяц).
+    shares_sql из ALLOC_SQL_BY_TYPE читает веса месяца: их строит build_goods_weight.
+    Возвращает число записанных строк.
     """
+    params = _alloc_params(table_name, mstart, mnext, registrars)
     with engine.begin() as conn:
-        create_temp_table_key(conn, table_name, mstart, mnext)
-        conn.execute(text(create_sql_month), {"mstart": mstart, "mnext": mnext, "precision": PRECISION})
+        _lock_month(conn, table_name, mstart)
+        conn.execute(text(DELETE_ALLOC_EXPENSES_SQL), params)
+        rows = conn.execute(text(ALLOC_EXPENSES_SQL.format(shares=shares_sql, target=ALLOC_TABLE)), params).rowcount
 
-        # создать вьюшки
-        conn.execute(text(CREATE_VIEWS_SQL))
+    mark_success(engine, table_name)
+    return rows
 
-        # «только плюс» корректировка с твоим шагом инкремента
-        conn.execute(text(UPDATE_WITH_VIEWS_SQL), {"inc": str(INC)})
 
-        # убрать вьюшки
-        conn.execute(text(DROP_VIEWS_SQL))
+def publish_month_by_swap(
+        engine: Engine, table_names: tuple[str, ...], mstart: date, mnext: date,
+) -> Optional[dict[str, int]]:
+    """
+    Пересчитывает типы table_names за месяц в новую таблицу и подменяет ею партицию месяца
+    dm_goods_expense_alloc (swap_month_partition): строки остальных типов копируются из
+    текущей партиции, индексы строятся до подмены. Читатели видят месяц целиком до или
+    после пересчёта, без мёртвых строк и ожидания блокировок строк; старая партиция
+    удаляется после COMMIT (drop_retired_partitions). Веса месяца строит build_goods_weight.
+    Блокирует все типы месяца: строки остальных типов не должны меняться до подмены.
+    Возвращает число записанных строк по типам; None — публиковать нужно через DELETE:
+    у месяца нет своей партиции (строки в DEFAULT) или подмена не дождалась блокировки
+    родителя (swap_month_partition) — тогда транзакция с новой таблицей откатывается.
+    """
+    live = month_partition_name(ALLOC_TABLE, mstart.year, mstart.month)
+    staging = f"{live}_swap"
+    try:
+        rows = _build_and_swap(engine, table_names, mstart, mnext, live, staging)
+    except _SwapLockTimeout:
+        log.warning("Партиция %s не подменена: пересчёт через DELETE", live)
+        return None
+    if rows is None:
+        return None
 
-        # перезалить агрегат
-        conn.execute(text(DELETE_ALLOC_EXPENSES_SQL), {"mstart": mstart, "mnext": mnext})
-        conn.execute(text(INSERT_ALLOC_EXPENSES_SQL))
+    for table_name in table_names:
+        mark_success(engine, table_name)
+    drop_retired_partitions(ALLOC_TABLE)
+    return rows
 
-    mark_success(engine, table_name)
+
+class _SwapLockTimeout(Exception):
+    """Подмена партиции не дождалась блокировки: откатить транзакцию с новой таблицей."""
+
+
+def _build_and_swap(
+        engine: Engine, table_names: tuple[str, ...], mstart: date, mnext: date, live: str, staging: str,
+) -> Optional[dict[str, int]]:
+    """Транзакция publish_month_by_swap: новая таблица месяца и подмена ею партиции live."""
+    with engine.begin() as conn:
+        for table_name in ALLOC_SQL_BY_TYPE:
+            _lock_month(conn, table_name, mstart)
+        if conn.execute(text("SELECT to_regclass(:p)"), {"p": f'{PARTITIONS_SCHEMA}."{live}"'}).scalar() is None:
+            return None
+        # LIKE партиции, а не родителя: до подмены родитель не блокируется
+        conn.execute(text(
+            f'CREATE TABLE {PARTITIONS_SCHEMA}."{staging}" (LIKE {PARTITIONS_SCHEMA}."{live}" INCLUDING DEFAULTS)'
+        ))
+        keep = [TYPE_EXPENSE[t] for t in ALLOC_SQL_BY_TYPE if t not in table_names]
+        if keep:
+            conn.execute(
+                text(f'INSERT INTO {PARTITIONS_SCHEMA}."{staging}" '
+                     f'SELECT * FROM {PARTITIONS_SCHEMA}."{live}" WHERE type_expense = ANY(:keep)'),
+                {"keep": keep},
+            )
+        rows = {}
+        for table_name in table_names:
+            rows[table_name] = conn.execute(
+                text(ALLOC_EXPENSES_SQL.format(
+                    shares=ALLOC_SQL_BY_TYPE[table_name], target=f'{PARTITIONS_SCHEMA}."{staging}"',
+                )),
+                _alloc_params(table_name, mstart, mnext),
+            ).rowcount
+        create_parent_indexes(conn, "public", ALLOC_TABLE, PARTITIONS_SCHEMA, staging)
+        conn.execute(text(f'ANALYZE {PARTITIONS_SCHEMA}."{staging}"'))
+        if swap_month_partition(conn, "public", ALLOC_TABLE, staging, mstart.year, mstart.month) is None:
+            raise _SwapLockTimeout
+    return rows
+
+
+def recalc_units(
+        engine: Engine,
+        units: list[tuple[date, str]],
+        on_done: Optional[Callable[[date, str, float, int], None]] = None,
+        workers: Optional[int] = None,
+        registrars: Optional[dict[tuple[date, str], list]] = None,
+        publish: Optional[str] = None,
+        cancelled: Optional[Callable[[], bool]] = None,
+) -> list[dict]:
+    """
+    Пересчитать пары (месяц, тип расхода) пулом из workers соединений (по умолчанию
+    RECALC_WORKERS). Для месяцев, где есть пары целиком, сначала строятся веса товаров
+    (build_goods_weight) — один раз на месяц для всех типов. Пары пишут непересекающиеся строки dm_goods_expense_alloc
+    (месяц и type_expense), поэтому идут параллельно; одну пару два прогона
+    одновременно не считают (advisory-блокировка в replace_allocations_for_month).
+    on_done(месяц, тип, сек, строк) вызывается после успешного пересчёта пары.
+    registrars — для пар, которые нужно пересчитать не целиком, список регистраторов расходов
+    (такие пары считаются по исходным таблицам, REGISTRAR_ALLOC_SQL_BY_TYPE).
+    publish — способ публикации (по умолчанию RECALC_PUBLISH): "delete" — DELETE + INSERT
+    по паре; "swap" — целые пары одного месяца считаются одним заданием и публикуются
+    подменой партиции (publish_month_by_swap), пары с отбором регистраторов — как при delete.
+    cancelled() проверяется перед каждым заданием: если вернула True, оставшиеся задания
+    не выполняются, их месяцы получают статус "cancelled" (начатые доводятся до конца).
+    Возвращает отчёты по месяцам в порядке units: статус, время и число записанных строк
+    по типам (при swap — время задания месяца); если хоть одна пара не пересчитана —
+    RuntimeError после завершения остальных.
+    """
+    workers = max(1, settings.RECALC_WORKERS if workers is None else workers)
+    publish = settings.RECALC_PUBLISH if publish is None else publish
+    registrars = registrars or {}
+
+    # задания пула: (месяц, типы, подменой партиции)
+    jobs: list[tuple[date, tuple[str, ...], bool]] = []
+    swap_months: dict[date, list[str]] = {}
+    for mstart, table_name in units:
+        if publish == PUBLISH_SWAP and (mstart, table_name) not in registrars:
+            swap_months.setdefault(mstart, []).append(table_name)
+        else:
+            jobs.append((mstart, (table_name,), False))
+    jobs += [(mstart, tuple(table_names), True) for mstart, table_names in swap_months.items()]
+
+    def publish_job(mstart: date, table_names: tuple[str, ...], swap: bool) -> dict[str, int]:
+        mnext = next_month(mstart)
+        if mstart in weights:
+            weights[mstart].result()  # веса месяца: ошибка их построения — ошибка всех его пар
+        if swap:
+            rows = publish_month_by_swap(engine, table_names, mstart, mnext)
+            if rows is not None:
+                return rows
+            log.info("%s за %s не подменён партицией: пересчёт через DELETE", ALLOC_TABLE, mstart.strftime("%Y-%m"))
+        rows = {}
+        for table_name in table_names:
+            unit_registrars = registrars.get((mstart, table_name))
+            shares_sql = (ALLOC_SQL_BY_TYPE if unit_registrars is None else REGISTRAR_ALLOC_SQL_BY_TYPE)[table_name]
+            rows[table_name] = replace_allocations_for_month(
+                engine, table_name, shares_sql, mstart, mnext, unit_registrars,
+            )
+        return rows
+
+    def run(job: tuple[date, tuple[str, ...], bool]) -> Optional[tuple[float, dict[str, int]]]:
+        if cancelled is not None and cancelled():
+            return None
+        rows, sec = timed(publish_job, *job)
+        if on_done is not None:
+            for table_name in job[1]:
+                on_done(job[0], table_name, sec, rows[table_name])
+        return sec, rows
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs) or 1), thread_name_prefix="recalc") as pool:
+        # веса ставятся в пул первыми: задание, ждущее веса своего месяца, не занимает их очередь
+        weights = {
+            mstart: pool.submit(build_goods_weight, engine, mstart, next_month(mstart))
+            for mstart in dict.fromkeys(mstart for mstart, table_name in units if (mstart, table_name) not in registrars)
+        }
+        futures = [(job, pool.submit(run, job)) for job in jobs]
+
+    months: dict[date, dict] = {
+        mstart: {"month": mstart.strftime("%Y-%m"), "status": "ok", "timings": {}, "rows": {}} for mstart, _ in units
+    }
+    failed = []
+    for (mstart, table_names, _), future in futures:
+        report = months[mstart]
+        try:
+            done = future.result()
+        except Exception as e:
+            log.exception("Ошибка пересчёта %s за %s", ", ".join(table_names), report["month"])
+            report["status"] = "error"
+            failed.append(f"{report['month']} {', '.join(table_names)}: {e}")
+            continue
+        if done is None:
+            if report["status"] == "ok":
+                report["status"] = "cancelled"
+            continue
+        sec, rows = done
+        for table_name in table_names:
+            report["timings"][table_name] = round(sec, 3)
+            report["rows"][table_name] = rows[table_name]
+    if failed:
+        raise RuntimeError("; ".join(failed))
+    return list(months.values())
 
 
 def recalc_period_by_months( engine: Engine,  period_start: date, period_end: date,) -> list[dict]:
     """
-    Пересчитать весь период (включая конечный месяц), «месяц за месяцем».
+    Пересчитать весь период (включая конечный месяц): все типы расходов за каждый месяц,
+    пары (месяц, тип) — параллельно (см. recalc_units).
     Возвращает короткие отчёты по каждому месяцу.
     """
-    results: list[dict] = []
+    units = [
+        (mstart, table_name)
+        for mstart, _ in iter_months(period_start, period_end)
+        for table_name in ALLOC_SQL_BY_TYPE
+    ]
+    return recalc_units(engine, units)
 
-    for mstart, mnext in iter_months(period_start, period_end):
 
-        replace_allocations_for_month(engine, "reg_direct_expenses",    ALLOC_DIRECT_EXPENSES_SQL,    mstart, mnext)
-        replace_allocations_for_month(engine, "reg_warehouse_expenses", ALLOC_WAREHOUSE_EXPENSES_SQL, mstart, mnext)
-        replace_allocations_for_month(engine, "reg_general_expenses",   ALLOC_GENERAL_EXPENSES_SQL,   mstart, mnext)
 
-        results.append(
-            {
-                "month": mstart.strftime("%Y-%m"),
-                "status": "ok",
-            }
-        )
+def recalc_dirty(engine: Engine) -> list[dict]:
+    """
+    Пересчитать только отмеченные в recalc_dirty пары (месяц, тип расхода) — целиком или
+    только отмеченных регистраторов расходов — и снять отметки. Отметки, сделанные загрузкой
+    во время пересчёта, остаются до следующего прогона.
+    Возвращает короткие отчёты по каждому месяцу.
+    """
+    marks, registrars = {}, {}
+    with engine.begin() as conn:
+        for month, expense_type, up_to_id, unit_registrars in read_dirty(conn):
+            marks[(month, expense_type)] = up_to_id
+            if unit_registrars is not None:
+                registrars[(month, expense_type)] = unit_registrars
 
-    return results
+    def clear(mstart: date, table_name: str, sec: float, rows: int) -> None:
+        with engine.begin() as conn:
+            clear_dirty(conn, mstart, table_name, marks[(mstart, table_name)])
 
+    units = [unit for unit in marks if unit[1] in ALLOC_SQL_BY_TYPE]
+    results = recalc_units(engine, units, on_done=clear, registrars=registrars)
+    by_month = {report["month"]: report for report in results}
+    for report in results:
+        report["types"] = list(report["timings"])
+        report["registrars"] = {}
+    for mstart, table_name in units:
+        # тип -> сколько регистраторов пересчитано (None — месяц целиком)
+        unit_registrars = registrars.get((mstart, table_name))
+        by_month[mstart.strftime("%Y-%m")]["registrars"][table_name] = (
+            None if unit_registrars is None else len(unit_registrars)
+        )
+    return results
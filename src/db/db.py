@@ -1,96 +1,727 @@
+import io
+import re
+import time
 import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date
+from itertools import chain, islice
 
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy import Table, MetaData, insert, select, and_, exists, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import (
+    ARRAY, Column, Table, MetaData, insert, select, and_, any_, bindparam, cast, exists, func, inspect, text,
+)
 from sqlmodel import create_engine
 
 from src.config import settings
+from src.db.coercers import get_coercer
+from src.db.dirty_months import DIRTY_SOURCES, delete_marking_dirty, mark_changed_rows, mark_rows
 from src.db.models import DeletedObject
 from src.db.registry import REGISTRY, CASCADE_DELETED_MAP
 from sqlalchemy import delete as sa_delete
+from sqlalchemy.exc import OperationalError
 import logging
 
 engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True, echo=False)  # echo=True
 log = logging.getLogger("app")
 
-def replace_scope(dataModel, rows):
+INSERT_BATCH_SIZE = 5000  # сколько строк валидируется и пишется в TEMP за один раз
+REPLACE_CHUNK_ROWS = 200_000  # строк на одну часть DELETE/INSERT в replace_scope (0 — весь шаблон разом)
+SKIP_UNCHANGED = True  # не переписывать скоупы, содержимое которых совпадает с приёмником
+UPSERT_PK_SCOPED = True  # модели со скоупом = PK пишутся через INSERT ... ON CONFLICT DO UPDATE
+PARTITION_ROUTING = True  # RANGE(date)-приёмники: DELETE только из затронутых партиций, INSERT сразу в месячные
+PARTITION_AUTO_CREATE_YEARS = 5  # недостающая месячная партиция создаётся, если месяц не дальше N лет от текущего
+PARTITION_CREATE_LOCK_TIMEOUT = "1s"  # сколько создание партиции ждёт блокировки (иначе строки идут через родителя)
+PARTITION_CREATE_ATTEMPTS = 3  # попыток создания, пока DEFAULT держит загрузка другого воркера
+PARTITION_RETRY_AFTER = 600  # сек: месяц, партицию которого не удалось создать, до этого не пробуется снова
+CASCADE_DELETE_BATCH_SIZE = 5000  # объектов deleted_object на одну транзакцию delete_with_cascade
+
+# способ заливки TEMP: "copy" — COPY FROM STDIN, "insert" — executemany через Core.
+# "copy" требует psycopg2, иначе автоматически используется "insert"
+TEMP_LOADER = "copy"
+
+# (таблица, год, месяц) -> time.monotonic() неудачного создания партиции, общий для всех сессий
+_partition_failures: dict[tuple[str, int, int], float] = {}
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def iter_batches(rows, size: int):
+    """Режет итерируемое на списки длиной не больше size."""
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def _copy_value(value) -> str:
+    """Значение в текстовом формате COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_rows(conn, table_qname: str, columns: list[str], rows: list[dict]) -> bool:
     """
-       Полная замена строк по переданным PK:
-       1) CREATE TEMP TABLE AS SELECT * FROM (VALUES ... ) v(cols...)
-       2) DELETE target USING temp по PK
-       3) INSERT target(cols) SELECT cols FROM temp
+    Заливает строки в таблицу через COPY FROM STDIN (текстовый формат).
+    Возвращает False, если драйвер не умеет COPY — тогда вызывающий код заливает INSERT-ом.
     """
-    if not rows:
-        return
-    normalized = []
-    for raw in rows:
-        dto = dataModel.model_validate(raw)
-        normalized.append(dto.dict(by_alias=False, exclude_unset=True))
+    cursor = conn.connection.dbapi_connection.cursor()
+    if not hasattr(cursor, "copy_expert"):
+        cursor.close()
+        return False
 
-    target_tbl = dataModel.__table__
+    prep = conn.dialect.identifier_preparer
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(row[c]) for c in columns))
+        buf.write("\n")
+    buf.seek(0)
 
-    with engine.begin() as conn:
+    cols_sql = ", ".join(prep.quote(c) for c in columns)
+    with cursor:
+        cursor.copy_expert(f"COPY {table_qname} ({cols_sql}) FROM STDIN", buf)
+    return True
+
+
+def load_temp(conn, temp_tbl, tmp_qname: str, columns: list[str], batches, loader: str | None = None) -> int:
+    """Заливает пачки нормализованных строк во временную таблицу, возвращает число строк."""
+    use_copy = (loader or TEMP_LOADER) == "copy"
+    total = 0
+    for batch in batches:
+        if not (use_copy and copy_rows(conn, tmp_qname, columns, batch)):
+            use_copy = False
+            conn.execute(insert(temp_tbl), batch)
+        total += len(batch)
+    return total
+
+
+def ingest_strategy(dataModel) -> str:
+    """
+    "upsert", если скоуп модели совпадает с её PK (или не задан), иначе "replace".
+    Можно задать явно атрибутом модели __ingest_strategy__.
+    """
+    explicit = getattr(dataModel, "__ingest_strategy__", None)
+    if explicit:
+        return explicit
+    if not UPSERT_PK_SCOPED:
+        return "replace"
+    pk_columns = {col.name for col in dataModel.__table__.primary_key.columns}
+    scope_columns = set(getattr(dataModel, "__scope_delete_cols__", None) or pk_columns)
+    return "upsert" if pk_columns and scope_columns == pk_columns else "replace"
+
+
+@dataclass
+class ScopeStats:
+    """Строки шаблона: в новых скоупах, в изменённых и пропущенных без изменений."""
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+
+    @property
+    def rows(self) -> int:
+        return self.inserted + self.updated + self.skipped
+
+    def __iadd__(self, other: "ScopeStats") -> "ScopeStats":
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.skipped += other.skipped
+        return self
+
+
+_RANGE_KEY_RE = re.compile(r"RANGE\s*\(\s*(\w+)\s*\)", re.IGNORECASE)
+
+
+def partition_key(target_tbl) -> str | None:
+    """Колонка RANGE-партиционирования таблицы из модели (postgresql_partition_by) или None."""
+    partition_by = target_tbl.dialect_options["postgresql"].get("partition_by")
+    m = _RANGE_KEY_RE.fullmatch(partition_by.strip()) if partition_by else None
+    return m.group(1) if m else None
+
+
+def qualified_name(conn, tbl) -> str:
+    prep = conn.dialect.identifier_preparer
+    return f"{prep.quote_schema(tbl.schema)}.{prep.quote(tbl.name)}" if tbl.schema else prep.quote(tbl.name)
+
+
+class IngestSession:
+    """
+    Загрузка целого пакета 1С в одном соединении и одной транзакции.
+    Промежуточные таблицы создаются один раз на целевую таблицу и переиспользуются
+    между шаблонами через TRUNCATE; их схема берётся из метаданных модели, без рефлексии из БД.
+
+    staging="temp" — TEMP-таблицы (ON COMMIT DROP).
+    staging="unlogged" — обычные UNLOGGED-таблицы с уникальным именем: нужны для
+    двухфазного коммита (PREPARE TRANSACTION запрещён, если транзакция трогала TEMP).
+    Их нужно удалить через drop_staging() до фиксации.
+    """
+
+    def __init__(self, conn, staging: str = "temp"):
+        self.conn = conn
+        self.staging = staging
+        self._temp_tables: dict[str, Table] = {}
+        self._partitions: dict[tuple[str, int, int], str | None] = {}
+        self._token = uuid.uuid4().hex[:8]
+
+    def _staging_table(self, key: str, name: str, columns: list[Column], ddl: str, **fmt) -> Table:
+        """Пустая промежуточная таблица: создаётся при первом обращении, дальше очищается TRUNCATE."""
+        conn = self.conn
+        temp_tbl = self._temp_tables.get(key)
+        if temp_tbl is not None:
+            conn.exec_driver_sql(f"TRUNCATE {qualified_name(conn, temp_tbl)}")
+            return temp_tbl
+
+        if self.staging == "unlogged":
+            name = f"stg_{name}_{self._token}"
+            create = "CREATE UNLOGGED TABLE {tmp}"
+        else:
+            name = f"tmp_{name}"
+            create = "CREATE TEMP TABLE {tmp}"
+        temp_tbl = Table(name, MetaData(), *columns)
+        tmp = qualified_name(conn, temp_tbl)
+        conn.exec_driver_sql(ddl.format(create=create.format(tmp=tmp), tmp=tmp, **fmt))
+        self._temp_tables[key] = temp_tbl
+        return temp_tbl
+
+    def temp_table(self, target_tbl) -> Table:
+        """Пустая промежуточная таблица по структуре приёмника."""
+        return self._staging_table(
+            target_tbl.fullname,
+            target_tbl.name,
+            [Column(col.name, col.type) for col in target_tbl.columns],
+            "{create} (LIKE {target} INCLUDING DEFAULTS)" + self._on_commit,
+            target=qualified_name(self.conn, target_tbl),
+        )
+
+    def scope_table(self, target_tbl, scope_columns: list[str]) -> Table:
+        """Пустая таблица уже заменённых ключей скоупа (для замены по частям)."""
+        prep = self.conn.dialect.identifier_preparer
+        cols = ", ".join(prep.quote(c) for c in scope_columns)
+        return self._staging_table(
+            f"{target_tbl.fullname}:scope",
+            f"{target_tbl.name}_scope",
+            [Column(c, target_tbl.c[c].type) for c in scope_columns],
+            "{create}" + self._on_commit + " AS SELECT {cols} FROM {target} WITH NO DATA;"
+            " ALTER TABLE {tmp} ADD PRIMARY KEY ({cols})",
+            target=qualified_name(self.conn, target_tbl), cols=cols,
+        )
+
+    @property
+    def _on_commit(self) -> str:
+        return " ON COMMIT DROP" if self.staging == "temp" else ""
+
+    def drop_staging(self) -> None:
+        """Удаляет промежуточные таблицы (для TEMP это сделает и сам COMMIT)."""
+        for temp_tbl in self._temp_tables.values():
+            self.conn.exec_driver_sql(f"DROP TABLE IF EXISTS {qualified_name(self.conn, temp_tbl)}")
+        self._temp_tables.clear()
+
+    def _diff_scopes(self, target_tbl, temp_tbl, scope_tbl, scope_columns, compare_cols, skip: bool) -> ScopeStats:
+        """
+        Сравнивает скоупы из TEMP с приёмником по md5 содержимого (колонки compare_cols).
+        skip — строки неизменённых скоупов удаляются из TEMP (и запоминаются в scope_tbl,
+        если он передан), поэтому ниже они не удаляются и не вставляются заново.
+        Скоупы, уже заменённые предыдущими частями (scope_tbl), не сравниваются.
+        Колонки, не переданные в шаблоне, не сравниваются.
+        """
+        conn = self.conn
+        prep = conn.dialect.identifier_preparer
+        q = prep.quote
+        scope = ", ".join(q(c) for c in scope_columns)
+        on_temp = " AND ".join(f"tm.{q(c)} = t.{q(c)}" for c in scope_columns)
+        on_target = " AND ".join(f"x.{q(c)} = t.{q(c)}" for c in scope_columns)
+        on_done = " AND ".join(f"s.{q(c)} = t.{q(c)}" for c in scope_columns)
+
+        def row_hash(alias: str) -> str:
+            row = f"({', '.join(f'{alias}.{q(c)}' for c in compare_cols)})::text"
+            return f"md5(string_agg({row}, '|' ORDER BY {row}))"
+
+        done = "false"
+        if scope_tbl is not None:
+            done = f"EXISTS (SELECT 1 FROM {qualified_name(conn, scope_tbl)} s WHERE {on_done})"
+
+        skipped_sql = "SELECT 1 WHERE false"
+        remember = ""
+        if skip:
+            returning = ", ".join(f"tm.{q(c)}" for c in scope_columns)
+            skipped_sql = f"""
+                DELETE FROM {qualified_name(conn, temp_tbl)} tm
+                USING diff t
+                WHERE t.same AND {on_temp}
+                RETURNING {returning}
+            """
+            if scope_tbl is not None:
+                remember = f"""
+                , remembered AS (
+                    INSERT INTO {qualified_name(conn, scope_tbl)} ({scope})
+                    SELECT DISTINCT {scope} FROM skipped
+                    ON CONFLICT DO NOTHING
+                )
+                """
+
+        # скоуп, начатый предыдущей частью, уже переписан: считается изменённым и не сравнивается
+        sql = f"""
+            WITH t AS (
+                SELECT {scope}, count(*) AS n, {row_hash("tm")} AS h
+                FROM {qualified_name(conn, temp_tbl)} tm
+                GROUP BY {scope}
+            ), diff AS (
+                SELECT t.n, t.done OR d.h IS NOT NULL AS existed, NOT t.done AND coalesce(d.h = t.h, false) AS same, {scope}
+                FROM (SELECT t.*, {done} AS done FROM t) t
+                LEFT JOIN LATERAL (
+                    SELECT {row_hash("x")} AS h
+                    FROM {qualified_name(conn, target_tbl)} x
+                    WHERE NOT t.done AND {on_target}
+                    HAVING count(*) > 0
+                ) d ON true
+            ), skipped AS ({skipped_sql}){remember}
+            SELECT
+                coalesce(sum(n) FILTER (WHERE NOT existed), 0),
+                coalesce(sum(n) FILTER (WHERE existed AND NOT same), 0),
+                coalesce(sum(n) FILTER (WHERE same), 0),
+                (SELECT count(*) FROM skipped)
+            FROM diff
+        """
+        inserted, updated, same, _ = map(int, conn.exec_driver_sql(sql).one())
+        return ScopeStats(inserted=inserted, updated=updated if skip else updated + same, skipped=same if skip else 0)
+
+    def _upsert(self, target_tbl, temp_tbl, key_columns, insert_cols, skip: bool) -> tuple[int, int]:
+        """
+        INSERT ... ON CONFLICT (PK) DO UPDATE из TEMP в приёмник.
+        skip — строки, совпадающие с приёмником, не обновляются (WHERE ... IS DISTINCT FROM).
+        Возвращает (вставлено, обновлено).
+        """
+        conn = self.conn
+        q = conn.dialect.identifier_preparer.quote
+        cols = ", ".join(q(c) for c in insert_cols)
+        update_cols = [c for c in insert_cols if c not in key_columns]
+        if update_cols:
+            on_conflict = "DO UPDATE SET " + ", ".join(f"{q(c)} = EXCLUDED.{q(c)}" for c in update_cols)
+            if skip:
+                on_conflict += (
+                    f" WHERE ({', '.join(f't.{q(c)}' for c in update_cols)})"
+                    f" IS DISTINCT FROM ({', '.join(f'EXCLUDED.{q(c)}' for c in update_cols)})"
+                )
+        else:
+            on_conflict = "DO NOTHING"
+
+        if skip:
+            # совпадающие строки убираем из TEMP заранее: ON CONFLICT блокирует строку
+            # приёмника (и пишет это в WAL), даже если WHERE отсекает обновление
+            same_key = " AND ".join(f"t.{q(c)} = tm.{q(c)}" for c in key_columns)
+            same_row = (
+                f"({', '.join(f't.{q(c)}' for c in update_cols)})"
+                f" IS NOT DISTINCT FROM ({', '.join(f'tm.{q(c)}' for c in update_cols)})"
+            ) if update_cols else "true"
+            conn.exec_driver_sql(f"""
+                DELETE FROM {qualified_name(conn, temp_tbl)} tm
+                USING {qualified_name(conn, target_tbl)} t
+                WHERE {same_key} AND {same_row}
+            """)
+
+        sql = f"""
+            WITH up AS (
+                INSERT INTO {qualified_name(conn, target_tbl)} AS t ({cols})
+                SELECT {cols} FROM {qualified_name(conn, temp_tbl)}
+                ON CONFLICT ({', '.join(q(c) for c in key_columns)}) {on_conflict}
+                RETURNING xmax = 0 AS inserted
+            )
+            SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM up
+        """
+        inserted, updated = conn.exec_driver_sql(sql).one()
+        return inserted, updated
+
+    def _month_partition(self, target_tbl, year: int, month: int) -> str | None:
+        """
+        Месячная партиция приёмника (partitions.{таблица}_{год}_{месяц}); недостающая создаётся.
+        None — строки месяца идут через родителя: партицию нельзя создать (месяц вне
+        PARTITION_AUTO_CREATE_YEARS, его строки уже лежат в DEFAULT, диапазон занят,
+        блокировка не получена за PARTITION_CREATE_LOCK_TIMEOUT и т.п.). Неудача запоминается
+        для всех сессий на PARTITION_RETRY_AFTER: каждая попытка берёт ACCESS EXCLUSIVE
+        на DEFAULT и просматривает её заново.
+
+        Партиция создаётся отдельной короткой транзакцией, а не в транзакции пакета:
+        иначе блокировки DDL держались бы до конца загрузки всего пакета. Но если пакет
+        уже читал родителя (следующая часть шаблона, второй шаблон той же таблицы), его
+        транзакция держит DEFAULT и отдельная транзакция ждала бы саму загрузку —
+        тогда партиция прикрепляется в транзакции пакета, под точкой сохранения. ACCESS
+        EXCLUSIVE на DEFAULT держится до конца пакета, и запросы к родителю без отсечения
+        DEFAULT его ждут — но строки месяца не уходят в DEFAULT, после чего партицию
+        месяца уже не прикрепить.
+        """
+        cache_key = (target_tbl.fullname, year, month)
+        if cache_key in self._partitions:
+            return self._partitions[cache_key]
+
+        # partition_manager импортирует этот модуль
+        from src.db.utils.partition_manager import PARTITIONS_SCHEMA, ensure_month_partition_with_indexes
+
+        conn = self.conn
         prep = conn.dialect.identifier_preparer
-        def qtbl(tbl) -> str:
-            return f"{prep.quote_schema(tbl.schema)}.{prep.quote(tbl.name)}" if tbl.schema else prep.quote(tbl.name)
+        part_name = f"{PARTITIONS_SCHEMA}.{prep.quote(f'{target_tbl.name}_{year}_{month:02d}')}"
+        part = part_name if conn.execute(text("SELECT to_regclass(:p)"), {"p": part_name}).scalar() else None
+        failed_at = _partition_failures.get(cache_key)
+        retry = failed_at is None or time.monotonic() - failed_at >= PARTITION_RETRY_AFTER
+        if part is None and retry and abs(year - date.today().year) <= PARTITION_AUTO_CREATE_YEARS:
+            create = dict(
+                parent_schema=target_tbl.schema or "public", parent=target_tbl.name,
+                year=year, month=month, child_schema=PARTITIONS_SCHEMA,
+            )
+            try:
+                if self._holds_default_partition(target_tbl):
+                    with conn.begin_nested():
+                        restore = conn.execute(text("SELECT current_setting('lock_timeout')")).scalar()
+                        conn.execute(text("SELECT set_config('lock_timeout', :t, true)"), {"t": PARTITION_CREATE_LOCK_TIMEOUT})
+                        ensure_month_partition_with_indexes(conn, **create)
+                        conn.execute(text("SELECT set_config('lock_timeout', :t, true)"), {"t": restore})
+                else:
+                    self._create_partition_retrying(create)
+                part = part_name
+                _partition_failures.pop(cache_key, None)
+            except Exception as e:
+                _partition_failures[cache_key] = time.monotonic()
+                log.warning("Партиция %s не создана, строки месяца пишутся через родителя: %s", part_name, e)
+        self._partitions[cache_key] = part
+        return part
+
+    @staticmethod
+    def _create_partition_retrying(create: dict) -> None:
+        """Партиция отдельной транзакцией; при lock_timeout — повтор после паузы (DEFAULT читает другой пакет)."""
+        from src.db.utils.partition_manager import LOCK_NOT_AVAILABLE, ensure_month_partition_with_indexes
+
+        for attempt in range(1, PARTITION_CREATE_ATTEMPTS + 1):
+            try:
+                with engine.begin() as ddl_conn:
+                    ddl_conn.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_CREATE_LOCK_TIMEOUT}'"))
+                    ensure_month_partition_with_indexes(ddl_conn, **create)
+                return
+            except OperationalError as e:
+                if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == PARTITION_CREATE_ATTEMPTS:
+                    raise
+                time.sleep(attempt)
+
+    def _holds_default_partition(self, target_tbl) -> bool:
+        """Транзакция сессии уже держит блокировку DEFAULT-партиции приёмника (читала родителя)."""
+        return bool(self.conn.execute(text("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_locks l ON l.relation = c.oid AND l.locktype = 'relation' AND l.pid = pg_backend_pid()
+                WHERE i.inhparent = to_regclass(:parent) AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'
+            )
+        """), {"parent": qualified_name(self.conn, target_tbl)}).scalar())
+
+    def _ensure_month_partitions(self, target_tbl, temp_tbl, key: str) -> None:
+        """Месячные партиции под строки TEMP (_month_partition запоминает результат)."""
+        conn = self.conn
+        months = conn.exec_driver_sql(
+            f"SELECT DISTINCT date_trunc('month', {conn.dialect.identifier_preparer.quote(key)}) "
+            f"FROM {qualified_name(conn, temp_tbl)}"
+        ).scalars().all()
+        for month_start in months:
+            if month_start is not None:
+                self._month_partition(target_tbl, month_start.year, month_start.month)
+
+    def _delete_scopes_partitioned(self, target_tbl, temp_tbl, scope_tbl, scope_column: str) -> None:
+        """
+        DELETE строк скоупов TEMP только из партиций, где они есть: индексный проход
+        по ключам (= ANY) находит партиции и ключи в каждой, затем DELETE идёт
+        в каждую партицию напрямую и только по её ключам.
+        """
+        conn = self.conn
+        q = conn.dialect.identifier_preparer.quote
+        col = q(scope_column)
+        key_type = target_tbl.c[scope_column].type.compile(dialect=conn.dialect)
+        where = f"x.{col} = ANY(ARRAY(SELECT DISTINCT {col} FROM {qualified_name(conn, temp_tbl)}))"
+        if scope_tbl is not None:
+            where += f" AND NOT EXISTS (SELECT 1 FROM {qualified_name(conn, scope_tbl)} s WHERE s.{col} = x.{col})"
+        parts = conn.exec_driver_sql(
+            f"SELECT x.tableoid::regclass::text, array_agg(DISTINCT x.{col}::text) "
+            f"FROM {qualified_name(conn, target_tbl)} x WHERE {where} GROUP BY 1"
+        ).all()
+        for part, keys in parts:
+            conn.execute(text(f"DELETE FROM {part} WHERE {col} = ANY(CAST(:keys AS {key_type}[]))"), {"keys": keys})
 
-        target_name = qtbl(target_tbl)
-        tmp_name = f"tmp_{target_tbl.name}_{uuid.uuid4().hex[:8]}"
-        tmp_qname = prep.quote(tmp_name)
+    def _insert_partitioned(self, target_tbl, temp_tbl, key: str, insert_cols: list[str]) -> None:
+        """INSERT из TEMP сразу в месячные партиции; строки без своей партиции — через родителя."""
+        from src.db.utils.partition_manager import month_bounds
 
-        # TEMP по структуре приёмника
-        conn.exec_driver_sql(f"CREATE TEMP TABLE {tmp_qname} (LIKE {target_name} INCLUDING DEFAULTS);")
+        conn = self.conn
+        q = conn.dialect.identifier_preparer.quote
+        temp = qualified_name(conn, temp_tbl)
+        cols = ", ".join(q(c) for c in insert_cols)
+        months = conn.exec_driver_sql(f"SELECT DISTINCT date_trunc('month', {q(key)}) FROM {temp}").scalars().all()
 
-        # рефлексия TEMP, чтобы использовать Core-инсерты
-        temp_tbl = Table(tmp_name, MetaData(), autoload_with=conn)
+        routed = []
+        for month_start in months:
+            if month_start is None:
+                continue
+            part = self._month_partition(target_tbl, month_start.year, month_start.month)
+            if part is None:
+                continue
+            start, end = month_bounds(month_start.year, month_start.month)
+            conn.execute(
+                text(f"INSERT INTO {part} ({cols}) SELECT {cols} FROM {temp} WHERE {q(key)} >= :start AND {q(key)} < :end"),
+                {"start": start, "end": end},
+            )
+            routed.append(month_start)
 
-        # bulk INSERT в TEMP
-        conn.execute(insert(temp_tbl), normalized)
+        if len(routed) == len(months):
+            return
+        insert_parent = f"INSERT INTO {qualified_name(conn, target_tbl)} ({cols}) SELECT {cols} FROM {temp}"
+        if not routed:
+            conn.exec_driver_sql(insert_parent)
+        else:
+            conn.execute(
+                text(f"{insert_parent} WHERE {q(key)} IS NULL OR NOT date_trunc('month', {q(key)}) = ANY(:routed)"),
+                {"routed": routed},
+            )
 
-        # DELETE из приёмника по scope (из модели или PK)
+    @staticmethod
+    def _replaced_rows(target_tbl, temp_tbl, scope_tbl, scope_column: str):
+        """Подзапрос строк приёмника, которые заменяет TEMP (как в _delete_scopes_partitioned)."""
+        column = target_tbl.c[scope_column]
+        rows = select(target_tbl).where(column.in_(select(temp_tbl.c[scope_column]).distinct()))
+        if scope_tbl is not None:
+            rows = rows.where(~exists(select(1).select_from(scope_tbl).where(scope_tbl.c[scope_column] == column)))
+        return rows.subquery("replaced")
 
-        # список колонок, по которым чистим срез
+    def _remember_scopes(self, scope_tbl, temp_tbl, scope_columns, pending) -> None:
+        if pending is not None:
+            # ключи этой части заменены: следующие части их строки из приёмника не удаляют
+            self.conn.execute(
+                pg_insert(scope_tbl)
+                .from_select(scope_columns, select(*(temp_tbl.c[c] for c in scope_columns)).distinct())
+                .on_conflict_do_nothing()
+            )
+
+    def replace_scope(
+            self,
+            dataModel,
+            rows,
+            loader: str | None = None,
+            chunk_rows: int | None = None,
+            skip_unchanged: bool | None = None,
+            strategy: str | None = None,
+    ) -> "ScopeStats":
+        """
+           Полная замена строк по переданным PK:
+           1) заливка строк пачками в TEMP по структуре приёмника
+           2) сравнение скоупов TEMP с приёмником: неизменённые скоупы пропускаются
+           3) DELETE target USING temp по PK
+           4) INSERT target(cols) SELECT cols FROM temp
+           rows может быть любым итерируемым (в т.ч. генератором потокового разбора):
+           в памяти одновременно держится не больше INSERT_BATCH_SIZE строк.
+           loader — способ заливки TEMP ("copy"/"insert"), по умолчанию TEMP_LOADER.
+
+           chunk_rows — шаги 1-4 выполняются частями по chunk_rows строк (по умолчанию
+           REPLACE_CHUNK_ROWS, 0 — одним куском), TEMP и сами DELETE/INSERT не растут
+           с размером шаблона. Семантика полной замены сохраняется: ключ скоупа удаляется
+           из приёмника только в первой части, где он встретился (уже заменённые ключи
+           копятся в таблице скоупа).
+
+           skip_unchanged — пропускать скоупы, содержимое которых (переданные колонки)
+           совпадает с приёмником, по умолчанию SKIP_UNCHANGED. 1С повторно присылает
+           одни и те же документы: так они не переписываются, не порождают WAL и мёртвые строки.
+
+           strategy — "replace" (шаги выше) или "upsert": INSERT ... ON CONFLICT (PK) DO UPDATE
+           вместо DELETE + INSERT, вдвое меньше записи. По умолчанию выбирается ingest_strategy(dataModel):
+           upsert для моделей, у которых скоуп совпадает с PK (справочники, шапки документов,
+           deleted_object) — там нет строк, которые нужно удалить из-за их отсутствия в пакете.
+           Возвращает ScopeStats: строки новых скоупов (inserted), изменённых (updated)
+           и пропущенных без изменений (skipped); для upsert — по строкам.
+
+           Для таблиц-источников расчёта расходов (dirty_months.DIRTY_SOURCES) месяцы
+           (или регистраторы расходов) удалённых и вставленных строк изменённых скоупов
+           отмечаются в recalc_dirty в той же транзакции.
+        """
+        chunk_rows = REPLACE_CHUNK_ROWS if chunk_rows is None else chunk_rows
+        skip_unchanged = SKIP_UNCHANGED if skip_unchanged is None else skip_unchanged
+        strategy = strategy or ingest_strategy(dataModel)
+
+        # эквивалент dataModel.model_validate(raw).dict(by_alias=False, exclude_unset=True)
+        coerce = get_coercer(dataModel)
+        normalized = (coerce(raw) for raw in rows)
+        batches = iter_batches(normalized, INSERT_BATCH_SIZE)
+        first_batch = next(batches, None)
+        if not first_batch:
+            return ScopeStats()
+
+        conn = self.conn
+        target_tbl = dataModel.__table__
+        insert_cols = list(first_batch[0].keys())
+
+        # список колонок, по которым чистим срез (из модели или PK)
         scope_columns = getattr(dataModel, "__scope_delete_cols__", None) or [
             col.name for col in target_tbl.primary_key.columns
         ]
 
-        # равенство по всем колонкам скоупа между целевой и временной таблицами
-        scope_conditions = and_(*(target_tbl.c[column_name] == temp_tbl.c[column_name] for column_name in scope_columns)
-        )
+        # RANGE-партиционированный приёмник со скоупом из одной колонки: маршрутизация по партициям
+        part_key = partition_key(target_tbl) if PARTITION_ROUTING else None
+        partitioned = part_key in insert_cols and len(scope_columns) == 1
+        # таблица — источник расчёта расходов: затронутые месяцы отмечаются в recalc_dirty
+        dirty_types = DIRTY_SOURCES.get(target_tbl.name)
+
+        per_chunk = max(1, chunk_rows // INSERT_BATCH_SIZE) if chunk_rows else 0
+        stats = ScopeStats()
+        scope_tbl = None
+        pending = first_batch
+        while pending is not None:
+            chunk = chain([pending], islice(batches, per_chunk - 1) if per_chunk else batches)
+            temp_tbl = self.temp_table(target_tbl)
+
+            # bulk-заливка TEMP пачками
+            loaded = load_temp(conn, temp_tbl, qualified_name(conn, temp_tbl), insert_cols, chunk, loader)
 
-        # DELETE из целевой всех строк, для которых во временной есть запись с тем же скоупом
-        delete_stmt = target_tbl.delete().where(exists(select(1).select_from(temp_tbl).where(scope_conditions)))
-        conn.execute(delete_stmt)
+            pending = next(batches, None)
+            if strategy == "upsert":
+                # строки независимы по PK: части не влияют друг на друга
+                if dirty_types:
+                    mark_changed_rows(conn, target_tbl, temp_tbl, scope_columns, insert_cols)
+                inserted, updated = self._upsert(target_tbl, temp_tbl, scope_columns, insert_cols, skip_unchanged)
+                stats += ScopeStats(inserted=inserted, updated=updated, skipped=loaded - inserted - updated)
+                continue
 
-        # INSERT из TEMP в приёмник (только нужные колонки)
-        insert_cols = list(normalized[0].keys())
-        sel = select(*(temp_tbl.c[c] for c in insert_cols))
-        conn.execute(insert(target_tbl).from_select(insert_cols, sel))
+            if pending is not None and scope_tbl is None:
+                # шаблон не уместился в одну часть
+                scope_tbl = self.scope_table(target_tbl, scope_columns)
 
-        conn.exec_driver_sql(f"DROP TABLE IF EXISTS {tmp_qname};")
+            if partitioned:
+                # партиции создаются до первого чтения приёмника в этой транзакции:
+                # прикрепление ждёт DEFAULT-партицию, которую чтение через родителя блокирует
+                self._ensure_month_partitions(target_tbl, temp_tbl, part_key)
+            stats += self._diff_scopes(target_tbl, temp_tbl, scope_tbl, scope_columns, insert_cols, skip_unchanged)
 
+            if partitioned:
+                if dirty_types:
+                    mark_rows(conn, target_tbl.name, self._replaced_rows(target_tbl, temp_tbl, scope_tbl, scope_columns[0]))
+                self._delete_scopes_partitioned(target_tbl, temp_tbl, scope_tbl, scope_columns[0])
+                self._insert_partitioned(target_tbl, temp_tbl, part_key, insert_cols)
+                if dirty_types:
+                    mark_rows(conn, target_tbl.name, temp_tbl)
+                self._remember_scopes(scope_tbl, temp_tbl, scope_columns, pending)
+                continue
 
-def delete_with_cascade():
+            # равенство по всем колонкам скоупа между целевой и временной таблицами
+            scope_conditions = and_(
+                *(target_tbl.c[column_name] == temp_tbl.c[column_name] for column_name in scope_columns)
+            )
+            # DELETE из целевой всех строк, для которых во временной есть запись с тем же скоупом
+            # (кроме ключей, уже заменённых предыдущими частями)
+            delete_where = exists(select(1).select_from(temp_tbl).where(scope_conditions))
+            if scope_tbl is not None:
+                delete_where = and_(delete_where, ~exists(select(1).select_from(scope_tbl).where(
+                    and_(*(target_tbl.c[c] == scope_tbl.c[c] for c in scope_columns))
+                )))
+            if dirty_types:
+                delete_marking_dirty(conn, target_tbl.delete().where(delete_where), target_tbl)
+                mark_rows(conn, target_tbl.name, temp_tbl)
+            else:
+                conn.execute(target_tbl.delete().where(delete_where))
+
+            # INSERT из TEMP в приёмник (только нужные колонки)
+            sel = select(*(temp_tbl.c[c] for c in insert_cols))
+            conn.execute(insert(target_tbl).from_select(insert_cols, sel))
+
+            self._remember_scopes(scope_tbl, temp_tbl, scope_columns, pending)
+
+        log.debug("%s: %s", target_tbl.name, stats)
+        return stats
+
+
+@contextmanager
+def ingest_session():
+    """Сессия загрузки пакета: всё, что в ней записано, фиксируется одним COMMIT."""
     with engine.begin() as conn:
-        log.debug("Старт удаления")
-        stmt = select(DeletedObject.object_id, DeletedObject.name_metadata)
-        rows = conn.execute(stmt).all()
-        for object_id, name_metadata in rows:
-            log.info("Удаляем %s %s", str(object_id), str(name_metadata))
-            dataModel = REGISTRY.get(name_metadata)
-            # удаляем  связные объекты
-            for rule in CASCADE_DELETED_MAP.get(name_metadata, []):
-                log.debug("rule.model %s %s",str(rule.model),str(rule.column_name))
-                child_table = rule.model
-                column = getattr(child_table, rule.column_name)
-                conn.execute(sa_delete(child_table).where(column == object_id))
-
-            # удаляем  объект (по PK или по полю удаления т.к. поле должно быть одно)
-            pk_column = (getattr(dataModel, "__scope_delete_cols__", None)
-                             or next(iter(inspect(dataModel).primary_key)))
-
-            conn.execute(sa_delete(dataModel).where(pk_column == object_id))
-
-            # удаляем из таблицы удаленных объектов
-            pk_column = DeletedObject.object_id
-            conn.execute(sa_delete(DeletedObject).where(pk_column == object_id))
\ No newline at end of file
+        yield IngestSession(conn)
+
+
+def replace_scope(dataModel, rows, loader: str | None = None, chunk_rows: int | None = None,
+                  skip_unchanged: bool | None = None, strategy: str | None = None) -> ScopeStats:
+    """replace_scope одного шаблона в отдельной транзакции (см. IngestSession.replace_scope)."""
+    with ingest_session() as session:
+        return session.replace_scope(dataModel, rows, loader, chunk_rows, skip_unchanged, strategy)
+
+
+def _ids_param(column, ids: list):
+    """= ANY(:ids) с массивом нужного типа: один параметр на всю пачку вместо IN (...)."""
+    return any_(cast(bindparam("ids", ids), ARRAY(column.type)))
+
+
+def _object_column(dataModel):
+    # объект удаляется по полю удаления (оно одно) или по первой колонке PK
+    scope_columns = getattr(dataModel, "__scope_delete_cols__", None)
+    if scope_columns:
+        return dataModel.__table__.c[scope_columns[0]]
+    return next(iter(inspect(dataModel).primary_key))
+
+
+def delete_with_cascade(batch_size: int | None = None) -> dict[str, int]:
+    """
+    Удаляет объекты из deleted_object вместе со связанными строками (CASCADE_DELETED_MAP).
+
+    Удаления группируются по НаименованиеМетаданных: на пачку — один DELETE ... = ANY(:ids)
+    на каждое правило, на модель и на сами записи deleted_object. Каждая пачка
+    (CASCADE_DELETE_BATCH_SIZE объектов) — отдельная транзакция; записи пачки берутся
+    FOR UPDATE SKIP LOCKED, поэтому параллельные вызовы не удаляют одно и то же.
+    Объекты с метаданными, которых нет в REGISTRY, остаются в deleted_object.
+    Месяцы удалённых строк таблиц-источников расчёта отмечаются в recalc_dirty.
+    Возвращает число удалённых строк по таблицам.
+    """
+    batch_size = batch_size or CASCADE_DELETE_BATCH_SIZE
+    known = list(REGISTRY)
+    pending = (
+        select(DeletedObject.object_id, DeletedObject.name_metadata)
+        .where(DeletedObject.name_metadata.in_(known))
+        .order_by(DeletedObject.name_metadata, DeletedObject.object_id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    counts: dict[str, int] = {}
+
+    def count(table, rowcount: int) -> None:
+        counts[table.name] = counts.get(table.name, 0) + rowcount
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(pending).all()
+            if not rows:
+                break
+            groups: dict[str, list] = {}
+            for object_id, name_metadata in rows:
+                groups.setdefault(name_metadata, []).append(object_id)
+
+            for name_metadata, ids in groups.items():
+                log.info("Удаляем %s: %i объектов", name_metadata, len(ids))
+                # удаляем  связные объекты
+                for rule in CASCADE_DELETED_MAP.get(name_metadata, []):
+                    child_table = rule.model.__table__
+                    column = child_table.c[rule.column_name]
+                    stmt = sa_delete(child_table).where(column == _ids_param(column, ids))
+                    count(child_table, delete_marking_dirty(conn, stmt, child_table))
+
+                # удаляем  объект
+                column = _object_column(REGISTRY[name_metadata])
+                stmt = sa_delete(column.table).where(column == _ids_param(column, ids))
+                count(column.table, delete_marking_dirty(conn, stmt, column.table))
+
+                # удаляем из таблицы удаленных объектов
+                column = DeletedObject.__table__.c.object_id
+                count(DeletedObject.__table__, conn.execute(
+                    sa_delete(DeletedObject)
+                    .where(DeletedObject.name_metadata == name_metadata, column == _ids_param(column, ids))
+                ).rowcount)
+
+        if len(rows) < batch_size:
+            break
+
+    with engine.connect() as conn:
+        skipped = conn.execute(
+            select(func.count()).select_from(DeletedObject).where(DeletedObject.name_metadata.not_in(known))
+        ).scalar()
+    if skipped:
+        log.warning("В deleted_object %i объектов с метаданными без связки в REGISTRY — не удалены", skipped)
+    if counts:
+        log.info("Каскадное удаление: %s", counts)
+    return counts
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""
+Журнал «грязных» месяцев (таблица recalc_dirty).
+
+Загрузка (replace_scope) и каскадное удаление отмечают, какие (месяц, тип расхода)
+затронуты изменёнными строками исходных таблиц; пересчёт в режиме dirty
+(dags.recalc_dirty) считает только их и снимает отметки.
+
+Тип расхода — таблица регистра затрат, как в recalc_period_by_months. Месяц строки —
+месяц её даты; у товаров и строк перемещений своей даты нет, их месяц — месяц
+перемещения (doc_transfers.date), в котором товар едет.
+
+Окна расчёта разделены по регистратору расходов, поэтому там, где затронутые
+регистраторы известны (REGISTRAR_SOURCES), отмечаются пары (месяц, регистратор)
+и пересчитываются только они: изменение строк расходов — их регистраторы, изменение
+перемещения, его товаров или их сумм — регистраторы прямых расходов по этому
+перемещению (goods_doc_id) в месяцах их собственных дат. Остальные типы отмечаются
+месяцем целиком (registrar_id = NULL): доли складских и общих расходов зависят
+от всех товаров месяца.
+"""
+from datetime import date, datetime
+
+from sqlalchemy import Date, and_, cast, exists, func, not_, select, text
+
+from src.db.models import DirectExpenses, GoodsTransfers, Transfers
+
+DIRECT_EXPENSES = "reg_direct_expenses"
+WAREHOUSE_EXPENSES = "reg_warehouse_expenses"
+GENERAL_EXPENSES = "reg_general_expenses"
+EXPENSE_TYPES = (DIRECT_EXPENSES, WAREHOUSE_EXPENSES, GENERAL_EXPENSES)
+
+GOODS_TABLE = "ref_goods"
+GOODS_LINKS_TABLE = "doc_link_goods_transfers"
+
+# таблица-источник -> типы расходов, расчёт которых читает её строки
+DIRTY_SOURCES: dict[str, tuple[str, ...]] = {
+    DIRECT_EXPENSES: (DIRECT_EXPENSES,),
+    WAREHOUSE_EXPENSES: (WAREHOUSE_EXPENSES,),
+    GENERAL_EXPENSES: (GENERAL_EXPENSES,),
+    "doc_transfers": EXPENSE_TYPES,
+    "reg_goods_location": (WAREHOUSE_EXPENSES,),
+    GOODS_TABLE: EXPENSE_TYPES,
+    GOODS_LINKS_TABLE: (DIRECT_EXPENSES, GENERAL_EXPENSES),
+}
+
+# таблица-источник -> типы расходов из DIRTY_SOURCES, отмечаемые по регистраторам (affected_registrars)
+REGISTRAR_SOURCES: dict[str, tuple[str, ...]] = {
+    DIRECT_EXPENSES: (DIRECT_EXPENSES,),
+    WAREHOUSE_EXPENSES: (WAREHOUSE_EXPENSES,),
+    GENERAL_EXPENSES: (GENERAL_EXPENSES,),
+    "doc_transfers": (DIRECT_EXPENSES,),
+    GOODS_TABLE: (DIRECT_EXPENSES,),
+    GOODS_LINKS_TABLE: (DIRECT_EXPENSES,),
+}
+
+# колонки, изменение которых влияет на расчёт (для upsert-моделей); остальные — любые переданные
+DIRTY_COLUMNS: dict[str, tuple[str, ...]] = {
+    GOODS_TABLE: ("amount",),
+}
+
+
+def affected_months(table_name: str, rows):
+    """SELECT DISTINCT первых дней месяцев, которые затрагивают строки rows (со структурой table_name)."""
+    tf = Transfers.__table__
+    if table_name == GOODS_TABLE:
+        gt = GoodsTransfers.__table__
+        return (
+            select(cast(func.date_trunc("month", tf.c.date), Date)).distinct()
+            .select_from(rows.join(gt, gt.c.goods_id == rows.c.id).join(tf, tf.c.id == gt.c.transfer_id))
+        )
+    if table_name == GOODS_LINKS_TABLE:
+        return (
+            select(cast(func.date_trunc("month", tf.c.date), Date)).distinct()
+            .select_from(rows.join(tf, tf.c.id == rows.c.transfer_id))
+        )
+    return select(cast(func.date_trunc("month", rows.c.date), Date)).distinct()
+
+
+def affected_registrars(table_name: str, rows):
+    """
+    SELECT DISTINCT (первый день месяца, регистратор расходов), которые затрагивают
+    строки rows, для типов REGISTRAR_SOURCES[table_name].
+    """
+    if table_name in EXPENSE_TYPES:
+        return select(cast(func.date_trunc("month", rows.c.date), Date), rows.c.registrar_id).distinct()
+    de = DirectExpenses.__table__
+    if table_name == GOODS_TABLE:
+        gt = GoodsTransfers.__table__
+        source = rows.join(gt, gt.c.goods_id == rows.c.id).join(de, de.c.goods_doc_id == gt.c.transfer_id)
+    elif table_name == GOODS_LINKS_TABLE:
+        source = rows.join(de, de.c.goods_doc_id == rows.c.transfer_id)
+    else:
+        source = rows.join(de, de.c.goods_doc_id == rows.c.id)
+    return select(cast(func.date_trunc("month", de.c.date), Date), de.c.registrar_id).distinct().select_from(source)
+
+
+def _split_types(table_name: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """Типы расходов таблицы-источника: (отмечаемые месяцем целиком, отмечаемые по регистраторам)."""
+    by_registrar = REGISTRAR_SOURCES.get(table_name, ())
+    return tuple(t for t in DIRTY_SOURCES[table_name] if t not in by_registrar), by_registrar
+
+
+def mark_dirty(conn, months, expense_types) -> None:
+    """Отмечает месяцы months (даты/datetime любого дня месяца) по типам expense_types."""
+    months = sorted({date(m.year, m.month, 1) for m in months if m is not None})
+    if not months or not expense_types:
+        return
+    conn.execute(
+        text("""
+            insert into recalc_dirty(month, expense_type)
+            select m, t from unnest(cast(:months as date[])) m, unnest(cast(:types as text[])) t
+        """),
+        {"months": months, "types": list(expense_types)},
+    )
+
+
+def mark_registrars(conn, months, registrars, expense_types) -> None:
+    """Отмечает пары (месяц, регистратор) — months[i] и registrars[i] — по типам expense_types."""
+    pairs = {(date(m.year, m.month, 1), r) for m, r in zip(months, registrars, strict=True) if m is not None and r is not None}
+    if not pairs or not expense_types:
+        return
+    months, registrars = zip(*sorted(pairs), strict=True)
+    conn.execute(
+        text("""
+            insert into recalc_dirty(month, expense_type, registrar_id)
+            select m, t, r
+            from unnest(cast(:months as date[]), cast(:registrars as uuid[])) u(m, r), unnest(cast(:types as text[])) t
+        """),
+        {"months": list(months), "registrars": [str(r) for r in registrars], "types": list(expense_types)},
+    )
+
+
+def mark_rows(conn, table_name: str, rows) -> None:
+    """Отмечает месяцы (или регистраторов) строк rows (TEMP или подзапрос со структурой table_name)."""
+    month_types, registrar_types = _split_types(table_name)
+    if month_types:
+        mark_dirty(conn, conn.execute(affected_months(table_name, rows)).scalars().all(), month_types)
+    if registrar_types:
+        pairs = conn.execute(affected_registrars(table_name, rows)).all()
+        mark_registrars(conn, [m for m, _ in pairs], [r for _, r in pairs], registrar_types)
+
+
+def mark_changed_rows(conn, target_tbl, temp_tbl, key_columns, columns) -> None:
+    """
+    Отмечает месяцы строк TEMP, которые отличаются от приёмника по columns
+    (для upsert: строки с тем же ключом и теми же значениями не влияют на расчёт).
+    """
+    columns = [c for c in DIRTY_COLUMNS.get(target_tbl.name, columns) if c in temp_tbl.c]
+    if not columns:
+        return
+    same = exists(select(1).select_from(target_tbl).where(and_(
+        *(target_tbl.c[c] == temp_tbl.c[c] for c in key_columns),
+        *(target_tbl.c[c].is_not_distinct_from(temp_tbl.c[c]) for c in columns),
+    )))
+    changed = select(temp_tbl).where(not_(same)).subquery("changed")
+    mark_rows(conn, target_tbl.name, changed)
+
+
+def delete_marking_dirty(conn, stmt, table) -> int:
+    """
+    Выполняет DELETE stmt; если таблица отслеживается — в том же запросе находит
+    месяцы (и регистраторов) удалённых строк и отмечает их. Возвращает число удалённых строк.
+    """
+    if table.name not in DIRTY_SOURCES:
+        return conn.execute(stmt).rowcount
+    month_types, registrar_types = _split_types(table.name)
+    deleted = stmt.returning(*table.c).cte("deleted")
+    columns = [select(func.count()).select_from(deleted).scalar_subquery()]
+    if month_types:
+        columns.append(func.array(affected_months(table.name, deleted).scalar_subquery()))
+    if registrar_types:
+        pairs = affected_registrars(table.name, deleted).subquery("pairs")
+        columns += [select(func.array_agg(c)).scalar_subquery() for c in pairs.c]
+    count, *marks = conn.execute(select(*columns)).one()
+    if month_types:
+        mark_dirty(conn, marks.pop(0) or [], month_types)
+    if registrar_types:
+        mark_registrars(conn, marks[0] or [], marks[1] or [], registrar_types)
+    return count
+
+
+def read_dirty(conn) -> list[tuple[date, str, int, list | None]]:
+    """
+    Отмеченные пары (месяц, тип расхода), id последней отметки каждой пары и
+    отмеченные регистраторы (None — пару нужно пересчитать целиком).
+    """
+    return [tuple(row) for row in conn.execute(text("""
+        select month, expense_type, max(id),
+               case when bool_or(registrar_id is null) then null
+                    else array_agg(distinct registrar_id) end
+        from recalc_dirty
+        group by month, expense_type
+        order by month, expense_type
+    """))]
+
+
+def clear_dirty(conn, month: date | datetime, expense_type: str, up_to_id: int) -> None:
+    """Снимает отметки пары, сделанные до её пересчёта (id <= up_to_id)."""
+    conn.execute(
+        text("delete from recalc_dirty where month = :month and expense_type = :type and id <= :id"),
+        {"month": month, "type": expense_type, "id": up_to_id},
+    )
@@ -0,0 +1,100 @@
+"""
+Журнал отпечатков пакетов (таблица ingest_fingerprint) — идемпотентная загрузка.
+
+1С при таймауте повторяет отправку того же пакета. Отпечаток — sha256 тела в том виде,
+в каком оно пришло (плюс формат и сжатие), считается при сохранении тела без
+отдельного прохода. Пакет с известным отпечатком подтверждается по журналу:
+загрузка, каскадное удаление и блокировки целевых таблиц не выполняются.
+
+Отпечаток действует INGEST_DEDUP_TTL_HOURS часов (0 — журнал выключен): повтор пакета
+позже этого срока загружается заново.
+"""
+import hashlib
+import json
+import uuid
+from typing import Any
+
+from sqlalchemy import text
+
+from src.config import settings
+from src.db.db import engine
+from src.db.jobs import STALE_AFTER
+
+FP_PENDING = "pending"  # пакет в очереди или загружается
+FP_DONE = "done"
+
+
+def package_digest(package_format: str, encoding: str):
+    """sha256, в который дописывается тело пакета по мере чтения."""
+    return hashlib.sha256(f"{package_format}:{encoding}:".encode())
+
+
+def dedup_enabled() -> bool:
+    return settings.INGEST_DEDUP_TTL_HOURS > 0
+
+
+def claim_fingerprint(fingerprint: str, job_id: uuid.UUID | None = None) -> dict[str, Any] | None:
+    """
+    Регистрирует пакет в журнале. None — пакет новый (или его запись устарела),
+    его нужно загрузить; иначе — запись журнала о предыдущем приёме этого пакета
+    (status, job_id, result), счётчик повторов увеличивается.
+    """
+    if not dedup_enabled():
+        return None
+    # ON CONFLICT блокирует существующую запись и при невыполненном WHERE,
+    # поэтому её не удалят до чтения ниже
+    claim = text(f"""
+        insert into ingest_fingerprint as f (fingerprint, status, job_id)
+        values (:fp, :pending, :job_id)
+        on conflict (fingerprint) do update
+        set status = excluded.status, job_id = excluded.job_id, result = null, hits = 0,
+            created_at = now(), finished_at = null, last_seen_at = null
+        where f.created_at < now() - make_interval(hours => :ttl)
+           or (f.status = :pending and f.created_at < now() - interval '{STALE_AFTER}')
+        returning fingerprint
+    """)
+    seen = text("""
+        update ingest_fingerprint set hits = hits + 1, last_seen_at = now()
+        where fingerprint = :fp
+        returning status, job_id, result, hits, created_at, finished_at
+    """)
+    with engine.begin() as conn:
+        params = {"fp": fingerprint, "pending": FP_PENDING, "job_id": job_id, "ttl": settings.INGEST_DEDUP_TTL_HOURS}
+        if conn.execute(claim, params).fetchone() is not None:
+            return None
+        row = conn.execute(seen, {"fp": fingerprint}).mappings().fetchone()
+    return dict(row) if row else None
+
+
+def finish_fingerprint(fingerprint: str | None, result: dict) -> None:
+    """Пакет загружен: повторы с этим отпечатком подтверждаются итогом result."""
+    if not fingerprint:
+        return
+    with engine.begin() as conn:
+        conn.execute(text("""
+            update ingest_fingerprint
+            set status = :done, result = cast(:result as jsonb), finished_at = now()
+            where fingerprint = :fp
+        """), {"fp": fingerprint, "done": FP_DONE, "result": json.dumps(result, default=str)})
+
+
+def release_fingerprint(fingerprint: str | None) -> None:
+    """Пакет не загружен (ошибка): повтор должен обрабатываться заново."""
+    if not fingerprint:
+        return
+    with engine.begin() as conn:
+        conn.execute(
+            text("delete from ingest_fingerprint where fingerprint = :fp and status = :pending"),
+            {"fp": fingerprint, "pending": FP_PENDING},
+        )
+
+
+def purge_fingerprints() -> int:
+    """Удаляет устаревшие записи журнала."""
+    if not dedup_enabled():
+        return 0
+    with engine.begin() as conn:
+        return conn.execute(
+            text("delete from ingest_fingerprint where created_at < now() - make_interval(hours => :ttl)"),
+            {"ttl": settings.INGEST_DEDUP_TTL_HOURS},
+        ).rowcount
@@ -0,0 +1,274 @@
+"""
+Очередь фоновых задач в Postgres (таблица bg_job).
+
+Задача ставится в очередь одной вставкой, воркеры забирают её через
+SELECT ... FOR UPDATE SKIP LOCKED: потоки-воркеры пула не получат одну и ту же
+задачу и не ждут блокировок друг друга.
+
+Очередь рассчитана на один процесс приложения (deploy/systemd, uvicorn без --workers):
+при старте пула requeue_stale_jobs считает брошенными все задачи в running, в том
+числе выполняемые другим живым процессом, и вернула бы их в очередь повторно.
+"""
+import json
+import logging
+import threading
+import uuid
+import zlib
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from sqlalchemy import text
+
+from src.db.db import engine
+
+log = logging.getLogger("app")
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+JOB_CANCELLED = "cancelled"
+
+POLL_INTERVAL = 1.0  # сек, пауза воркера при пустой очереди
+STALE_AFTER = "1 hour"  # отпечаток пакета в pending дольше этого считается брошенным (см. fingerprints)
+
+
+class JobCancelled(Exception):
+    """Обработчик остановил задачу по запросу отмены; result — итог выполненной части."""
+
+    def __init__(self, result: dict | None = None):
+        super().__init__("Задача отменена")
+        self.result = result
+
+
+def compress_payload(chunks: Iterable[bytes]) -> bytes:
+    """gzip кусков тела без сборки несжатого тела в памяти."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    parts = [compressor.compress(chunk) for chunk in chunks]
+    parts.append(compressor.flush())
+    return b"".join(parts)
+
+
+def enqueue_job(
+        kind: str, payload: bytes | None = None, params: dict | None = None, job_id: uuid.UUID | None = None,
+) -> uuid.UUID:
+    job_id = job_id or uuid.uuid4()
+    q = text("""
+        insert into bg_job(id, kind, status, payload, params)
+        values (:id, :kind, :status, :payload, cast(:params as jsonb))
+    """)
+    with engine.begin() as conn:
+        conn.execute(q, {
+            "id": job_id, "kind": kind, "status": JOB_QUEUED, "payload": payload,
+            "params": json.dumps(params) if params is not None else None,
+        })
+    return job_id
+
+
+def claim_job(kind: str) -> tuple[uuid.UUID, bytes | None, dict | None] | None:
+    """Забирает самую старую задачу из очереди (или None, если очередь пуста)."""
+    q = text("""
+        update bg_job
+        set status = :running, started_at = now(), attempts = attempts + 1
+        where id = (
+            select id from bg_job
+            where kind = :kind and status = :queued
+            order by created_at
+            limit 1
+            for update skip locked
+        )
+        returning id, payload, params
+    """)
+    with engine.begin() as conn:
+        row = conn.execute(q, {"kind": kind, "running": JOB_RUNNING, "queued": JOB_QUEUED}).fetchone()
+    return tuple(row) if row else None
+
+
+def merge_job_params(job_id: uuid.UUID, params: dict) -> bool:
+    """Дописывает ключи в params задачи отдельной транзакцией; False — задачи с таким id нет."""
+    q = text("""
+        update bg_job
+        set params = coalesce(params, '{}'::jsonb) || cast(:params as jsonb)
+        where id = :id
+    """)
+    with engine.begin() as conn:
+        return conn.execute(q, {"id": job_id, "params": json.dumps(params, default=str)}).rowcount > 0
+
+
+def finish_job(
+        job_id: uuid.UUID, result: dict | None = None, error: str | None = None, status: str | None = None,
+) -> None:
+    """Фиксирует итог задачи; тело пакета больше не нужно и удаляется."""
+    q = text("""
+        update bg_job
+        set status = :status, result = cast(:result as jsonb), error = :error,
+            finished_at = now(), payload = null
+        where id = :id
+    """)
+    with engine.begin() as conn:
+        conn.execute(q, {
+            "id": job_id, "status": status or (JOB_ERROR if error is not None else JOB_DONE),
+            "result": json.dumps(result, default=str) if result is not None else None, "error": error,
+        })
+
+
+def running_jobs_with(param: str) -> list[tuple[uuid.UUID, dict]]:
+    """Выполняемые задачи, в params которых записан ключ param: [(id, params)]."""
+    q = text("select id, params from bg_job where status = :running and params ? :param order by created_at")
+    with engine.begin() as conn:
+        return [tuple(row) for row in conn.execute(q, {"running": JOB_RUNNING, "param": param})]
+
+
+def requeue_stale_jobs(kind: str, needs_payload: bool = True) -> dict[str, int]:
+    """
+    Разбирает задачи, брошенные упавшим процессом. Вызывается при старте пула:
+    приложение работает одним процессом (deploy/systemd), поэтому все задачи вида
+    в running к этому моменту брошены, сколько бы они ни выполнялись.
+
+    Задача возвращается в очередь; с запрошенной отменой — становится cancelled;
+    без тела при needs_payload (выполнить её заново нечем) — error. Задачи без тела
+    (пересчёт, каскадное удаление) повторяются по params. Возвращает {статус: число задач}.
+    """
+    q = text("""
+        update bg_job
+        set status = case
+                when cancel_requested_at is not null then :cancelled
+                when :needs_payload and payload is null then :error
+                else :queued end,
+            error = case
+                when cancel_requested_at is null and :needs_payload and payload is null
+                then 'Процесс остановился во время выполнения, тело задачи не сохранилось'
+                else error end,
+            finished_at = case when cancel_requested_at is not null or (:needs_payload and payload is null)
+                then now() else finished_at end
+        where kind = :kind and status = :running
+        returning status
+    """)
+    with engine.begin() as conn:
+        statuses = conn.execute(q, {
+            "kind": kind, "needs_payload": needs_payload, "running": JOB_RUNNING,
+            "queued": JOB_QUEUED, "cancelled": JOB_CANCELLED, "error": JOB_ERROR,
+        }).scalars().all()
+    return {status: statuses.count(status) for status in set(statuses)}
+
+
+def request_cancel(job_id: uuid.UUID) -> str | None:
+    """
+    Отмена задачи: ожидающая в очереди сразу становится cancelled, у выполняемой
+    отмечается cancel_requested_at — обработчик проверяет её (cancel_requested) и
+    останавливается в удобной точке. Возвращает статус задачи после запроса
+    или None, если задача не найдена или уже завершена.
+    """
+    q = text("""
+        update bg_job
+        set status = case when status = :queued then :cancelled else status end,
+            finished_at = case when status = :queued then now() else finished_at end,
+            cancel_requested_at = coalesce(cancel_requested_at, now()),
+            payload = case when status = :queued then null else payload end
+        where id = :id and status in (:queued, :running)
+        returning status
+    """)
+    with engine.begin() as conn:
+        return conn.execute(
+            q, {"id": job_id, "queued": JOB_QUEUED, "running": JOB_RUNNING, "cancelled": JOB_CANCELLED},
+        ).scalar()
+
+
+def cancel_requested(job_id: uuid.UUID) -> bool:
+    with engine.begin() as conn:
+        return bool(conn.execute(
+            text("select cancel_requested_at is not null from bg_job where id = :id"), {"id": job_id},
+        ).scalar())
+
+
+def get_job(job_id: uuid.UUID) -> dict[str, Any] | None:
+    q = text("""
+        select id, kind, status, params, result, error, progress, attempts,
+               created_at, started_at, finished_at, cancel_requested_at,
+               extract(epoch from started_at - created_at) as wait_sec,
+               extract(epoch from coalesce(finished_at, now()) - started_at) as run_sec,
+               case when status = :queued then (
+                   select count(*) from bg_job q
+                   where q.kind = j.kind and q.status = :queued and q.created_at < j.created_at
+               ) end as queue_position
+        from bg_job j
+        where id = :id
+    """)
+    with engine.begin() as conn:
+        row = conn.execute(q, {"id": job_id, "queued": JOB_QUEUED}).mappings().fetchone()
+    return dict(row) if row else None
+
+
+class JobWorkerPool:
+    """
+    Пул потоков-воркеров одного вида задач.
+    handler(job_id, payload, params) -> dict результата; исключение помечает задачу как error.
+    needs_payload=False — задачи вида выполняются по params, без тела (см. requeue_stale_jobs).
+    """
+
+    def __init__(
+            self,
+            kind: str,
+            handler: Callable[[uuid.UUID, bytes | None, dict | None], dict],
+            workers: int,
+            needs_payload: bool = True,
+    ):
+        self.kind = kind
+        self.handler = handler
+        self.workers = workers
+        self.needs_payload = needs_payload
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        stale = requeue_stale_jobs(self.kind, self.needs_payload)
+        if stale:
+            log.warning("%s: брошенные задачи разобраны: %s", self.kind, stale)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"{self.kind}-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads.clear()
+
+    def notify(self) -> None:
+        """Разбудить воркеры (новая задача поставлена этим же процессом)."""
+        self._wakeup.set()
+
+    def run_once(self) -> bool:
+        """Обрабатывает одну задачу; False — очередь пуста."""
+        job = claim_job(self.kind)
+        if job is None:
+            return False
+        job_id, payload, params = job
+        log.info("%s: задача %s взята в работу", self.kind, job_id)
+        try:
+            result = self.handler(job_id, payload, params)
+        except JobCancelled as e:
+            finish_job(job_id, result=e.result, status=JOB_CANCELLED)
+            log.info("%s: задача %s отменена", self.kind, job_id)
+        except Exception as e:
+            log.exception("%s: задача %s завершилась ошибкой", self.kind, job_id)
+            finish_job(job_id, error=str(e) or type(e).__name__)
+        else:
+            finish_job(job_id, result=result)
+            log.info("%s: задача %s выполнена", self.kind, job_id)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                # БД недоступна и т.п. — ждём и пробуем снова
+                log.exception("%s: ошибка воркера", self.kind)
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+
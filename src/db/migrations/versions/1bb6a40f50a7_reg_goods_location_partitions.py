@@ -0,0 +1,46 @@
+"""reg_goods_location partitions
+
+Revision ID: 1bb6a40f50a7
+Revises: 59eec9a41b72
+Create Date: 2026-10-18 12:10:15.447466
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+from src.db.utils.online_partition import convert_to_partitioned
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1bb6a40f50a7'
+down_revision: Union[str, Sequence[str], None] = '59eec9a41b72'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # перенос идёт своими транзакциями на отдельных соединениях, загрузка в таблицу не останавливается
+    with op.get_context().autocommit_block():
+        convert_to_partitioned(
+            op.get_bind().engine, "reg_goods_location",
+            indexes=[
+                "CREATE INDEX ix_gl_shipped_sender_date ON {table} (sender_warehouse_id, date) "
+                "INCLUDE (goods_id, registrar_id) WHERE goods_status = 2",
+            ],
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # обратно — без переноса онлайн: таблица блокируется на время копирования
+    op.execute("ALTER TABLE reg_goods_location RENAME TO reg_goods_location__part")
+    op.execute("ALTER TABLE reg_goods_location__part RENAME CONSTRAINT reg_goods_location_pkey TO reg_goods_location__part_pkey")
+    op.execute("CREATE TABLE reg_goods_location (LIKE reg_goods_location__part INCLUDING DEFAULTS)")
+    op.create_primary_key('reg_goods_location_pkey', 'reg_goods_location', ['registrar_id', 'date', 'goods_id', 'registrar_type'])
+    op.execute("INSERT INTO reg_goods_location SELECT * FROM reg_goods_location__part")
+    # партиции в схеме partitions удаляются вместе с родителем
+    op.drop_table('reg_goods_location__part')
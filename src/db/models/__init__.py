@@ -59,8 +59,13 @@ from .regs import (
 )
 
 from .other import (
+    BgJob,
     DeletedObject,
+    LoadCheckpoint,
+    IngestFingerprint,
+    RecalcDirty,
     DmGoodsExpenseAlloc,
+    GoodsWeight,
     TelegramChats
 )
 
@@ -81,8 +86,13 @@ __all__ = [
     "GoodsLocation", "DirectExpenses", "GeneralExpenses",
     "WarehouseExpenses", "CostAndPaymentGoods",
     # другие
+    "BgJob",
     "DeletedObject",
+    "LoadCheckpoint",
+    "IngestFingerprint",
+    "RecalcDirty",
     "DmGoodsExpenseAlloc",
+    "GoodsWeight",
     "TelegramChats",
 
 ]
@@ -1,10 +1,11 @@
 import uuid
-from datetime import datetime
+from datetime import date, datetime
 from decimal import Decimal
 
-from sqlalchemy import DateTime, Index
+from sqlalchemy import BigInteger, DateTime, Index, LargeBinary, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import Field, SQLModel
-from .base import TimestampMixin, BaseModelConfig
+from .base import TimestampMixin, BaseModelConfig, utcnow
 
 
 class ETLJobStatus(SQLModel, table=True):
@@ -14,6 +15,97 @@ class ETLJobStatus(SQLModel, table=True):
     last_success_at: datetime = Field(sa_type=DateTime(timezone=True), nullable=False)
 
 
+class BgJob(SQLModel, table=True):
+    """
+    Очередь фоновых задач (загрузка пакетов и т.п.).
+    Воркеры забирают задачи через SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    __tablename__ = "bg_job"
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    kind: str = Field(max_length=50, nullable=False)
+    status: str = Field(max_length=20, nullable=False)  # queued / running / done / error / cancelled
+    payload: bytes | None = Field(default=None, sa_type=LargeBinary)  # gzip
+    params: dict | None = Field(default=None, sa_type=JSONB)
+    result: dict | None = Field(default=None, sa_type=JSONB)
+    error: str | None = Field(default=None)
+    progress: dict | None = Field(default=None, sa_type=JSONB)  # ход выполнения, пишет обработчик задачи
+    cancel_requested_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+    attempts: int = Field(default=0, sa_column_kwargs={"server_default": text("0")}, nullable=False)
+    created_at: datetime = Field(
+        default_factory=utcnow,
+        sa_type=DateTime(timezone=True), sa_column_kwargs={"server_default": text("now()")}, nullable=False,
+    )
+    started_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+    finished_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+    __table_args__ = (
+        Index("ix_bg_job_queue", "kind", "status", "created_at"),
+    )
+
+
+class LoadCheckpoint(SQLModel, table=True):
+    """
+    Чекпоинты первичной загрузки (first_load_data): строка на каждый записанный шаблон файла,
+    template_index = -1 — файл загружен целиком.
+    """
+    __tablename__ = "load_checkpoint"
+
+    file_name: str = Field(primary_key=True, max_length=255)
+    template_index: int = Field(primary_key=True)
+    file_size: int = Field(sa_type=BigInteger, nullable=False)
+    file_mtime: float = Field(nullable=False)
+    name_metadata: str | None = Field(default=None)
+    rows: int = Field(default=0, sa_type=BigInteger, nullable=False)
+    finished_at: datetime = Field(
+        default_factory=utcnow,
+        sa_type=DateTime(timezone=True), sa_column_kwargs={"server_default": text("now()")}, nullable=False,
+    )
+
+
+class IngestFingerprint(SQLModel, table=True):
+    """
+    Журнал отпечатков принятых пакетов: sha256 тела (с форматом и сжатием).
+    Повтор пакета, уже загруженного или стоящего в очереди, подтверждается по журналу
+    без обращения к целевым таблицам.
+    """
+    __tablename__ = "ingest_fingerprint"
+
+    fingerprint: str = Field(primary_key=True, max_length=64)
+    status: str = Field(max_length=20, nullable=False)  # pending / done
+    job_id: uuid.UUID | None = Field(default=None)  # задача очереди (None — пакет принят с sync=true)
+    result: dict | None = Field(default=None, sa_type=JSONB)  # итог загрузки (IngestStats.as_dict)
+    hits: int = Field(default=0, sa_column_kwargs={"server_default": text("0")}, nullable=False)  # подтверждённых повторов
+    created_at: datetime = Field(
+        default_factory=utcnow,
+        sa_type=DateTime(timezone=True), sa_column_kwargs={"server_default": text("now()")}, nullable=False,
+    )
+    finished_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+    last_seen_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+
+
+class RecalcDirty(SQLModel, table=True):
+    """
+    Журнал «грязных» месяцев: (месяц, тип расхода), которые нужно пересчитать после
+    загрузки или удаления исходных строк (см. src/db/dirty_months.py). registrar_id —
+    пересчитать только этого регистратора расходов, NULL — весь месяц.
+    Только вставки, без уникального ключа: параллельные транзакции загрузки не ждут
+    друг друга; пересчёт снимает отметки не новее прочитанного id.
+    """
+    __tablename__ = "recalc_dirty"
+
+    id: int | None = Field(default=None, primary_key=True, sa_type=BigInteger)
+    month: date = Field(nullable=False)
+    expense_type: str = Field(max_length=50, nullable=False)  # таблица регистра затрат
+    registrar_id: uuid.UUID | None = Field(default=None)
+    marked_at: datetime = Field(
+        default_factory=utcnow,
+        sa_type=DateTime(timezone=True), sa_column_kwargs={"server_default": text("now()")}, nullable=False,
+    )
+    __table_args__ = (
+        Index("ix_recalc_dirty_month_type", "month", "expense_type"),
+    )
+
+
 class DeletedObject(TimestampMixin, BaseModelConfig, table=True):
     """
     ТП_ДанныеНаУдаление
@@ -43,6 +135,35 @@ class DmGoodsExpenseAlloc(SQLModel, table=True):
     )
 
 
+class GoodsWeight(SQLModel, table=True):
+    """
+    Веса товаров месяца для распределения расходов (см. dags.build_goods_weight): соединения
+    товаров с перемещениями, складами, подразделениями и странами считаются один раз на
+    месяц и читаются всеми тремя типами расходов.
+    kind = "transfer" — товары перемещений, на которые ссылаются прямые расходы месяца,
+    total — сумма товаров перемещения; kind = "china" — товары перемещений «Погрузка в машину»
+    месяца из Китая за его пределы (общие расходы), total — сумма всех таких товаров месяца;
+    kind = "location" — отправления товаров месяца (reg_goods_location), total — сумма
+    отправлений подразделения склада-отправителя.
+    UNLOGGED: строки месяца пересобираются в начале каждого пересчёта.
+    """
+    __tablename__ = "stg_goods_weight"
+
+    id: int | None = Field(default=None, primary_key=True, sa_type=BigInteger)
+    month: date = Field(nullable=False)
+    kind: str = Field(max_length=10, nullable=False)
+    transfer_id: uuid.UUID = Field(nullable=False)
+    goods_id: uuid.UUID = Field(nullable=False)
+    department_id: uuid.UUID | None = Field(default=None)
+    amount: Decimal = Field(nullable=False)
+    total: Decimal = Field(nullable=False)
+    __table_args__ = (
+        Index("ix_stg_goods_weight_transfer", "month", "kind", "transfer_id"),
+        Index("ix_stg_goods_weight_department", "month", "kind", "department_id"),
+        {"prefixes": ["UNLOGGED"]},
+    )
+
+
 class TelegramChats(SQLModel, table=True):
     __tablename__ = "telegram_chats"
 
@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 from decimal import Decimal
 
-from sqlalchemy import Index
+from sqlalchemy import Index, text
 from sqlmodel import Field
 from .base import TimestampMixin, BaseModelConfig
 
@@ -24,6 +24,16 @@ class GoodsLocation(TimestampMixin, BaseModelConfig, table=True):
     sender_warehouse_id: uuid.UUID | None = Field(alias="СкладОтправитель")
     goods_status: int | None = Field(alias="СтатусТовара")
 
+    __table_args__ = (
+        # отправления месяца со складов подразделения: раскладка складских расходов
+        Index(
+            "ix_gl_shipped_sender_date", "sender_warehouse_id", "date",
+            postgresql_where=text("goods_status = 2"),
+            postgresql_include=["goods_id", "registrar_id"],
+        ),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+
 
 class DirectExpenses(TimestampMixin, BaseModelConfig, table=True):
     """
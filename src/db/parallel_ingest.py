@@ -0,0 +1,307 @@
+"""
+Параллельная загрузка пакета по целевым таблицам.
+
+Шаблоны пакета раскладываются по "дорожкам": каждая целевая таблица закрепляется
+за одной дорожкой (своё соединение, своя транзакция, свой поток), поэтому порядок
+шаблонов внутри таблицы сохраняется, а разные таблицы пишутся одновременно.
+Разбор тела остаётся в вызывающем потоке и передаёт строки дорожкам пачками
+через ограниченные очереди — память не растёт с размером пакета.
+
+atomic=True — пакет фиксируется двухфазным коммитом: все дорожки делают
+PREPARE TRANSACTION, и только после этого COMMIT PREPARED. Требует
+max_prepared_transactions > 0 на сервере.
+
+Идентификаторы подготовленных транзакций — "dbtransfer:<id пакета>:<запуск>:<дорожка>",
+id пакета — id задачи очереди, запуск различает повторы одной задачи. Когда все дорожки подготовлены, их список
+записывается в params задачи (prepared_gids) — это и есть решение о фиксации.
+Транзакции, оставшиеся подготовленными после падения процесса или сбоя
+COMMIT PREPARED, разбирает recover_prepared при старте приложения: записанные
+в задаче фиксируются, остальные откатываются. После записи решения пакет считается
+загруженным: сбой COMMIT PREPARED только логируется, задача завершается успешно.
+У пакета без задачи (sync) решение не записывается — его транзакции откатываются,
+а сбой фиксации возвращается клиенту: он не получил ответа и повторит пакет.
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import cache
+
+from sqlalchemy import text
+
+from src.db.db import IngestSession, ScopeStats, engine, iter_batches
+from src.db.fingerprints import finish_fingerprint
+from src.db.jobs import finish_job, get_job, merge_job_params, running_jobs_with
+
+log = logging.getLogger("app")
+
+LANE_BATCH_SIZE = 1000  # строк в одной пачке, передаваемой дорожке
+LANE_QUEUE_SIZE = 4  # пачек в очереди дорожки (ограничивает память)
+_POLL = 0.1
+
+GID_PREFIX = "dbtransfer"  # префикс идентификаторов подготовленных транзакций приложения
+COMMIT_ATTEMPTS = 5  # попыток COMMIT PREPARED на дорожку
+COMMIT_RETRY_PAUSE = 1.0  # сек, пауза перед повтором (растёт с номером попытки)
+
+_END = object()  # конец пакета
+_END_TEMPLATE = object()  # конец строк шаблона
+
+
+class _Aborted(Exception):
+    pass
+
+
+@cache
+def two_phase_available() -> bool:
+    with engine.connect() as conn:
+        return int(conn.exec_driver_sql("SHOW max_prepared_transactions").scalar()) > 0
+
+
+def package_gid(package_id: uuid.UUID, run: str, index: int) -> str:
+    return f"{GID_PREFIX}:{package_id}:{run}:{index}"
+
+
+def _finish_prepared(gid: str, commit: bool) -> bool:
+    """
+    COMMIT/ROLLBACK PREPARED в отдельном соединении (вне блока транзакции).
+    False — транзакции с таким gid уже нет.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        exists = conn.execute(
+            text("select 1 from pg_prepared_xacts where gid = :gid and database = current_database()"), {"gid": gid},
+        ).scalar()
+        if not exists:
+            return False
+        conn.exec_driver_sql(f"{'COMMIT' if commit else 'ROLLBACK'} PREPARED '{gid}'")
+    return True
+
+
+def recover_prepared() -> dict[str, int]:
+    """
+    Разбирает подготовленные транзакции приложения, оставшиеся с прошлого запуска.
+    Вызывается при старте до воркеров загрузки: приложение работает одним процессом,
+    поэтому все такие транзакции брошены. Пакет, все дорожки которого были подготовлены
+    (gid записан в задаче), фиксируется, остальные откатываются — иначе их блокировки
+    держат целевые таблицы.
+
+    Задача с записанным решением завершается как выполненная (и её отпечаток — как
+    загруженный), даже если её транзакции уже были зафиксированы до падения: иначе
+    requeue_stale_jobs вернёт её в очередь и пакет загрузится повторно.
+    Возвращает {"committed": .., "rolled_back": .., "jobs_done": ..}.
+    """
+    with engine.connect() as conn:
+        gids = conn.execute(text("""
+            select gid from pg_prepared_xacts
+            where database = current_database() and starts_with(gid, :prefix)
+            order by prepared
+        """), {"prefix": f"{GID_PREFIX}:"}).scalars().all()
+
+    decided: dict[str, set[str]] = {}
+    counts = {"committed": 0, "rolled_back": 0}
+    for gid in gids:
+        package_id = gid.split(":")[1]
+        if package_id not in decided:
+            try:
+                job = get_job(uuid.UUID(package_id))
+            except ValueError:
+                job = None
+            decided[package_id] = set(((job or {}).get("params") or {}).get("prepared_gids") or ())
+        commit = gid in decided[package_id]
+        try:
+            if _finish_prepared(gid, commit):
+                counts["committed" if commit else "rolled_back"] += 1
+        except Exception:
+            log.exception("Не удалось разобрать подготовленную транзакцию %s", gid)
+
+    # оставшаяся подготовленной транзакция с записанным решением зафиксируется при следующем старте
+    counts["jobs_done"] = 0
+    for job_id, params in running_jobs_with("prepared_gids"):
+        result = {"recovered": True, "prepared_gids": params["prepared_gids"]}
+        finish_fingerprint(params.get("fingerprint"), result)
+        finish_job(job_id, result=result)
+        counts["jobs_done"] += 1
+    if gids or counts["jobs_done"]:
+        log.warning("Подготовленные транзакции прошлого запуска разобраны: %s", counts)
+    return counts
+
+
+class _Lane:
+    """Поток с собственным соединением, последовательно применяющий свои шаблоны."""
+
+    def __init__(self, index: int, atomic: bool, gid: str):
+        self.atomic = atomic
+        self.gid = gid
+        self.error: BaseException | None = None
+        self.results: list[tuple[str, ScopeStats]] = []
+        self._queue: queue.Queue = queue.Queue(maxsize=LANE_QUEUE_SIZE)
+        self._abort = threading.Event()
+        self.conn = engine.connect()
+        self.tx = self.conn.begin_twophase(gid) if atomic else self.conn.begin()
+        self.session = IngestSession(self.conn, staging="unlogged" if atomic else "temp")
+        self._thread = threading.Thread(target=self._run, name=f"ingest-lane-{index}", daemon=True)
+        self._thread.start()
+
+    def put(self, item) -> None:
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self._queue.put(item, timeout=_POLL)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self):
+        while True:
+            try:
+                return self._queue.get(timeout=_POLL)
+            except queue.Empty:
+                if self._abort.is_set():
+                    raise _Aborted from None
+
+    def _rows(self):
+        while (batch := self._get()) is not _END_TEMPLATE:
+            yield from batch
+
+    def _run(self) -> None:
+        try:
+            while (item := self._get()) is not _END:
+                name_meta, dataModel = item
+                scope_stats = self.session.replace_scope(dataModel, self._rows())
+                self.results.append((name_meta, scope_stats))
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self.error = e
+
+    def finish(self) -> None:
+        """Дождаться обработки всех переданных шаблонов."""
+        self.put(_END)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def prepare(self) -> None:
+        if self.atomic:
+            self.session.drop_staging()
+            self.tx.prepare()
+
+    def commit(self) -> None:
+        """
+        Фиксация дорожки. Подготовленная транзакция при сбое COMMIT PREPARED не
+        бросается: фиксация повторяется из нового соединения, а если и это не удалось —
+        gid остаётся записанным в задаче и транзакцию фиксирует recover_prepared.
+        """
+        try:
+            self.tx.commit()
+            return
+        except Exception:
+            if not self.atomic:
+                raise
+            log.warning("Сбой COMMIT PREPARED %s, повтор", self.gid, exc_info=True)
+            self.conn.invalidate()  # закрытие не должно откатить подготовленную транзакцию
+        finally:
+            self.conn.close()
+        for attempt in range(1, COMMIT_ATTEMPTS + 1):
+            time.sleep(COMMIT_RETRY_PAUSE * attempt)
+            try:
+                _finish_prepared(self.gid, commit=True)
+                return
+            except Exception:
+                if attempt == COMMIT_ATTEMPTS:
+                    raise
+                log.warning("Сбой COMMIT PREPARED %s (попытка %i)", self.gid, attempt, exc_info=True)
+
+    def rollback(self) -> None:
+        self._abort.set()
+        self._thread.join()
+        try:
+            self.tx.rollback()
+        except Exception:
+            log.exception("Ошибка отката дорожки загрузки")
+        finally:
+            self.conn.close()
+
+
+class TableLanes:
+    """Раскладывает шаблоны пакета по дорожкам (не больше workers соединений)."""
+
+    def __init__(self, workers: int, atomic: bool, package_id: uuid.UUID | None = None):
+        self.workers = workers
+        self.atomic = atomic
+        self.package_id = package_id or uuid.uuid4()
+        self._run = uuid.uuid4().hex[:8]
+        self.decided = False  # решение о фиксации записано в задаче (см. prepare)
+        self.results: list[tuple[str, ScopeStats]] = []
+        self._lanes: list[_Lane] = []
+        self._by_table: dict[str, _Lane] = {}
+
+    def _lane_for(self, table_name: str) -> _Lane:
+        lane = self._by_table.get(table_name)
+        if lane is None:
+            if len(self._lanes) < self.workers:
+                index = len(self._lanes)
+                lane = _Lane(index, self.atomic, package_gid(self.package_id, self._run, index))
+                self._lanes.append(lane)
+            else:
+                lane = self._lanes[len(self._by_table) % self.workers]
+            self._by_table[table_name] = lane
+        return lane
+
+    def replace_scope(self, name_meta: str, dataModel, rows) -> None:
+        """Передаёт шаблон дорожке его таблицы; строки читаются здесь же, по мере разбора."""
+        lane = self._lane_for(dataModel.__table__.fullname)
+        lane.put((name_meta, dataModel))
+        for batch in iter_batches(rows, LANE_BATCH_SIZE):
+            lane.put(batch)
+        lane.put(_END_TEMPLATE)
+
+    def prepare(self) -> None:
+        """Дождаться все дорожки и подготовить их транзакции к фиксации."""
+        for lane in self._lanes:
+            lane.finish()
+        for lane in self._lanes:
+            lane.prepare()
+        if self.atomic:
+            # решение о фиксации: после записи пакет фиксируется и при восстановлении
+            self.decided = merge_job_params(self.package_id, {"prepared_gids": [lane.gid for lane in self._lanes]})
+
+    def commit(self) -> None:
+        """
+        После PREPARE каждая дорожка гарантированно фиксируема: откатывать остальные
+        при сбое одной нельзя, её транзакция остаётся подготовленной. Если решение
+        записано в задаче, сбой только логируется — пакет загружен, транзакцию
+        зафиксирует recover_prepared; иначе ошибка передаётся вызывающему.
+        """
+        failed = None
+        for lane in self._lanes:
+            try:
+                lane.commit()
+            except Exception as e:
+                log.exception("Ошибка фиксации дорожки загрузки (xid %s)", lane.gid)
+                failed = failed or e
+            self.results.extend(lane.results)
+        if failed is not None and not self.decided:
+            raise failed
+
+    def rollback(self) -> None:
+        for lane in self._lanes:
+            lane.rollback()
+
+
+@contextmanager
+def parallel_ingest(workers: int, atomic: bool, package_id: uuid.UUID | None = None):
+    """
+    Параллельная сессия загрузки пакета: фиксация при выходе, откат всех дорожек при ошибке.
+    package_id — id задачи очереди, в которой записывается решение о фиксации (см. recover_prepared).
+    """
+    lanes = TableLanes(workers, atomic, package_id)
+    try:
+        yield lanes
+        lanes.prepare()
+    except BaseException:
+        lanes.rollback()
+        raise
+    lanes.commit()
@@ -1,39 +1,204 @@
+# Веса товаров месяца [mstart, mnext) в stg_goods_weight — общая часть трёх типов расходов:
+# товары с суммой, склад-отправитель и его подразделение, страны и вид перемещения
+# соединяются один раз, здесь же считаются знаменатели долей (total).
+# kind = 'transfer' — товары перемещений, на которые ссылаются прямые расходы месяца;
+# total — сумма товаров перемещения.
+# kind = 'china' — товары перемещений «Погрузка в машину» месяца из Китая за его пределы:
+# по ним раскладывается каждая строка общих расходов; total — сумма всех этих товаров.
+# kind = 'location' — отправления месяца (reg_goods_location, goods_status = 2) со складов
+# подразделений; total — сумма отправлений подразделения.
+DELETE_GOODS_WEIGHT_SQL = """
+    DELETE FROM stg_goods_weight WHERE month = :mstart
+"""
+
+GOODS_WEIGHT_TRANSFERS_SQL = """
+    INSERT INTO stg_goods_weight (month, kind, transfer_id, goods_id, department_id, amount, total)
+    SELECT
+        :mstart, 'transfer', tf.id, gd.id, wh.department_id, gd.amount,
+        SUM(gd.amount) OVER (PARTITION BY tf.id)
+    FROM (
+        SELECT DISTINCT e.goods_doc_id AS id
+        FROM reg_direct_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+    ) AS ids
+    JOIN doc_transfers AS tf ON tf.id = ids.id
+    JOIN ref_warehouses AS wh ON tf.out_warehouse_id = wh.id
+    JOIN doc_link_goods_transfers AS gt ON gt.transfer_id = tf.id
+    JOIN ref_goods AS gd ON gd.id = gt.goods_id
+    WHERE gd.amount IS NOT NULL
+"""
+
+# страны сравниваются по имени один раз на склад, а не в соединении с расходами
+GOODS_WEIGHT_CHINA_SQL = """
+    INSERT INTO stg_goods_weight (month, kind, transfer_id, goods_id, department_id, amount, total)
+    SELECT
+        :mstart, 'china', tr.id, gd.id, wh_out.department_id, gd.amount,
+        SUM(gd.amount) OVER ()
+    FROM doc_transfers AS tr
+    JOIN ref_warehouses AS wh_out ON tr.out_warehouse_id = wh_out.id
+    JOIN ref_countries  AS cn_out ON wh_out.country_id = cn_out.id
+    JOIN ref_warehouses AS wh_in  ON tr.in_warehouse_id = wh_in.id
+    JOIN ref_countries  AS cn_in  ON wh_in.country_id  = cn_in.id
+    JOIN doc_link_goods_transfers AS gt ON gt.transfer_id = tr.id
+    JOIN ref_goods AS gd ON gd.id = gt.goods_id
+    WHERE tr.date >= :mstart AND tr.date < :mnext AND tr.type_transfer = 'Погрузка в машину'
+      AND cn_out.name = 'КИТАЙ'
+      AND cn_in.name <> 'КИТАЙ'
+      AND gd.amount IS NOT NULL
+"""
+
+GOODS_WEIGHT_LOCATIONS_SQL = """
+    INSERT INTO stg_goods_weight (month, kind, transfer_id, goods_id, department_id, amount, total)
+    SELECT
+        :mstart, 'location', gl.registrar_id, gd.id, de.id, gd.amount,
+        SUM(gd.amount) OVER (PARTITION BY de.id)
+    FROM reg_goods_location AS gl
+    JOIN ref_goods AS gd ON gd.id = gl.goods_id
+    JOIN doc_transfers AS tf ON tf.id = gl.registrar_id
+    JOIN ref_warehouses AS wh ON gl.sender_warehouse_id = wh.id
+    JOIN ref_departments AS de ON wh.department_id = de.id
+    WHERE gl.goods_status = 2  -- отправление
+      AND gd.amount IS NOT NULL
+      AND gl.date >= :mstart AND gl.date < :mnext
+"""
+
+
+# Доли расходов по товарам за месяц [mstart, mnext): строка расхода x товар.
+# total_amount — сумма расходов ключа (registrar_id, cost_category_id, goods_doc_id) за месяц:
+# её после раскладки копеек должна дать сумма долей ключа.
+# :registrars — только эти регистраторы расходов (NULL — все): окна долей и раскладки
+# разделены по registrar_id, поэтому доли регистратора от отбора не зависят.
+#
+# *_SHARES_SQL читают веса месяца из stg_goods_weight (пересчёт месяца целиком).
+# Знаменатель доли — сумма весов по всем строкам расходов окна, то есть число строк
+# расходов окна x total; так он совпадает с SUM(gd.amount) OVER окна по соединению.
+# *_REGISTRAR_SHARES_SQL — то же по исходным таблицам: для нескольких регистраторов
+# строить веса всего месяца дороже, чем соединить их строки напрямую.
 
 # Распределение прямых расходов
-ALLOC_DIRECT_EXPENSES_SQL = """
-    CREATE TEMP TABLE tmp_table ON COMMIT DROP AS
+DIRECT_EXPENSES_SHARES_SQL = """
     SELECT
-        'Прямые расходы' AS type_expense,
+        CAST(:type_expense AS varchar) AS type_expense,
+        de.registrar_id,
+        w.goods_id,
+        de.cost_category_id,
+        w.department_id,
+        de.date,
+        de.goods_doc_id,
+        ROUND(de.amount * w.amount / NULLIF(de.key_rows * w.total, 0), :precision) AS amount,
+        de.total_amount
+    FROM (
+        SELECT e.*, SUM(e.amount) OVER k AS total_amount, COUNT(*) OVER k AS key_rows
+        FROM reg_direct_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+        WINDOW k AS (PARTITION BY e.registrar_id, e.cost_category_id, e.goods_doc_id)
+    ) AS de
+    JOIN stg_goods_weight AS w
+      ON w.month = :mstart AND w.kind = 'transfer' AND w.transfer_id = de.goods_doc_id
+"""
+
+
+# Распределение складских расходов
+WAREHOUSE_EXPENSES_SHARES_SQL = """
+    SELECT
+        CAST(:type_expense AS varchar) AS type_expense,
+        we.registrar_id,
+        w.goods_id,
+        we.cost_category_id,
+        we.department_id,
+        we.date,
+        NULL::uuid AS goods_doc_id,
+        ROUND(we.amount * w.amount / NULLIF(we.registrar_total, 0), :precision) AS amount,
+        we.total_amount
+    FROM (
+        SELECT
+            e.*,
+            SUM(e.amount) OVER (PARTITION BY e.registrar_id, e.cost_category_id) AS total_amount,
+            SUM(dt.total) OVER (PARTITION BY e.registrar_id) AS registrar_total
+        FROM reg_warehouse_expenses AS e
+        LEFT JOIN LATERAL (
+            SELECT w.total FROM stg_goods_weight AS w
+            WHERE w.month = :mstart AND w.kind = 'location' AND w.department_id = e.department_id
+            LIMIT 1
+        ) AS dt ON true
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+    ) AS we
+    JOIN stg_goods_weight AS w
+      ON w.month = :mstart AND w.kind = 'location' AND w.department_id = we.department_id
+"""
+
+
+# Распределение общих расходов
+GENERAL_EXPENSES_SHARES_SQL = """
+    SELECT
+        CAST(:type_expense AS varchar) AS type_expense,
+        ge.registrar_id,
+        w.goods_id,
+        ge.cost_category_id,
+        w.department_id,
+        ge.date,
+        NULL::uuid AS goods_doc_id,
+        ROUND(ge.amount * w.amount / NULLIF(ge.registrar_rows * w.total, 0), :precision) AS amount,
+        ge.total_amount
+    FROM (
+        SELECT
+            e.*,
+            SUM(e.amount) OVER (PARTITION BY e.registrar_id, e.cost_category_id) AS total_amount,
+            COUNT(*) OVER (PARTITION BY e.registrar_id) AS registrar_rows
+        FROM reg_general_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+    ) AS ge
+    JOIN stg_goods_weight AS w ON w.month = :mstart AND w.kind = 'china'
+"""
+
+
+# Распределение прямых расходов (по исходным таблицам)
+DIRECT_EXPENSES_REGISTRAR_SHARES_SQL = """
+    SELECT
+        CAST(:type_expense AS varchar) AS type_expense,
         de.registrar_id,
         gd.id AS goods_id,
         de.cost_category_id,
         wh.department_id,
         de.date,
         de.goods_doc_id,
-        ROUND(de.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY de.registrar_id, de.cost_category_id, de.goods_doc_id), 0), :precision) AS amount
-    FROM reg_direct_expenses AS de
+        ROUND(de.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY de.registrar_id, de.cost_category_id, de.goods_doc_id), 0), :precision) AS amount,
+        de.total_amount
+    FROM (
+        SELECT e.*, SUM(e.amount) OVER (PARTITION BY e.registrar_id, e.cost_category_id, e.goods_doc_id) AS total_amount
+        FROM reg_direct_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+    ) AS de
     JOIN doc_link_goods_transfers AS gt ON gt.transfer_id = de.goods_doc_id
     JOIN ref_goods AS gd ON gd.id = gt.goods_id
     JOIN doc_transfers AS tf ON tf.id = gt.transfer_id
     JOIN ref_warehouses AS wh ON tf.out_warehouse_id = wh.id
     WHERE gd.amount IS NOT NULL
-      AND de.date >= :mstart AND de.date < :mnext
 """
 
 
-# Распределение складских расходов
-ALLOC_WAREHOUSE_EXPENSES_SQL = """
-    CREATE TEMP TABLE tmp_table ON COMMIT DROP AS
+# Распределение складских расходов (по исходным таблицам)
+WAREHOUSE_EXPENSES_REGISTRAR_SHARES_SQL = """
     SELECT
-        'Складские расходы' AS type_expense,
+        CAST(:type_expense AS varchar) AS type_expense,
         we.registrar_id,
         gd.id AS goods_id,
         we.cost_category_id,
         we.department_id,
         we.date,
         NULL::uuid AS goods_doc_id,
-        ROUND(we.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY we.registrar_id), 0), :precision) AS amount
-    FROM reg_warehouse_expenses AS we
+        ROUND(we.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY we.registrar_id), 0), :precision) AS amount,
+        we.total_amount
+    FROM (
+        SELECT e.*, SUM(e.amount) OVER (PARTITION BY e.registrar_id, e.cost_category_id) AS total_amount
+        FROM reg_warehouse_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+    ) AS we
     JOIN ref_departments AS de ON de.id = we.department_id
     JOIN ref_warehouses AS wh ON wh.department_id = de.id
     JOIN reg_goods_location AS gl ON gl.sender_warehouse_id = wh.id
@@ -41,24 +206,28 @@ ALLOC_WAREHOUSE_EXPENSES_SQL = """
     JOIN doc_transfers AS tf ON tf.id = gl.registrar_id
     WHERE gl.goods_status = 2  -- отправление
       AND gd.amount IS NOT NULL
-      AND we.date >= :mstart AND we.date < :mnext
-      AND gl.date >= :mstart AND gl.date < :mnext   
+      AND gl.date >= :mstart AND gl.date < :mnext
 """
 
 
-# Распределение общих расходов
-ALLOC_GENERAL_EXPENSES_SQL = """
-    CREATE TEMP TABLE tmp_table ON COMMIT DROP AS
+# Распределение общих расходов (по исходным таблицам)
+GENERAL_EXPENSES_REGISTRAR_SHARES_SQL = """
     SELECT
-        'Общие расходы' AS type_expense,
+        CAST(:type_expense AS varchar) AS type_expense,
         ge.registrar_id,
         gd.id AS goods_id,
         ge.cost_category_id,
         wh_out.department_id,
         ge.date,
         NULL::uuid AS goods_doc_id,
-        ROUND(ge.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY ge.registrar_id), 0), :precision) AS amount
-    FROM reg_general_expenses AS ge
+        ROUND(ge.amount * gd.amount / NULLIF(SUM(gd.amount) OVER (PARTITION BY ge.registrar_id), 0), :precision) AS amount,
+        ge.total_amount
+    FROM (
+        SELECT e.*, SUM(e.amount) OVER (PARTITION BY e.registrar_id, e.cost_category_id) AS total_amount
+        FROM reg_general_expenses AS e
+        WHERE e.date >= :mstart AND e.date < :mnext
+          AND (CAST(:registrars AS uuid[]) IS NULL OR e.registrar_id = ANY(CAST(:registrars AS uuid[])))
+    ) AS ge
     JOIN doc_transfers AS tr
       ON tr.date >= :mstart AND tr.date < :mnext AND tr.type_transfer = 'Погрузка в машину'
     JOIN ref_warehouses AS wh_out ON tr.out_warehouse_id = wh_out.id
@@ -70,72 +239,44 @@ ALLOC_GENERAL_EXPENSES_SQL = """
     WHERE gd.amount IS NOT NULL
       AND cn_out.name = 'КИТАЙ'
       AND cn_in.name <> 'КИТАЙ'
-      AND ge.date >= :mstart AND ge.date < :mnext
-    ;
-
 """
 
-CREATE_VIEWS_SQL = """
--- v_part: ранжируем товары внутри ключа и считаем агрегаты
-CREATE TEMP VIEW v_part AS
-SELECT
-    t.type_expense,
-    t.registrar_id,
-    t.cost_category_id,
-    t.goods_doc_id,
-    t.goods_id,
-    t.amount,
-    ROW_NUMBER() OVER (
-        PARTITION BY t.type_expense, t.registrar_id, t.cost_category_id, t.goods_doc_id
-        ORDER BY t.amount DESC
-    ) AS rn,
-    COUNT(*) OVER (
-        PARTITION BY t.type_expense, t.registrar_id, t.cost_category_id, t.goods_doc_id
-    ) AS n,
-    SUM(t.amount) OVER (
-        PARTITION BY t.type_expense, t.registrar_id, t.cost_category_id, t.goods_doc_id
-    ) AS sum_rounded
-FROM tmp_table t;
-
-CREATE TEMP VIEW v_agg AS
-SELECT
-    p.type_expense,
-    p.registrar_id,
-    p.cost_category_id,
-    p.goods_doc_id,
-    MAX(p.sum_rounded) AS sum_rounded,
-    k.total_amount     AS total_amount
-FROM v_part p
-JOIN tmp_de_key_amount k
-  ON k.registrar_id     = p.registrar_id
- AND k.cost_category_id = p.cost_category_id
- AND ( (k.goods_doc_id IS NOT DISTINCT FROM p.goods_doc_id) )  
-GROUP BY p.type_expense, p.registrar_id, p.cost_category_id, p.goods_doc_id, k.total_amount;
-"""
 
-UPDATE_WITH_VIEWS_SQL = """
+DELETE_ALLOC_EXPENSES_SQL = """
+        DELETE FROM dm_goods_expense_alloc d
+        WHERE d.date >= :mstart AND d.date < :mnext
+        AND d.type_expense = :type_expense
+        AND (CAST(:registrars AS uuid[]) IS NULL OR d.registrar_id = ANY(CAST(:registrars AS uuid[])));
+    """
+
+
+# Распределение за один проход: доли {shares} ранжируются внутри ключа, погрешность
+# округления (total_amount - сумма долей) раскладывается по шагу :inc — по шагу на первые
+# товары по убыванию доли, остаток меньше шага — самому дорогому, — и строки пишутся сразу
+# в {target} (dm_goods_expense_alloc или новая партиция месяца).
+# При равных долях порядок фиксирует goods_id.
+ALLOC_EXPENSES_SQL = """
 WITH
+shares AS ({shares}),
+ranked AS (
+    SELECT
+        s.*,
+        ROW_NUMBER() OVER (
+            PARTITION BY s.registrar_id, s.cost_category_id, s.goods_doc_id
+            ORDER BY s.amount DESC, s.goods_id
+        ) AS rn,
+        COUNT(*) OVER k AS n,
+        SUM(s.amount) OVER k AS sum_rounded
+    FROM shares s
+    WINDOW k AS (PARTITION BY s.registrar_id, s.cost_category_id, s.goods_doc_id)
+),
 dist AS (
     SELECT
-        p.type_expense,
-        p.registrar_id,
-        p.cost_category_id,
-        p.goods_doc_id,
-        p.goods_id,
-        p.amount,
-        p.rn,
-        p.n,
-        a.total_amount,
-        a.sum_rounded,
-        (a.total_amount - a.sum_rounded)::numeric AS err,
-        CASE WHEN (a.total_amount - a.sum_rounded) >= 0 THEN 1 ELSE -1 END AS sgn,
+        r.*,
+        (r.total_amount - r.sum_rounded)::numeric AS err,
+        CASE WHEN (r.total_amount - r.sum_rounded) >= 0 THEN 1 ELSE -1 END AS sgn,
         (:inc)::numeric AS inc
-    FROM v_part p
-    JOIN v_agg  a
-      ON a.type_expense    = p.type_expense
-     AND a.registrar_id    = p.registrar_id
-     AND a.cost_category_id= p.cost_category_id
-     AND (a.goods_doc_id IS NOT DISTINCT FROM p.goods_doc_id) 
+    FROM ranked r
 ),
 calc AS (
     SELECT
@@ -143,49 +284,18 @@ calc AS (
         FLOOR( (ABS(d.err))::numeric / d.inc )::bigint AS k,
         GREATEST(ABS(d.err) - (FLOOR( (ABS(d.err))::numeric / d.inc )::numeric * d.inc), 0)::numeric AS extra
     FROM dist d
-),
-incr AS (
-    SELECT
-        c.type_expense,
-        c.registrar_id,
-        c.cost_category_id,
-        c.goods_doc_id,
-        c.goods_id,
-        (
-          c.sgn * (
+)
+INSERT INTO {target}
+(type_expense, registrar_id, goods_id, department_id, cost_category_id, date, amount)
+SELECT
+    c.type_expense, c.registrar_id, c.goods_id, c.department_id, c.cost_category_id, c.date,
+    sum(c.amount + (
+        c.sgn * (
             ((c.k / c.n) * c.inc) +
             (CASE WHEN (c.k % c.n) >= c.rn THEN c.inc ELSE 0 END) +
             (CASE WHEN c.rn = 1 THEN c.extra ELSE 0 END)
-          )
-        )::numeric AS delta
-    FROM calc c
-)
-UPDATE tmp_table u
-SET amount = (u.amount + i.delta)
-FROM incr i
-WHERE u.type_expense     = i.type_expense
-  AND u.registrar_id     = i.registrar_id
-  AND u.cost_category_id = i.cost_category_id
-  AND (u.goods_doc_id IS NOT DISTINCT FROM i.goods_doc_id) 
-  AND u.goods_id         = i.goods_id;
-"""
-
-DROP_VIEWS_SQL = """
-DROP VIEW IF EXISTS v_agg;
-DROP VIEW IF EXISTS v_part;
+        )
+    )::numeric)
+FROM calc c
+GROUP BY c.type_expense, c.registrar_id, c.goods_id, c.department_id, c.cost_category_id, c.date;
 """
-
-DELETE_ALLOC_EXPENSES_SQL = """
-        DELETE FROM dm_goods_expense_alloc d
-        WHERE d.date >= :mstart AND d.date < :mnext
-        AND d.type_expense IN (SELECT DISTINCT type_expense FROM tmp_table);
-    """
-
-
-INSERT_ALLOC_EXPENSES_SQL = """
-       INSERT INTO dm_goods_expense_alloc 
-       (type_expense, registrar_id, goods_id, department_id, cost_category_id, date, amount)
-       SELECT type_expense, registrar_id, goods_id, department_id, cost_category_id, date, sum(amount)
-       FROM tmp_table
-       group by type_expense, registrar_id, goods_id, department_id, cost_category_id, date;
-             """
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""
+Перевод обычной таблицы в партиционированную по месяцам без остановки загрузки.
+
+    1. рядом создаётся копия {table}__part: те же колонки, умолчания и первичный ключ,
+       PARTITION BY RANGE (key), месячные партиции под имеющиеся данные и DEFAULT
+       ({table}__part_{год}_{месяц}: до переключения процессы с новой моделью не должны
+       находить их по имени {table}_{год}_{месяц} и писать в копию мимо журнала);
+    2. триггер исходной таблицы пишет ключи изменённых строк в журнал {table}__changes;
+    3. строки копируются пачками по первичному ключу, каждая пачка — своей транзакцией;
+    4. журнал проигрывается пачками: строки с ключами из журнала удаляются из копии и
+       копируются заново в текущем виде, поэтому повтор и порядок записей не важны;
+    5. под короткой блокировкой исходной таблицы проигрывается остаток журнала, триггер
+       снимается, таблицы меняются именами, партиции копии получают имена {table}_…;
+       исходная удаляется.
+
+Запись в таблицу ждёт только шаг 5, чтение — только переименование. TRUNCATE исходной
+таблицы во время переноса журнал не видит. Если перенос прервался до переключения,
+копия, журнал и триггер удаляются (при ошибке — сразу, после падения процесса —
+при следующем запуске), исходная таблица остаётся как была.
+"""
+import logging
+from collections.abc import Sequence
+
+from sqlalchemy import Engine, text
+from sqlalchemy.engine import Connection
+
+from src.db.utils.partition_manager import (
+    PARTITIONS_SCHEMA,
+    ensure_default_partition,
+    ensure_month_partition_with_indexes,
+)
+from src.utils import iter_months
+
+log = logging.getLogger("app")
+
+COPY_BATCH_ROWS = 50_000  # строк исходной таблицы в пачке копирования
+REPLAY_BATCH_ROWS = 10_000  # записей журнала в пачке проигрывания
+CUTOVER_BACKLOG = 1_000  # записей журнала, которые допустимо проиграть под блокировкой
+CUTOVER_ATTEMPTS = 5  # попыток взять блокировку для переключения
+
+
+def _pk_columns(conn: Connection, schema: str, table: str) -> list[str]:
+    return conn.execute(text("""
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = CAST(:rel AS regclass) AND i.indisprimary
+        ORDER BY array_position(CAST(i.indkey AS int2[]), a.attnum)
+    """), {"rel": f'"{schema}"."{table}"'}).scalars().all()
+
+
+def _columns(columns: Sequence[str], alias: str = "") -> str:
+    return ", ".join(f'{alias}"{c}"' for c in columns)
+
+
+def _key_match(columns: Sequence[str], left: str, right: str) -> str:
+    return " AND ".join(f'{left}."{c}" = {right}."{c}"' for c in columns)
+
+
+def _prepare(conn: Connection, schema: str, table: str, key: str, pk: list[str]) -> int:
+    """Шаги 1–2: партиционированная копия с партициями и журнал с триггером. Возвращает число партиций."""
+    part, changes = f"{table}__part", f"{table}__changes"
+    conn.execute(text(
+        f'CREATE TABLE "{schema}"."{part}" (LIKE "{schema}"."{table}" INCLUDING DEFAULTS) PARTITION BY RANGE ("{key}")'
+    ))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{part}" ADD CONSTRAINT "{part}_pkey" PRIMARY KEY ({_columns(pk)})'))
+    ensure_default_partition(conn, schema, part, PARTITIONS_SCHEMA)
+    first, last = conn.execute(text(f'SELECT min("{key}"), max("{key}") FROM "{schema}"."{table}"')).one()
+    months = list(iter_months(first, last)) if first is not None else []
+    for mstart, _ in months:
+        ensure_month_partition_with_indexes(conn, schema, part, mstart.year, mstart.month)
+
+    conn.execute(text(
+        f'CREATE TABLE "{schema}"."{changes}" AS SELECT {_columns(pk)} FROM "{schema}"."{table}" WITH NO DATA'
+    ))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{changes}" ADD COLUMN id bigserial PRIMARY KEY'))
+    conn.execute(text(f"""
+        CREATE FUNCTION "{schema}"."{table}__log_change"() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO "{schema}"."{changes}" ({_columns(pk)}) VALUES ({_columns(pk, "OLD.")});
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO "{schema}"."{changes}" ({_columns(pk)}) VALUES ({_columns(pk, "NEW.")});
+            END IF;
+            RETURN NULL;
+        END $$
+    """))
+    # CREATE TRIGGER ждёт начатые транзакции записи: всё, что зафиксируется после, попадёт в журнал
+    conn.execute(text(
+        f'CREATE TRIGGER "{table}__log_change" AFTER INSERT OR UPDATE OR DELETE ON "{schema}"."{table}" '
+        f'FOR EACH ROW EXECUTE FUNCTION "{schema}"."{table}__log_change"()'
+    ))
+    return len(months) + 1
+
+
+def _copy_batches(engine: Engine, schema: str, table: str, pk: list[str], batch_rows: int) -> int:
+    """Шаг 3: копирование пачками по первичному ключу. Возвращает число скопированных строк."""
+    part = f"{table}__part"
+    keys = _columns(pk)
+    params = {f"k{i}": None for i in range(len(pk))}
+    lower = f"({keys}) > ({', '.join(f':k{i}' for i in range(len(pk)))})"
+    copied, first = 0, True
+    while True:
+        with engine.begin() as conn:
+            where = "true" if first else lower
+            upper = conn.execute(text(
+                f'SELECT {keys} FROM "{schema}"."{table}" WHERE {where} ORDER BY {keys} LIMIT 1 OFFSET :offset'
+            ), {**params, "offset": batch_rows - 1}).fetchone()
+            if upper is not None:
+                bound = {f"u{i}": v for i, v in enumerate(upper)}
+                where += f" AND ({keys}) <= ({', '.join(f':u{i}' for i in range(len(pk)))})"
+            else:
+                bound = {}
+            copied += conn.execute(text(
+                f'INSERT INTO "{schema}"."{part}" SELECT * FROM "{schema}"."{table}" WHERE {where} ON CONFLICT DO NOTHING'
+            ), {**params, **bound}).rowcount
+        if upper is None:
+            return copied
+        params = {f"k{i}": v for i, v in enumerate(upper)}
+        first = False
+        log.info("%s: скопировано %i строк", table, copied)
+
+
+def _replay(conn: Connection, schema: str, table: str, pk: list[str], batch_rows: int) -> int:
+    """
+    Шаг 4, одна пачка журнала в транзакции conn: строки с ключами из журнала приводятся
+    в копии к текущему виду исходной таблицы. Возвращает число обработанных записей журнала.
+    """
+    part, changes = f"{table}__part", f"{table}__changes"
+    replayed = conn.execute(text(f"""
+        CREATE TEMP TABLE replay_keys ON COMMIT DROP AS
+        WITH batch AS (
+            DELETE FROM "{schema}"."{changes}"
+            WHERE id IN (SELECT id FROM "{schema}"."{changes}" ORDER BY id LIMIT :n)
+            RETURNING {_columns(pk)}
+        )
+        SELECT DISTINCT {_columns(pk)} FROM batch
+    """), {"n": batch_rows}).rowcount
+    if replayed:
+        conn.execute(text(f'DELETE FROM "{schema}"."{part}" p USING replay_keys k WHERE {_key_match(pk, "p", "k")}'))
+        conn.execute(text(
+            f'INSERT INTO "{schema}"."{part}" SELECT t.* FROM "{schema}"."{table}" t '
+            f'JOIN replay_keys k ON {_key_match(pk, "t", "k")}'
+        ))
+    conn.execute(text("DROP TABLE replay_keys"))
+    return replayed
+
+
+def _cutover(conn: Connection, schema: str, table: str, pk: list[str], lock_timeout: str) -> int:
+    """Шаг 5: остаток журнала под блокировкой и обмен именами. Возвращает число проигранных записей."""
+    part, changes, old = f"{table}__part", f"{table}__changes", f"{table}__old"
+    conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+    conn.execute(text(f'LOCK TABLE "{schema}"."{table}" IN ACCESS EXCLUSIVE MODE'))
+    replayed = 0
+    while n := _replay(conn, schema, table, pk, REPLAY_BATCH_ROWS):
+        replayed += n
+    conn.execute(text(f'DROP TRIGGER "{table}__log_change" ON "{schema}"."{table}"'))
+    conn.execute(text(f'DROP FUNCTION "{schema}"."{table}__log_change"()'))
+    conn.execute(text(f'DROP TABLE "{schema}"."{changes}"'))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{table}" RENAME TO "{old}"'))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{old}" RENAME CONSTRAINT "{table}_pkey" TO "{old}_pkey"'))
+    # партиции копии и их индексы: {table}__part_… -> {table}_…
+    renames = conn.execute(text("""
+        SELECT n.nspname, c.relname, c.relkind = 'i'
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+                        OR c.oid IN (SELECT x.indexrelid FROM pg_index x WHERE x.indrelid = i.inhrelid)
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE i.inhparent = CAST(:rel AS regclass) AND starts_with(c.relname, :prefix)
+    """), {"rel": f'"{schema}"."{part}"', "prefix": f"{part}_"}).all()
+    for part_schema, name, is_index in renames:
+        kind = "INDEX" if is_index else "TABLE"
+        conn.execute(text(f'ALTER {kind} "{part_schema}"."{name}" RENAME TO "{table}{name[len(part):]}"'))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{part}" RENAME TO "{table}"'))
+    conn.execute(text(f'ALTER TABLE "{schema}"."{table}" RENAME CONSTRAINT "{part}_pkey" TO "{table}_pkey"'))
+    return replayed
+
+
+def _drop_shadow(engine: Engine, schema: str, table: str, lock_timeout: str) -> None:
+    """Удаляет копию, журнал и триггер незавершённого переноса (если они есть); исходная не меняется."""
+    with engine.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(text(f'DROP TRIGGER IF EXISTS "{table}__log_change" ON "{schema}"."{table}"'))
+        conn.execute(text(f'DROP FUNCTION IF EXISTS "{schema}"."{table}__log_change"()'))
+        conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table}__changes"'))
+        # партиции копии удаляются вместе с ней
+        conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table}__part"'))
+
+
+def convert_to_partitioned(
+        engine: Engine,
+        table: str,
+        key: str = "date",
+        schema: str = "public",
+        indexes: Sequence[str] = (),
+        batch_rows: int = COPY_BATCH_ROWS,
+        lock_timeout: str = "5s",
+) -> dict:
+    """
+    Переводит schema.table в партиционированную по месяцам key (RANGE) без остановки записи
+    (см. описание модуля). key должен входить в первичный ключ. indexes — CREATE INDEX
+    с {table} вместо имени таблицы: строятся на копии после переноса строк, до переключения.
+    Возвращает итог: партиций, скопировано строк, проиграно записей журнала.
+    """
+    # остатки прерванного запуска: копия и журнал неполны, перенос начинается заново
+    _drop_shadow(engine, schema, table, lock_timeout)
+    try:
+        with engine.begin() as conn:
+            pk = _pk_columns(conn, schema, table)
+            if key not in pk:
+                raise ValueError(f"{schema}.{table}: колонка {key} не входит в первичный ключ {pk}")
+            partitions = _prepare(conn, schema, table, key, pk)
+        log.info("%s: создана партиционированная копия (%i партиций), журнал изменений включён", table, partitions)
+
+        copied = _copy_batches(engine, schema, table, pk, batch_rows)
+        log.info("%s: скопировано %i строк", table, copied)
+
+        with engine.begin() as conn:
+            for ddl in indexes:
+                conn.execute(text(ddl.format(table=f'"{schema}"."{table}__part"')))
+            conn.execute(text(f'ANALYZE "{schema}"."{table}__part"'))
+
+        replayed = 0
+        while True:
+            with engine.begin() as conn:
+                n = _replay(conn, schema, table, pk, REPLAY_BATCH_ROWS)
+            replayed += n
+            if n < CUTOVER_BACKLOG:
+                break
+
+        for attempt in range(1, CUTOVER_ATTEMPTS + 1):
+            try:
+                with engine.begin() as conn:
+                    replayed += _cutover(conn, schema, table, pk, lock_timeout)
+                break
+            except Exception as e:
+                if attempt == CUTOVER_ATTEMPTS:
+                    raise
+                log.warning("%s: переключение не удалось (%s), повтор %i", table, e, attempt + 1)
+                with engine.begin() as conn:
+                    replayed += _replay(conn, schema, table, pk, REPLAY_BATCH_ROWS)
+    except BaseException:
+        log.exception("%s: перенос прерван, копия и журнал удаляются", table)
+        try:
+            _drop_shadow(engine, schema, table, lock_timeout)
+        except Exception:
+            log.exception("%s: копия не удалена, её удалит следующий запуск", table)
+        raise
+    log.info("%s: переключена на партиционированную таблицу, проиграно записей журнала: %i", table, replayed)
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+            conn.execute(text(f'DROP TABLE "{schema}"."{table}__old"'))
+    except Exception as e:
+        log.warning("%s: прежняя таблица %s__old не удалена, удалите её вручную: %s", table, table, e)
+    return {"partitions": partitions, "copied": copied, "replayed": replayed}
@@ -1,19 +1,28 @@
 from __future__ import annotations
+import logging
+import time
 from datetime import date, datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.engine import Connection
 
 from src.db.db import engine
 from src.db import models as app_models  # noqa
 from sqlmodel import SQLModel
 
+log = logging.getLogger("app")
+
 
 # ---------- helpers ----------
 
 PARTITIONS_SCHEMA = "partitions"  # здесь будут жить дочерние партиции
 
+SWAP_LOCK_TIMEOUT = "2s"  # сколько DETACH ждёт блокировку родителя (и держит в очереди его читателей)
+SWAP_ATTEMPTS = 3  # попыток подмены партиции, пока её ждут начатые запросы
+LOCK_NOT_AVAILABLE = "55P03"  # SQLSTATE: lock_timeout истёк
+
 def ensure_schema_exists(conn: Connection, schema: str) -> None:
     conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema};"))
 
@@ -22,6 +31,9 @@ def month_bounds(year: int, month: int) -> Tuple[date, date]:
     end = date(year + (month // 12), (month % 12) + 1, 1)
     return start, end
 
+def month_partition_name(parent: str, year: int, month: int) -> str:
+    return f"{parent}_{year}_{month:02d}"
+
 def table_is_partitioned_parent_in_models(table) -> bool:
     """Проверка по моделям: наличие декларативного партиционирования."""
     po = table.dialect_options.get("postgresql") if hasattr(table, "dialect_options") else {}
@@ -61,9 +73,9 @@ def ensure_default_partition(conn: Connection, parent_schema: str, parent: str,
           );
         END $$;
         """), {"child_schema": child_schema, "part": part_name, "parent_schema": parent_schema, "parent": parent})
-        print(f"[OK] DEFAULT партиция создана: {child_schema}.{part_name} (родитель {parent_schema}.{parent})")
+        log.info("DEFAULT партиция создана: %s.%s (родитель %s.%s)", child_schema, part_name, parent_schema, parent)
     else:
-        print(f"[=] DEFAULT партиция уже есть: {child_schema}.{part_name}")
+        log.debug("DEFAULT партиция уже есть: %s.%s", child_schema, part_name)
 
     return part_name
 
@@ -75,9 +87,17 @@ def ensure_month_partition_with_indexes(
     month: int,
     child_schema: str = PARTITIONS_SCHEMA,
 ) -> str:
-    """Создаёт месячную партицию в схеме child_schema и прикрепляет к parent_schema.parent"""
+    """
+    Создаёт месячную партицию в схеме child_schema и прикрепляет к parent_schema.parent.
+
+    Партиция создаётся отдельной таблицей и прикрепляется ATTACH PARTITION: он берёт на
+    parent только SHARE UPDATE EXCLUSIVE (CREATE TABLE ... PARTITION OF — ACCESS EXCLUSIVE,
+    то есть ждёт и блокирует всех читателей родителя). ACCESS EXCLUSIVE остаётся только
+    на DEFAULT-партицию: ATTACH проверяет, что в ней нет строк месяца. Индексы родителя
+    строятся на пустой таблице при прикреплении.
+    """
     ensure_schema_exists(conn, child_schema)
-    part_name = f"{parent}_{year}_{month:02d}"
+    part_name = month_partition_name(parent, year, month)
 
     exists = conn.execute(text("""
         SELECT 1 FROM pg_class c
@@ -92,8 +112,12 @@ def ensure_month_partition_with_indexes(
         DO $$
         BEGIN
           EXECUTE format(
-            'CREATE TABLE %I.%I PARTITION OF %I.%I FOR VALUES FROM (''%s'') TO (''%s'')',
-            :child_schema, :part, :parent_schema, :parent, :mstart, :mnext
+            'CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+            :child_schema, :part, :parent_schema, :parent
+          );
+          EXECUTE format(
+            'ALTER TABLE %I.%I ATTACH PARTITION %I.%I FOR VALUES FROM (''%s'') TO (''%s'')',
+            :parent_schema, :parent, :child_schema, :part, :mstart, :mnext
           );
         END $$;
         """), {
@@ -104,9 +128,12 @@ def ensure_month_partition_with_indexes(
             "mstart": mstart,
             "mnext": mnext
         })
-        print(f"[OK] Создана партиция: {child_schema}.{part_name} [{mstart} .. {mnext}) → родитель {parent_schema}.{parent}")
+        log.info(
+            "Создана партиция: %s.%s [%s .. %s) → родитель %s.%s",
+            child_schema, part_name, mstart, mnext, parent_schema, parent,
+        )
     else:
-        print(f"[=] Партиция уже есть: {child_schema}.{part_name}")
+        log.debug("Партиция уже есть: %s.%s", child_schema, part_name)
 
     return part_name
 
@@ -131,6 +158,7 @@ def list_partitioned_indexes_on_parent(conn: Connection, schema: str, parent: st
       ic.relname AS index_name,
       a.attname  AS column_name,
       i.indisunique AS is_unique,
+      i.indisprimary AS is_primary,
       i.indnkeyatts
     FROM pg_index i
     JOIN pg_class ic ON ic.oid = i.indexrelid
@@ -142,17 +170,115 @@ def list_partitioned_indexes_on_parent(conn: Connection, schema: str, parent: st
       AND tc.relname = :parent
       AND i.indisvalid = TRUE
       AND i.indisready = TRUE
-      AND i.indispartition = FALSE
+      AND ic.relispartition = FALSE
     ORDER BY ic.relname, k.ord
     """), {"schema": schema, "parent": parent}).fetchall()
 
     out: Dict[str, Dict] = {}
     for r in rows:
-        info = out.setdefault(r.index_name, {"name": r.index_name, "column_names": [], "unique": r.is_unique})
+        info = out.setdefault(r.index_name, {
+            "name": r.index_name, "column_names": [], "unique": r.is_unique, "primary": r.is_primary,
+        })
         info["column_names"].append(r.column_name)
     return list(out.values())
 
 
+def create_parent_indexes(conn: Connection, parent_schema: str, parent: str, child_schema: str, table: str) -> None:
+    """
+    Создаёт на отдельной таблице child_schema.table индексы (и первичный ключ), как у родителя:
+    при ATTACH PARTITION они прикрепляются к индексам родителя, а не строятся заново под блокировкой.
+    Имена — имя индекса родителя с номером транзакции: не совпадают с индексами других
+    таблиц схемы, в том числе созданными параллельными, ещё не зафиксированными транзакциями.
+    """
+    txid = conn.execute(text("SELECT txid_current()")).scalar()
+    for idx in list_partitioned_indexes_on_parent(conn, parent_schema, parent):
+        name = f'{idx["name"][:48]}_{txid}'
+        cols = ", ".join(f'"{c}"' for c in idx["column_names"])
+        if idx["primary"]:
+            conn.execute(text(f'ALTER TABLE "{child_schema}"."{table}" ADD CONSTRAINT "{name}" PRIMARY KEY ({cols})'))
+        else:
+            unique = "UNIQUE " if idx["unique"] else ""
+            conn.execute(text(f'CREATE {unique}INDEX "{name}" ON "{child_schema}"."{table}" ({cols})'))
+
+def swap_month_partition(
+    conn: Connection,
+    parent_schema: str,
+    parent: str,
+    staging: str,
+    year: int,
+    month: int,
+    key: str = "date",
+    child_schema: str = PARTITIONS_SCHEMA,
+    lock_timeout: str = SWAP_LOCK_TIMEOUT,
+    attempts: int = SWAP_ATTEMPTS,
+) -> Optional[str]:
+    """
+    Подменяет месячную партицию parent таблицей child_schema.staging (те же колонки
+    и индексы, create_parent_indexes): DETACH текущей, переименования, ATTACH новой —
+    в транзакции conn, читатели после COMMIT видят сразу новый месяц.
+    Отключённая партиция переименовывается в <партиция>_old_<n> и остаётся для
+    drop_retired_partitions. Возвращает её имя.
+
+    DETACH берёт ACCESS EXCLUSIVE на весь parent: пока он ждёт долгий запрос, за ним
+    встают читатели всех месяцев. Поэтому ожидание ограничено lock_timeout, подмена
+    повторяется attempts раз (в точке сохранения conn); не удалось — None, staging остаётся.
+    """
+    part_name = month_partition_name(parent, year, month)
+    retired = f"{part_name}_old_{int(datetime.now().timestamp() * 1000)}"
+    mstart, mnext = month_bounds(year, month)
+    # CHECK по границам месяца: ATTACH не сканирует таблицу для проверки
+    conn.execute(text(
+        f'ALTER TABLE "{child_schema}"."{staging}" ADD CONSTRAINT swap_bounds '
+        f"CHECK (\"{key}\" IS NOT NULL AND \"{key}\" >= '{mstart}' AND \"{key}\" < '{mnext}')"
+    ))
+    for attempt in range(1, attempts + 1):
+        try:
+            with conn.begin_nested():
+                conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                conn.execute(text(
+                    f'ALTER TABLE "{parent_schema}"."{parent}" DETACH PARTITION "{child_schema}"."{part_name}"'
+                ))
+                conn.execute(text(f'ALTER TABLE "{child_schema}"."{part_name}" RENAME TO "{retired}"'))
+                conn.execute(text(f'ALTER TABLE "{child_schema}"."{staging}" RENAME TO "{part_name}"'))
+                conn.execute(text(
+                    f'ALTER TABLE "{parent_schema}"."{parent}" ATTACH PARTITION "{child_schema}"."{part_name}" '
+                    f"FOR VALUES FROM ('{mstart}') TO ('{mnext}')"
+                ))
+                conn.execute(text(f'ALTER TABLE "{child_schema}"."{part_name}" DROP CONSTRAINT swap_bounds'))
+            return retired
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                raise
+            log.warning("Подмена партиции %s.%s: блокировка %s не получена (попытка %i из %i)",
+                        child_schema, part_name, parent, attempt, attempts)
+            time.sleep(attempt)
+    return None
+
+def drop_retired_partitions(parent: str, child_schema: str = PARTITIONS_SCHEMA, lock_timeout: str = "1s") -> list[str]:
+    """
+    Удаляет отключённые swap_month_partition партиции parent, каждую своей транзакцией.
+    Партиция, которую ещё читает начатый до подмены запрос, пропускается
+    (lock_timeout) и удаляется следующим вызовом. Возвращает удалённые.
+    """
+    with engine.begin() as conn:
+        names = conn.execute(text("""
+            SELECT c.relname FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relkind = 'r' AND NOT c.relispartition
+              AND c.relname LIKE :pattern
+        """), {"schema": child_schema, "pattern": f"{parent}\\_%\\_old\\_%"}).scalars().all()
+    dropped = []
+    for name in names:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                conn.execute(text(f'DROP TABLE IF EXISTS "{child_schema}"."{name}"'))
+            dropped.append(name)
+        except Exception as e:
+            log.warning("Отключённая партиция %s.%s не удалена: %s", child_schema, name, e)
+    return dropped
+
+
 # ---------- main ----------
 
 def create_year_partitions(year = datetime.now().year) -> None:
@@ -194,4 +320,5 @@ def create_year_partitions(year = datetime.now().year) -> None:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     create_year_partitions(datetime.now().year)
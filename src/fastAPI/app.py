@@ -1,15 +1,30 @@
 import secrets
+import uuid
+from contextlib import asynccontextmanager
 from datetime import date
-from typing import Any, Dict, List, Annotated
-import json
+from tempfile import SpooledTemporaryFile
+from typing import Annotated
 
-from fastapi import FastAPI, HTTPException, Query, Depends, status
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import JSONResponse
 
-from src.db.dags import recalc_period_by_months
-from src.db.db import engine, delete_with_cascade
-from src.handlers.handel_message import handle_json, MetadataNotRegistered, DataFormatError
+from src.db.dags import recalc_dirty, recalc_period_by_months
+from src.db.db import engine
+from src.db.fingerprints import (
+    FP_DONE, claim_fingerprint, finish_fingerprint, package_digest, purge_fingerprints, release_fingerprint,
+)
+from src.db.jobs import get_job, request_cancel
+from src.db.parallel_ingest import recover_prepared
+from src.handlers.cascade_jobs import cascade_metrics, cascade_workers, schedule_cascade, schedule_cascade_for
+from src.handlers.handel_message import handle_json_stream, MetadataNotRegistered, DataFormatError
+from src.handlers.ingest_jobs import enqueue_package, ingest_workers
+from src.handlers.recalc_jobs import RECALC_JOB, recalc_workers, schedule_recalc
+from src.handlers.row_stream import UnsupportedPackageFormat, row_format
+from src.handlers.json_stream import (
+    UnsupportedContentEncoding, content_encoding, iter_decoded_chunks, iter_file_chunks,
+)
 from src.config import basic_auth
 
 from fastapi.staticfiles import StaticFiles
@@ -18,9 +33,42 @@ from pathlib import Path
 import logging
 log = logging.getLogger("app")
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    purge_fingerprints()
+    recover_prepared()  # до воркеров: брошенные 2PC-транзакции держат блокировки таблиц
+    ingest_workers.start()
+    cascade_workers.start()
+    recalc_workers.start()
+    if cascade_metrics()["backlog"]:
+        schedule_cascade()  # удаления, оставшиеся с прошлого запуска
+    yield
+    ingest_workers.stop(timeout=30)
+    cascade_workers.stop(timeout=30)
+    recalc_workers.stop(timeout=30)
+
+
+app = FastAPI(lifespan=lifespan)
 security = HTTPBasic()
 
+SPOOL_MAX_SIZE = 8 * 1024 * 1024  # тело запроса больше этого размера сбрасывается во временный файл
+
+PACKAGE_BODY_SCHEMA = {
+    "required": True,
+    "content": {"application/json": {"schema": {"type": "array", "items": {"type": "object"}}}},
+}
+
+
+ROWS_BODY_SCHEMA = {
+    "required": True,
+    "content": {
+        "application/x-ndjson": {"schema": {"type": "string"}},
+        "application/x-msgpack": {"schema": {"type": "string", "format": "binary"}},
+    },
+}
+
 
 def get_current_user(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
     if not (secrets.compare_digest(credentials.username, basic_auth.USER) and
@@ -33,19 +81,97 @@ def get_current_user(credentials: Annotated[HTTPBasicCredentials, Depends(securi
     return credentials.username
 
 
-@app.post("/load_data", summary="Принять JSON-список и передать в handle_json")
-def load_data(
-        json_data: List[Dict[str, Any]],
-        _user: str = Depends(get_current_user),
-):
+async def spool_body(request: Request, digest=None) -> SpooledTemporaryFile:
+    """
+    Читает тело запроса кусками в буфер, который при росте уходит на диск.
+    digest — хеш (hashlib), в который попутно дописывается тело.
+    Буфер закрывает вызывающий; если чтение оборвалось, он закрывается здесь.
+    """
+    body = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)  # noqa: SIM115 — владение передаётся вызывающему
+    try:
+        async for chunk in request.stream():
+            body.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+        body.seek(0)
+    except BaseException:
+        body.close()
+        raise
+    return body
+
+
+def accepted_response(job_id: uuid.UUID, status_url: str | None = None, **extra) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={
+            "status": "accepted", "job_id": str(job_id), "status_url": status_url or f"/load_data/{job_id}", **extra,
+        },
+    )
+
+
+def duplicate_response(seen: dict) -> JSONResponse:
+    """Ответ на повтор пакета из журнала отпечатков — как на исходный приём."""
+    if seen["status"] == FP_DONE:
+        result = seen["result"] or {}
+        content = {
+            "status": "ok", "detail": "Пакет уже загружен (повтор)", "duplicate": True,
+            "items": result.get("templates"), "rows": result.get("rows"),
+        }
+        if seen["job_id"] is not None:
+            content["job_id"] = str(seen["job_id"])
+        return JSONResponse(status_code=200, content=content)
+    if seen["job_id"] is not None:
+        return accepted_response(seen["job_id"], duplicate=True)
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Этот пакет уже обрабатывается, повторите позже")
+
+
+async def ingest_body(request: Request, sync: bool, package_format: str = "json"):
     """
-    Принять JSON-список и передать в handle_json.
+    Общая часть /load_data и /load_data/rows: по умолчанию пакет сохраняется в очередь
+    и сразу возвращается 202 с id задачи, sync — обработка потоково в самом запросе.
+    Тело может быть сжато (Content-Encoding: gzip или zstd): оно хранится сжатым
+    и распаковывается кусками прямо в разборщик.
+    Повтор уже принятого пакета подтверждается по журналу отпечатков без загрузки
+    (ответ с "duplicate": true).
     """
     try:
-        handle_json(json.dumps(json_data, ensure_ascii=False).encode("utf-8"))
-        log.info("Данные успешно обработаны: %s", len(json_data))
-        delete_with_cascade()
-        return {"status": "ok", "detail": "Данные успешно обработаны", "items": len(json_data), }
+        encoding = content_encoding(request.headers.get("content-encoding"))
+    except UnsupportedContentEncoding as e:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e)) from e
+
+    claimed = None  # отпечаток, заявленный этим запросом: при ошибке запись журнала снимается
+    try:
+        digest = package_digest(package_format, encoding)
+        with await spool_body(request, digest) as body:
+            fingerprint = digest.hexdigest()
+            job_id = None if sync else uuid.uuid4()
+            seen = await run_in_threadpool(claim_fingerprint, fingerprint, job_id)
+            if seen is not None:
+                log.info("Повтор пакета, загрузка пропущена: %s", seen["job_id"] or "sync")
+                return duplicate_response(seen)
+            claimed = fingerprint
+
+            if not sync:
+                await run_in_threadpool(
+                    enqueue_package, iter_file_chunks(body), encoding, package_format, job_id, fingerprint,
+                )
+                claimed = None  # дальше журнал отмечает воркер
+                return accepted_response(job_id)
+
+            stats = await run_in_threadpool(
+                handle_json_stream, iter_decoded_chunks(body, encoding), package_format=package_format,
+            )
+        log.info("Данные успешно обработаны: %s", stats.templates)
+        await run_in_threadpool(finish_fingerprint, claimed, stats.as_dict())
+        claimed = None
+        content = {"status": "ok", "detail": "Данные успешно обработаны", "items": stats.templates, "rows": stats.rows_dict()}
+        cascade_job = await run_in_threadpool(schedule_cascade_for, stats.rows)
+        if cascade_job is not None:
+            content["cascade_job"] = str(cascade_job)
+        return JSONResponse(
+            status_code=200,
+            content=content,
+        )
 
     except MetadataNotRegistered as e:
         log.warning("Ошибка метаданных: %s", e)
@@ -59,29 +185,148 @@ def load_data(
         raise
 
     except Exception as e:
-        log.exception("Необработанная ошибка в /load_data")
+        log.exception("Необработанная ошибка в %s", request.url.path)
         return JSONResponse(
             status_code=400,
             content={"status": "error", "detail": str(e)}
         )
 
+    finally:
+        if claimed is not None:
+            await run_in_threadpool(release_fingerprint, claimed)
+
 
-@app.post("/costs/recalculate")
+@app.post(
+    "/load_data",
+    summary="Принять JSON-список пакета 1С",
+    openapi_extra={"requestBody": PACKAGE_BODY_SCHEMA},
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def load_data(
+        request: Request,
+        sync: bool = Query(False, description="Обработать пакет в запросе (старый режим) вместо постановки в очередь"),
+        _user: str = Depends(get_current_user),
+):
+    """
+    По умолчанию пакет сохраняется в очередь и сразу возвращается 202 с id задачи;
+    статус и итог обработки — GET /load_data/{job_id}.
+    sync=true — обработать пакет потоково в самом запросе: тело не разбирается целиком в память,
+    шаблоны передаются в БД по мере чтения.
+    Тело может быть сжато (Content-Encoding: gzip или zstd).
+    """
+    return await ingest_body(request, sync)
+
+
+@app.post(
+    "/load_data/rows",
+    summary="Принять пакет 1С построчно (NDJSON или msgpack)",
+    openapi_extra={"requestBody": ROWS_BODY_SCHEMA},
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def load_data_rows(
+        request: Request,
+        sync: bool = Query(False, description="Обработать пакет в запросе вместо постановки в очередь"),
+        _user: str = Depends(get_current_user),
+):
+    """
+    Тот же пакет, что и /load_data, в компактном построчном виде: заголовок шаблона
+    {"НаименованиеМетаданных": ..., "Колонки": [алиасы]} и затем строки-массивы значений.
+    Content-Type: application/x-ndjson (запись на строку) или application/x-msgpack.
+    Ответы, очередь, сжатие и семантика загрузки — как у /load_data.
+    """
+    try:
+        package_format = row_format(request.headers.get("content-type"))
+    except UnsupportedPackageFormat as e:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e)) from e
+    return await ingest_body(request, sync, package_format)
+
+
+@app.get("/load_data/{job_id}", summary="Статус задачи загрузки пакета")
+def load_data_status(
+        job_id: uuid.UUID,
+        _user: str = Depends(get_current_user),
+):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+
+@app.get("/cascade/metrics", summary="Очередь каскадного удаления: размер и задержка")
+def cascade_status(
+        _user: str = Depends(get_current_user),
+):
+    return cascade_metrics()
+
+
+@app.post("/costs/recalculate", status_code=status.HTTP_202_ACCEPTED)
 def costs_recalculate(
         start_date: date = Query(..., description="Дата начала, формат YYYY-MM-DD"),
         end_date: date = Query(..., description="Дата конца, формат YYYY-MM-DD"),
+        sync: bool = Query(False, description="Пересчитать в запросе (старый режим) вместо постановки в очередь"),
         _user: str = Depends(get_current_user),
 ):
-
+    """
+    По умолчанию пересчёт ставится в очередь и сразу возвращается 202 с id задачи;
+    ход по месяцам и типам расходов — GET /costs/recalculate/{job_id}, отмена —
+    POST /costs/recalculate/{job_id}/cancel. Если пересчёт уже ждёт в очереди,
+    месяцы добавляются в него ("coalesced": true).
+    sync=true — пересчитать в самом запросе.
+    """
     if start_date > end_date:
         raise HTTPException(status_code=400, detail="Стартовый месяц позже конечного.")
+    if not sync:
+        job_id, coalesced = schedule_recalc(start_date, end_date)
+        return accepted_response(job_id, status_url=f"/costs/recalculate/{job_id}", coalesced=coalesced)
     try:
         result = recalc_period_by_months(engine, start_date, end_date)
-        return {"status": "ok", "months": result}
+        return JSONResponse(status_code=200, content={"status": "ok", "months": result})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка расчёта: {e}")
 
 
+def get_recalc_job(job_id: uuid.UUID) -> dict:
+    job = get_job(job_id)
+    if job is None or job["kind"] != RECALC_JOB:
+        raise HTTPException(status_code=404, detail="Задача пересчёта не найдена")
+    return job
+
+
+@app.get("/costs/recalculate/{job_id}", summary="Статус и ход задачи пересчёта")
+def costs_recalculate_status(
+        job_id: uuid.UUID,
+        _user: str = Depends(get_current_user),
+):
+    return get_recalc_job(job_id)
+
+
+@app.post("/costs/recalculate/{job_id}/cancel", summary="Отменить задачу пересчёта")
+def costs_recalculate_cancel(
+        job_id: uuid.UUID,
+        _user: str = Depends(get_current_user),
+):
+    """
+    Задача из очереди отменяется сразу; у выполняемой уже начатые пары (месяц, тип)
+    доводятся до конца, остальные не считаются.
+    """
+    job = get_recalc_job(job_id)
+    job_status = request_cancel(job_id)
+    if job_status is None:
+        raise HTTPException(status_code=409, detail=f"Задача уже завершена ({job['status']})")
+    return {"status": job_status, "job_id": str(job_id), "cancel_requested": True}
+
+
+@app.post("/costs/recalculate/dirty", summary="Пересчёт только изменённых месяцев (журнал recalc_dirty)")
+def costs_recalculate_dirty(
+        _user: str = Depends(get_current_user),
+):
+    try:
+        result = recalc_dirty(engine)
+        return {"status": "ok", "months": result}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка расчёта: {e}") from e
+
+
 STATIC_DIR = Path(__file__).resolve().parents[1] / "html"  # -> src/html
 app.mount("/ui", StaticFiles(directory=str(STATIC_DIR), html=True), name="ui")
 
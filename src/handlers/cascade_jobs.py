@@ -0,0 +1,94 @@
+"""
+Каскадное удаление в фоне: загрузка пакета не вызывает delete_with_cascade сама,
+а ставит задачу cascade в очередь bg_job — и только если в пакете был шаблон
+ТП_ДанныеНаУдаление.
+
+Всплески пакетов схлопываются: пока в очереди есть невзятая задача cascade,
+новая не ставится (она и так заберёт все накопившиеся удаления). Метрики — размер
+очереди deleted_object и возраст самого старого удаления (cascade_metrics).
+"""
+import logging
+import uuid
+
+from sqlalchemy import text
+
+from src.db.db import delete_with_cascade, engine
+from src.db.jobs import JOB_DONE, JOB_QUEUED, JOB_RUNNING, JobWorkerPool
+from src.utils import timed
+
+log = logging.getLogger("app")
+
+CASCADE_JOB = "cascade"
+DELETED_OBJECTS_META = "ТП_ДанныеНаУдаление"
+
+
+def schedule_cascade() -> uuid.UUID:
+    """
+    Ставит задачу каскадного удаления, если такой ещё нет в очереди.
+    Возвращает id новой или уже ожидающей задачи.
+    """
+    q = text("""
+        insert into bg_job(id, kind, status)
+        select :id, :kind, :queued
+        where not exists (select 1 from bg_job where kind = :kind and status = :queued)
+        returning id
+    """)
+    with engine.begin() as conn:
+        # параллельные вызовы не должны поставить две задачи разом
+        conn.execute(text("select pg_advisory_xact_lock(hashtext(:kind))"), {"kind": CASCADE_JOB})
+        job_id = conn.execute(q, {"id": uuid.uuid4(), "kind": CASCADE_JOB, "queued": JOB_QUEUED}).scalar()
+        if job_id is None:
+            job_id = conn.execute(
+                text("select id from bg_job where kind = :kind and status = :queued order by created_at limit 1"),
+                {"kind": CASCADE_JOB, "queued": JOB_QUEUED},
+            ).scalar()
+        else:
+            log.info("Поставлено каскадное удаление: %s", job_id)
+    cascade_workers.notify()
+    return job_id
+
+
+def schedule_cascade_for(name_metas) -> uuid.UUID | None:
+    """Задача каскадного удаления, если среди загруженных шаблонов есть ТП_ДанныеНаУдаление."""
+    return schedule_cascade() if DELETED_OBJECTS_META in name_metas else None
+
+
+def cascade_metrics() -> dict:
+    """Очередь удалений: сколько объектов ждёт, возраст самого старого, состояние задач cascade."""
+    q = text("""
+        select
+            (select count(*) from deleted_object) as backlog,
+            (select extract(epoch from now() - min(created_at))::float8 from deleted_object) as lag_sec,
+            (select count(*) from bg_job where kind = :kind and status = :queued) as jobs_queued,
+            (select count(*) from bg_job where kind = :kind and status = :running) as jobs_running,
+            last.finished_at as last_finished_at,
+            extract(epoch from last.finished_at - last.created_at)::float8 as last_latency_sec,
+            last.result as last_result
+        from (select 1) one
+        left join lateral (
+            select finished_at, created_at, result from bg_job
+            where kind = :kind and status = :done
+            order by finished_at desc limit 1
+        ) last on true
+    """)
+    with engine.begin() as conn:
+        row = conn.execute(
+            q, {"kind": CASCADE_JOB, "queued": JOB_QUEUED, "running": JOB_RUNNING, "done": JOB_DONE},
+        ).mappings().one()
+    return dict(row)
+
+
+def process_cascade(job_id: uuid.UUID, payload: bytes | None, params: dict | None) -> dict:
+    """Задача cascade: удаляет всё, что накопилось в deleted_object."""
+    metrics = cascade_metrics()
+    deleted, sec = timed(delete_with_cascade)
+    return {
+        "deleted": deleted,
+        "backlog_before": metrics["backlog"],
+        "lag_sec": round(metrics["lag_sec"], 3) if metrics["lag_sec"] is not None else None,
+        "timings": {"cascade_sec": round(sec, 3)},
+    }
+
+
+# удаления применяются одним воркером: пачки всё равно забираются через SKIP LOCKED
+cascade_workers = JobWorkerPool(CASCADE_JOB, process_cascade, 1, needs_payload=False)
@@ -1,25 +1,127 @@
-import json
+"""
+Первичная загрузка выгрузки 1С из файлов src/data/*.json.
+
+    python -m src.handlers.first_load_data [--path DIR] [--workers 4] [--restart]
+
+Файлы обрабатываются параллельно пулом процессов, каждый файл разбирается потоково
+ровно один раз. Шаблоны фиксируются транзакциями примерно по CHECKPOINT_ROWS строк
+вместе с чекпоинтом каждого шаблона в load_checkpoint, поэтому прерванная загрузка
+при повторном запуске продолжается с первого незаписанного шаблона, а загруженные
+файлы пропускаются.
+Файлы не должны пересекаться по ключам: порядок между файлами не гарантируется.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from src.logger.logger import setup_logging
 setup_logging()
-from src.handlers.handel_message import handle_json
+from src.db.checkpoints import FILE_DONE, get_file_checkpoints, reset_file, save_checkpoint
+from src.db.db import delete_with_cascade, engine, ingest_session
+from src.handlers.handel_message import iter_package
+from src.handlers.json_stream import iter_file_chunks
 import logging
 log = logging.getLogger("app")
 FILES_PATH = Path(__file__).parent.parent / "data" # папка с json файлами
+LOAD_WORKERS = 4  # процессов по умолчанию
+CHECKPOINT_ROWS = 50_000  # строк в одной транзакции (между чекпоинтами)
+
+
+def _init_worker() -> None:
+    # соединения пула родителя не переиспользуем
+    engine.dispose(close=False)
+
+
+def load_file(file_path: str, restart: bool = False) -> dict:
+    """Загружает один файл, пропуская уже записанные шаблоны. Возвращает сводку по файлу."""
+    path = Path(file_path)
+    stat = path.stat()
+    file_name, file_size, file_mtime = path.name, stat.st_size, stat.st_mtime
+    if restart:
+        reset_file(file_name)
+    done = get_file_checkpoints(file_name, file_size, file_mtime)
+    summary = {"file": file_name, "bytes": file_size, "templates": 0, "resumed": 0, "rows": 0, "sec": 0.0}
+    if FILE_DONE in done:
+        summary["resumed"] = None
+        return summary
+
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        templates = enumerate(iter_package(iter_file_chunks(f)))
+        finished = False
+        while not finished:
+            # шаблоны коммитятся группами примерно по CHECKPOINT_ROWS строк
+            with ingest_session() as session:
+                rows_in_tx = 0
+                for index, (name_meta, dataModel, items) in templates:
+                    if index in done:
+                        # строки уже в БД — парсер пропустит их сам
+                        summary["resumed"] += 1
+                        continue
+                    stats = session.replace_scope(dataModel, items)
+                    save_checkpoint(session.conn, file_name, file_size, file_mtime, index, name_meta, stats.rows)
+                    summary["templates"] += 1
+                    summary["rows"] += stats.rows
+                    rows_in_tx += stats.rows
+                    if rows_in_tx >= CHECKPOINT_ROWS:
+                        break
+                else:
+                    finished = True
+
+    with engine.begin() as conn:
+        save_checkpoint(conn, file_name, file_size, file_mtime, FILE_DONE, rows=summary["rows"])
+    summary["sec"] = time.perf_counter() - start
+    return summary
+
+
+def firstLoadData(path: Path, workers: int = LOAD_WORKERS, restart: bool = False) -> None:
+    files = sorted(str(p) for p in path.glob("*.json"))
+    if not files:
+        log.info("Нет файлов для загрузки в %s", path)
+        return
+
+    start = time.perf_counter()
+    results, failed = [], []
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(files)), mp_context=ctx, initializer=_init_worker) as pool:
+        futures = {pool.submit(load_file, f, restart): f for f in files}
+        for future in as_completed(futures):
+            name = Path(futures[future]).name
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed.append(name)
+                log.error("Ошибка в обработке файла : %s , %s ", name, e)
+                continue
+            results.append(summary)
+            if summary["resumed"] is None:
+                log.info("Файл уже загружен, пропущен: %s", name)
+            else:
+                log.info(
+                    "Файл успешно обработан: %s (шаблонов %i, из чекпоинта %i, строк %i, %.1f c)",
+                    name, summary["templates"], summary["resumed"], summary["rows"], summary["sec"],
+                )
 
+    delete_with_cascade()
 
-def firstLoadData(path):
-    for file_path in path.glob("*.json"):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                json_data = json.load(f)
+    elapsed = time.perf_counter() - start
+    rows = sum(r["rows"] for r in results)
+    loaded_bytes = sum(r["bytes"] for r in results if r["resumed"] is not None)
+    log.info(
+        "Итого: файлов %i (ошибок %i), строк %i за %.1f c: %.0f строк/с, %.1f МБ/с",
+        len(results), len(failed), rows, elapsed, rows / elapsed, loaded_bytes / 1024 / 1024 / elapsed,
+    )
 
-            handle_json(json.dumps(json_data, ensure_ascii=False).encode("utf-8"))
-            log.info("Файл успешно обработан: %s", file_path.name)
-        except Exception as e:
-            log.error("Ошибка в обработке файла : %s , %s ", file_path.name, e)
 
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", type=Path, default=FILES_PATH, help="папка с json файлами")
+    parser.add_argument("--workers", type=int, default=LOAD_WORKERS, help="процессов загрузки")
+    parser.add_argument("--restart", action="store_true", help="игнорировать чекпоинты и загрузить всё заново")
+    args = parser.parse_args()
+    firstLoadData(args.path, args.workers, args.restart)
 
 
 if __name__ == "__main__":
-    firstLoadData(FILES_PATH)
+    main()
@@ -1,7 +1,13 @@
-import json
+import uuid
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass, field
 
-from src.db.db import replace_scope
+from src.config import settings
+from src.db.db import ScopeStats, ingest_session
+from src.db.parallel_ingest import parallel_ingest, two_phase_available
 from src.db.registry import REGISTRY
+from src.handlers.json_stream import JSONStreamError, iter_templates
+from src.handlers.row_stream import iter_msgpack_templates, iter_ndjson_templates
 import logging
 
 log = logging.getLogger("app")
@@ -18,20 +24,99 @@ class DataFormatError(AppError):
     pass
 
 
-def handle_json(body):
-    templates = json.loads(body)
-    for template in templates:
-        name_meta  = template.get("НаименованиеМетаданных")
-        items = template.get("Данные")
-        dataModel = REGISTRY.get(name_meta)
+# формат пакета -> разборщик шаблонов из потока байтов
+PACKAGE_PARSERS = {
+    "json": iter_templates,
+    "ndjson": iter_ndjson_templates,
+    "msgpack": iter_msgpack_templates,
+}
 
-        if not dataModel:
-            log.error("Новое название метаданных %s. Нет связки в REGISTRY", name_meta)
-            raise MetadataNotRegistered(name_meta)
 
-        if not isinstance(items, list):
-            raise DataFormatError(f"В '{name_meta}' поле 'Данные' должно быть списком")
+@dataclass
+class IngestStats:
+    """Итог загрузки пакета: число шаблонов и строк (inserted/updated/skipped) по метаданным."""
+    templates: int = 0
+    rows: dict[str, ScopeStats] = field(default_factory=dict)
 
-        log.debug("Обработка %s , количество строк %i", name_meta, len(items))
-        replace_scope(dataModel, items)
+    def add(self, name_meta: str, scope_stats: ScopeStats) -> None:
+        self.templates += 1
+        total = self.rows.setdefault(name_meta, ScopeStats())
+        total += scope_stats
 
+    def rows_dict(self) -> dict[str, dict[str, int]]:
+        return {name_meta: asdict(st) for name_meta, st in self.rows.items()}
+
+    def as_dict(self) -> dict:
+        return {
+            "templates": self.templates,
+            "rows": self.rows_dict(),
+            "rows_total": sum(st.rows for st in self.rows.values()),
+        }
+
+
+def handle_json(body) -> int:
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return handle_json_stream((body,)).templates
+
+
+def iter_package(chunks: Iterable[bytes], package_format: str = "json"):
+    """Шаблоны пакета с проверкой: (НаименованиеМетаданных, модель, итератор строк)."""
+    try:
+        for name_meta, items in PACKAGE_PARSERS[package_format](chunks):
+            dataModel = REGISTRY.get(name_meta)
+
+            if not dataModel:
+                log.error("Новое название метаданных %s. Нет связки в REGISTRY", name_meta)
+                raise MetadataNotRegistered(name_meta)
+
+            if items is None:
+                raise DataFormatError(f"В '{name_meta}' поле 'Данные' должно быть списком")
+
+            yield name_meta, dataModel, items
+    except JSONStreamError as e:
+        raise DataFormatError(str(e)) from e
+
+
+def handle_json_stream(
+        chunks: Iterable[bytes],
+        parallel: int | None = None,
+        atomic: bool | None = None,
+        package_format: str = "json",
+        package_id: uuid.UUID | None = None,
+) -> IngestStats:
+    """
+    Потоковая обработка пакета: шаблоны и их строки передаются в replace_scope
+    по мере разбора, весь пакет в памяти не собирается.
+    Пакет пишется в одной транзакции: при любой ошибке не применяется ни один шаблон.
+
+    parallel > 1 — шаблоны разных таблиц пишутся одновременно в parallel соединениях
+    (порядок внутри таблицы сохраняется). atomic — фиксировать такой пакет целиком
+    двухфазным коммитом; если сервер его не поддерживает, пакет пишется последовательно.
+    По умолчанию — из настроек INGEST_PARALLEL_TABLES / INGEST_ATOMIC.
+    package_format — json (массив шаблонов), ndjson или msgpack (см. row_stream).
+    package_id — id задачи очереди: в ней записывается решение о фиксации двухфазного коммита.
+    Возвращает IngestStats (шаблоны и строки по метаданным).
+    """
+    parallel = settings.INGEST_PARALLEL_TABLES if parallel is None else parallel
+    atomic = settings.INGEST_ATOMIC if atomic is None else atomic
+    if parallel > 1 and atomic and not two_phase_available():
+        log.warning("max_prepared_transactions = 0: атомарная параллельная загрузка недоступна, пакет пишется последовательно")
+        parallel = 1
+
+    stats = IngestStats()
+    if parallel > 1:
+        with parallel_ingest(parallel, atomic, package_id) as lanes:
+            for name_meta, dataModel, items in iter_package(chunks, package_format):
+                lanes.replace_scope(name_meta, dataModel, items)
+        for name_meta, scope_stats in lanes.results:
+            stats.add(name_meta, scope_stats)
+        return stats
+
+    with ingest_session() as session:
+        for name_meta, dataModel, items in iter_package(chunks, package_format):
+            scope_stats = session.replace_scope(dataModel, items)
+            log.debug("Обработка %s , строки %s", name_meta, scope_stats)
+            stats.add(name_meta, scope_stats)
+
+    return stats
@@ -0,0 +1,69 @@
+"""
+Асинхронная загрузка пакетов 1С: /load_data сохраняет тело в очередь bg_job
+и сразу отвечает 202 с id задачи, пакет обрабатывают фоновые воркеры.
+"""
+import io
+import logging
+import uuid
+from collections.abc import Iterable
+
+from src.config import settings
+from src.db.fingerprints import finish_fingerprint, release_fingerprint
+from src.db.jobs import JobWorkerPool, compress_payload, enqueue_job
+from src.handlers.cascade_jobs import schedule_cascade_for
+from src.handlers.handel_message import handle_json_stream
+from src.handlers.json_stream import iter_decoded_chunks
+from src.utils import timed
+
+log = logging.getLogger("app")
+
+INGEST_JOB = "ingest"
+
+
+def enqueue_package(
+        chunks: Iterable[bytes],
+        encoding: str = "identity",
+        package_format: str = "json",
+        job_id: uuid.UUID | None = None,
+        fingerprint: str | None = None,
+) -> uuid.UUID:
+    """
+    Сохраняет тело пакета в очередь сжатым: несжатое тело — в gzip,
+    уже сжатое клиентом (gzip/zstd) — как есть, без перепаковки.
+    fingerprint — отпечаток пакета в журнале (см. fingerprints), отмечается воркером по итогу.
+    """
+    if encoding == "identity":
+        payload, encoding = compress_payload(chunks), "gzip"
+    else:
+        payload = b"".join(chunks)
+    params = {"content_encoding": encoding, "format": package_format, "fingerprint": fingerprint}
+    job_id = enqueue_job(INGEST_JOB, payload, params, job_id)
+    ingest_workers.notify()
+    log.info("Пакет поставлен в очередь: %s (%i байт, %s)", job_id, len(payload), encoding)
+    return job_id
+
+
+def process_package(job_id: uuid.UUID, payload: bytes | None, params: dict | None) -> dict:
+    """Обработка пакета из очереди с замером времени; каскадное удаление ставится отдельной задачей."""
+    params = params or {}
+    fingerprint = params.get("fingerprint")
+    chunks = iter_decoded_chunks(io.BytesIO(payload or b""), params.get("content_encoding", "gzip"))
+    try:
+        stats, load_sec = timed(
+            handle_json_stream, chunks, package_format=params.get("format", "json"), package_id=job_id,
+        )
+    except BaseException:
+        release_fingerprint(fingerprint)
+        raise
+    result = {
+        **stats.as_dict(),
+        "timings": {"load_sec": round(load_sec, 3)},
+    }
+    finish_fingerprint(fingerprint, result)
+    cascade_job = schedule_cascade_for(stats.rows)
+    if cascade_job is not None:
+        result["cascade_job"] = cascade_job
+    return result
+
+
+ingest_workers = JobWorkerPool(INGEST_JOB, process_package, settings.INGEST_WORKERS)
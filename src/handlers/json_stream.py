@@ -0,0 +1,229 @@
+"""
+Потоковый разбор пакета 1С.
+
+Пакет — JSON-массив шаблонов вида {"НаименованиеМетаданных": ..., "Данные": [...]}.
+Тело читается кусками, строки из "Данные" отдаются по одной по мере разбора,
+поэтому в памяти находится только текущий кусок тела и текущая строка.
+"""
+import codecs
+import gzip
+import json
+import re
+import zlib
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+try:
+    import zstandard
+except ImportError:  # zstd — необязательная зависимость
+    zstandard = None
+
+NAME_KEY = "НаименованиеМетаданных"
+DATA_KEY = "Данные"
+
+READ_CHUNK_SIZE = 64 * 1024  # размер куска при чтении тела/файла
+MAX_VALUE_SIZE = 16 * 1024 * 1024  # предел размера одного значения (строки данных)
+
+_WS = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+class JSONStreamError(ValueError):
+    """Нарушение формата потока JSON."""
+
+
+class UnsupportedContentEncoding(ValueError):
+    """Сжатие тела, которое мы не умеем распаковывать."""
+
+
+class _Reader:
+    """Буфер над потоком байтов: дочитывает куски по мере необходимости."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._offset = 0  # сколько символов уже выброшено из буфера
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, want: int = 1) -> None:
+        """Дочитывает не меньше want символов (или до конца потока)."""
+        parts = []
+        got = 0
+        try:
+            while got < want:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    parts.append(self._decoder.decode(b"", final=True))
+                    self.eof = True
+                    break
+                text = self._decoder.decode(chunk)
+                parts.append(text)
+                got += len(text)
+        except UnicodeDecodeError as e:
+            raise JSONStreamError(f"Тело запроса не в кодировке UTF-8: {e}") from e
+
+        # отбрасываем уже разобранную часть
+        self._offset += self.pos
+        self.buf = self.buf[self.pos:] + "".join(parts)
+        self.pos = 0
+
+    def where(self) -> str:
+        return f"позиция {self._offset + self.pos}"
+
+    def peek(self) -> str:
+        """Следующий значимый символ (без сдвига) или '' в конце потока."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def expect(self, chars: str) -> str:
+        ch = self.peek()
+        if not ch or ch not in chars:
+            got = repr(ch) if ch else "конец данных"
+            raise JSONStreamError(f"Ожидалось {' или '.join(map(repr, chars))}, получено {got} ({self.where()})")
+        self.pos += 1
+        return ch
+
+    def value(self) -> Any:
+        """Целиком разобрать очередное JSON-значение."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise JSONStreamError(f"Некорректный JSON: {e.msg} ({self.where()})") from e
+                pending = len(self.buf) - self.pos
+                if pending > MAX_VALUE_SIZE:
+                    raise JSONStreamError(f"Слишком большое значение ({self.where()})") from e
+                # значение не уместилось в буфер — как минимум удваиваем прочитанное,
+                # чтобы повторный разбор не стал квадратичным
+                self._fill(pending)
+                continue
+            if end == len(self.buf) and not self.eof:
+                # число/литерал на границе куска мог быть обрезан — дочитываем
+                self._fill()
+                continue
+            self.pos = end
+            return obj
+
+
+def _iter_rows(reader: _Reader) -> Iterator[Any]:
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(",]") == "]":
+            return
+
+
+def _iter_template(reader: _Reader) -> Iterator[tuple[Any, Iterator[Any] | None]]:
+    if reader.peek() != "{":
+        raise JSONStreamError(f"Элемент пакета должен быть объектом ({reader.where()})")
+    reader.pos += 1
+
+    name = None
+    rows: Iterator[Any] | None = None
+    buffered: list | None = None  # "Данные", пришедшие раньше имени метаданных
+
+    if reader.peek() == "}":
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise JSONStreamError(f"Ключ объекта должен быть строкой ({reader.where()})")
+            reader.expect(":")
+
+            if key == NAME_KEY:
+                name = reader.value()
+            elif key != DATA_KEY:
+                reader.value()
+            elif reader.peek() != "[":
+                # не список — пропускаем значение, ошибку сформирует потребитель
+                reader.value()
+                buffered = None
+            elif name is not None:
+                rows = _iter_rows(reader)
+                yield name, rows
+                # дочитываем строки, которые потребитель не забрал
+                for _ in rows:
+                    pass
+            else:
+                buffered = list(_iter_rows(reader))
+
+            if reader.expect(",}") == "}":
+                break
+
+    if rows is None:
+        yield name, (iter(buffered) if buffered is not None else None)
+
+
+def iter_templates(chunks: Iterable[bytes]) -> Iterator[tuple[Any, Iterator[Any] | None]]:
+    """
+    Разбирает пакет из потока байтов.
+    Отдаёт пары (НаименованиеМетаданных, итератор строк "Данные").
+    Итератор строк нужно прочитать до перехода к следующему шаблону;
+    если "Данные" отсутствуют или не являются списком — вместо итератора None.
+    """
+    reader = _Reader(chunks)
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+    else:
+        while True:
+            yield from _iter_template(reader)
+            if reader.expect(",]") == "]":
+                break
+
+    if reader.peek():
+        raise JSONStreamError(f"Лишние данные после конца пакета ({reader.where()})")
+
+
+def iter_file_chunks(file, size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Читает бинарный файл кусками."""
+    while chunk := file.read(size):
+        yield chunk
+
+
+_ENCODING_ALIASES = {"": "identity", "identity": "identity", "gzip": "gzip", "x-gzip": "gzip", "zstd": "zstd"}
+
+
+def content_encoding(header: str | None) -> str:
+    """Нормализует заголовок Content-Encoding: identity, gzip или zstd."""
+    encoding = _ENCODING_ALIASES.get((header or "").strip().lower())
+    if encoding is None:
+        raise UnsupportedContentEncoding(f"Неподдерживаемый Content-Encoding: {header} (ожидается gzip или zstd)")
+    if encoding == "zstd" and zstandard is None:
+        raise UnsupportedContentEncoding("Content-Encoding zstd недоступен: не установлен пакет zstandard")
+    return encoding
+
+
+def iter_decoded_chunks(file, encoding: str = "identity", size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Читает бинарный файл кусками, распаковывая gzip/zstd на лету.
+    Каждый кусок — не больше size байт распакованных данных, поэтому даже сильно
+    сжатое тело не раздувается в памяти.
+    """
+    if encoding == "identity":
+        yield from iter_file_chunks(file, size)
+        return
+    if encoding == "gzip":
+        reader = gzip.GzipFile(fileobj=file, mode="rb")
+        errors = (OSError, EOFError, zlib.error)
+    else:
+        reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True, closefd=False)
+        errors = (zstandard.ZstdError,)
+    try:
+        while chunk := reader.read(size):
+            yield chunk
+    except errors as e:
+        raise JSONStreamError(f"Повреждённое сжатое тело ({encoding}): {e}") from None
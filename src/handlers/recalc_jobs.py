@@ -0,0 +1,153 @@
+"""
+Пересчёт себестоимости в фоне: /costs/recalculate ставит задачу recalc в очередь
+bg_job и сразу отвечает 202 с id задачи, месяцы пересчитывает фоновый воркер.
+
+Ход задачи пишется в bg_job.progress после каждой пары (месяц, тип расхода):
+    {"units_total": 6, "units_done": 2, "rows": 1234,
+     "months": {"2025-01": {"reg_direct_expenses": {"status": "done", "sec": 0.4, "rows": 600}, ...}}}
+Отмена (request_cancel) проверяется перед каждой парой: начатые пары доводятся
+до конца, остальные остаются "cancelled".
+
+Пересекающиеся запросы схлопываются: пока задача recalc ждёт в очереди, новые
+месяцы добавляются в неё, а не в новую задачу. В уже взятую задачу месяцы не
+добавляются — она могла прочитать данные до изменений, ради которых пришёл запрос.
+"""
+import json
+import logging
+import uuid
+from datetime import date
+
+from sqlalchemy import text
+
+from src.db.dags import ALLOC_SQL_BY_TYPE, recalc_units
+from src.db.db import engine
+from src.db.jobs import JOB_QUEUED, JobCancelled, JobWorkerPool, cancel_requested
+from src.utils import iter_months
+
+log = logging.getLogger("app")
+
+RECALC_JOB = "recalc"
+
+UNIT_QUEUED = "queued"
+UNIT_DONE = "done"
+UNIT_CANCELLED = "cancelled"
+
+
+def schedule_recalc(period_start: date, period_end: date) -> tuple[uuid.UUID, bool]:
+    """
+    Ставит пересчёт месяцев периода (включая конечный). Если задача recalc уже ждёт
+    в очереди, месяцы добавляются в неё. Возвращает (id задачи, схлопнут ли запрос).
+    """
+    months = [mstart.isoformat() for mstart, _ in iter_months(period_start, period_end)]
+    with engine.begin() as conn:
+        # параллельные вызовы не должны поставить две задачи разом
+        conn.execute(text("select pg_advisory_xact_lock(hashtext(:kind))"), {"kind": RECALC_JOB})
+        # FOR UPDATE: воркер не заберёт задачу, пока в неё дописываются месяцы
+        queued = conn.execute(
+            text("""
+                select id, params from bg_job
+                where kind = :kind and status = :queued
+                order by created_at
+                limit 1
+                for update
+            """),
+            {"kind": RECALC_JOB, "queued": JOB_QUEUED},
+        ).fetchone()
+        if queued is not None:
+            job_id, params = queued
+            merged = sorted(set((params or {}).get("months", [])) | set(months))
+            conn.execute(
+                text("update bg_job set params = cast(:params as jsonb) where id = :id"),
+                {"id": job_id, "params": json.dumps({**(params or {}), "months": merged})},
+            )
+            log.info("Пересчёт %s..%s добавлен в задачу %s", months[0], months[-1], job_id)
+        else:
+            job_id = uuid.uuid4()
+            conn.execute(
+                text("""
+                    insert into bg_job(id, kind, status, params)
+                    values (:id, :kind, :queued, cast(:params as jsonb))
+                """),
+                {"id": job_id, "kind": RECALC_JOB, "queued": JOB_QUEUED, "params": json.dumps({"months": months})},
+            )
+            log.info("Поставлен пересчёт %s..%s: %s", months[0], months[-1], job_id)
+    recalc_workers.notify()
+    return job_id, queued is not None
+
+
+def _save_progress(job_id: uuid.UUID, progress: dict) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text("update bg_job set progress = cast(:progress as jsonb) where id = :id"),
+            {"id": job_id, "progress": json.dumps(progress)},
+        )
+
+
+def _unit_done(job_id: uuid.UUID, mstart: date, table_name: str, sec: float, rows: int) -> None:
+    """Пара пересчитана: одним UPDATE — её статус и общие счётчики (пары идут параллельно)."""
+    unit = {"status": UNIT_DONE, "sec": round(sec, 3), "rows": rows}
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                update bg_job
+                set progress = jsonb_set(
+                    jsonb_set(
+                        jsonb_set(progress, '{units_done}', to_jsonb((progress->>'units_done')::int + 1)),
+                        '{rows}', to_jsonb((progress->>'rows')::bigint + :rows)
+                    ),
+                    array['months', :month, :type], cast(:unit as jsonb)
+                )
+                where id = :id
+            """),
+            {
+                "id": job_id, "rows": rows, "month": mstart.strftime("%Y-%m"), "type": table_name,
+                "unit": json.dumps(unit),
+            },
+        )
+
+
+def process_recalc(job_id: uuid.UUID, payload: bytes | None, params: dict | None) -> dict:
+    """Задача recalc: пересчёт месяцев params["months"] всеми типами расходов."""
+    months = [date.fromisoformat(m) for m in (params or {}).get("months", [])]
+    units = [(mstart, table_name) for mstart in months for table_name in ALLOC_SQL_BY_TYPE]
+    progress = {
+        "units_total": len(units),
+        "units_done": 0,
+        "rows": 0,
+        "months": {
+            mstart.strftime("%Y-%m"): {table_name: {"status": UNIT_QUEUED} for table_name in ALLOC_SQL_BY_TYPE}
+            for mstart in months
+        },
+    }
+    _save_progress(job_id, progress)
+
+    results = recalc_units(
+        engine, units,
+        on_done=lambda mstart, table_name, sec, rows: _unit_done(job_id, mstart, table_name, sec, rows),
+        cancelled=lambda: cancel_requested(job_id),
+    )
+    result = {"months": results}
+    if any(report["status"] == UNIT_CANCELLED for report in results):
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    update bg_job
+                    set progress = jsonb_set(progress, '{months}', (
+                        select jsonb_object_agg(m.key, (
+                            select jsonb_object_agg(u.key, case
+                                when u.value->>'status' = :queued then jsonb_build_object('status', :cancelled)
+                                else u.value end)
+                            from jsonb_each(m.value) u
+                        ))
+                        from jsonb_each(progress->'months') m
+                    ))
+                    where id = :id
+                """),
+                {"id": job_id, "queued": UNIT_QUEUED, "cancelled": UNIT_CANCELLED},
+            )
+        raise JobCancelled(result)
+    return result
+
+
+# пары месяца и так считаются параллельно пулом соединений (RECALC_WORKERS) внутри задачи
+recalc_workers = JobWorkerPool(RECALC_JOB, process_recalc, 1, needs_payload=False)
@@ -0,0 +1,181 @@
+"""
+Построчные форматы пакета 1С: NDJSON и msgpack.
+
+Пакет — поток записей. Шаблон начинается с записи-заголовка
+    {"НаименованиеМетаданных": "ПрямыеЗатраты", "Колонки": ["Регистратор", "Период", ...]}
+за которой идут строки данных до следующего заголовка:
+    ["3f1c...", "2025-01-31T00:00:00", ...]   — массив значений в порядке "Колонки";
+    {"Регистратор": "3f1c...", ...}            — или обычный объект, как в "Данные".
+Алиасы колонок передаются один раз на шаблон, а не в каждой строке, поэтому тело
+и его разбор заметно меньше, чем у JSON-массива с объектами.
+
+NDJSON — одна запись на строку (Content-Type application/x-ndjson), msgpack —
+подряд идущие объекты msgpack (application/x-msgpack). Даты передаются строками ISO,
+как и в JSON. Строки отдаются словарями {алиас: значение}, поэтому дальше пакет идёт
+тем же путём, что и JSON: REGISTRY -> replace_scope.
+"""
+import codecs
+import json
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+from src.handlers.json_stream import DATA_KEY, MAX_VALUE_SIZE, NAME_KEY, READ_CHUNK_SIZE, JSONStreamError
+
+try:
+    import msgpack
+except ImportError:  # msgpack — необязательная зависимость
+    msgpack = None
+
+COLUMNS_KEY = "Колонки"
+_MSGPACK_NIL = b"\xc0"
+
+_decoder = json.JSONDecoder()
+
+# Content-Type -> формат пакета
+ROW_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/x-msgpack": "msgpack",
+    "application/msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+}
+
+
+class UnsupportedPackageFormat(ValueError):
+    """Content-Type, для которого нет разборщика."""
+
+
+def row_format(content_type: str | None) -> str:
+    """Формат пакета (ndjson или msgpack) по заголовку Content-Type."""
+    fmt = ROW_FORMATS.get((content_type or "").split(";")[0].strip().lower())
+    if fmt is None:
+        raise UnsupportedPackageFormat(
+            f"Неподдерживаемый Content-Type: {content_type} (ожидается application/x-ndjson или application/x-msgpack)"
+        )
+    if fmt == "msgpack" and msgpack is None:
+        raise UnsupportedPackageFormat("Формат msgpack недоступен: не установлен пакет msgpack")
+    return fmt
+
+
+class _Records:
+    """Итератор записей с возвратом одной записи назад (заголовок следующего шаблона)."""
+
+    def __init__(self, records: Iterator[Any]):
+        self._records = records
+        self._pushed: list[Any] = []
+        self.index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pushed:
+            return self._pushed.pop()
+        record = next(self._records)
+        self.index += 1
+        return record
+
+    def push(self, record) -> None:
+        self._pushed.append(record)
+
+
+def _is_header(record) -> bool:
+    return type(record) is dict and NAME_KEY in record
+
+
+def _template_rows(records: _Records, name, columns: tuple[str, ...] | None) -> Iterator[dict]:
+    for record in records:
+        t = type(record)
+        if t is list:
+            if columns is None:
+                raise JSONStreamError(f"В '{name}' строка-массив без '{COLUMNS_KEY}' в заголовке (запись {records.index})")
+            try:
+                row = dict(zip(columns, record, strict=True))
+            except ValueError:
+                raise JSONStreamError(
+                    f"В '{name}' строка из {len(record)} значений при {len(columns)} колонках (запись {records.index})"
+                ) from None
+            yield row
+        elif t is dict:
+            if NAME_KEY in record:
+                records.push(record)
+                return
+            yield record
+        else:
+            raise JSONStreamError(f"В '{name}' строка должна быть массивом или объектом (запись {records.index})")
+
+
+def iter_record_templates(records: Iterable[Any]) -> Iterator[tuple[Any, Iterator[dict]]]:
+    """
+    Группирует поток записей в шаблоны: пары (НаименованиеМетаданных, итератор строк),
+    как iter_templates. Недочитанные строки шаблона пропускаются при переходе к следующему.
+    """
+    records = _Records(iter(records))
+    for header in records:
+        if not _is_header(header):
+            raise JSONStreamError(f"Ожидался заголовок шаблона с '{NAME_KEY}' (запись {records.index})")
+        if DATA_KEY in header:
+            raise JSONStreamError(f"Заголовок шаблона не должен содержать '{DATA_KEY}' (запись {records.index})")
+        columns = header.get(COLUMNS_KEY)
+        if columns is not None:
+            if type(columns) is not list or not all(type(c) is str for c in columns):
+                raise JSONStreamError(f"'{COLUMNS_KEY}' должны быть списком строк (запись {records.index})")
+            columns = tuple(columns)
+        name = header[NAME_KEY]
+        rows = _template_rows(records, name, columns)
+        yield name, rows
+        for _ in rows:
+            pass
+
+
+def _iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    # тело декодируется кусками целиком: json.loads на bytes каждой строки заметно дороже
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+    try:
+        for chunk in chunks:
+            lines = (tail + text.decode(chunk)).split("\n")
+            tail = lines.pop()
+            if len(tail) > MAX_VALUE_SIZE:
+                raise JSONStreamError(f"Строка NDJSON больше {MAX_VALUE_SIZE} символов")
+            yield from lines
+        yield tail + text.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        raise JSONStreamError(f"Тело не в UTF-8: {e}") from None
+
+
+def iter_ndjson_records(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Записи NDJSON из потока байтов (пустые строки пропускаются)."""
+    for number, line in enumerate(_iter_lines(chunks), 1):
+        if not line or line.isspace():
+            continue
+        try:
+            yield _decoder.decode(line)
+        except ValueError as e:
+            raise JSONStreamError(f"Некорректный JSON в строке {number}: {e}") from None
+
+
+def iter_msgpack_records(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Объекты msgpack из потока байтов."""
+    unpacker = msgpack.Unpacker(raw=False, strict_map_key=False, max_buffer_size=MAX_VALUE_SIZE + READ_CHUNK_SIZE)
+    try:
+        for chunk in chunks:
+            unpacker.feed(chunk)
+            yield from unpacker
+        # Unpacker не сообщает о недочитанном объекте в конце потока: дописываем nil —
+        # при целом потоке он вернётся отдельным объектом, иначе уйдёт в хвост оборванного
+        unpacker.feed(_MSGPACK_NIL)
+        tail = list(unpacker)
+    except (ValueError, msgpack.UnpackException) as e:
+        raise JSONStreamError(f"Некорректный msgpack: {e}") from None
+    if tail != [None]:
+        raise JSONStreamError(f"Поток msgpack оборван (позиция {unpacker.tell()})")
+
+
+def iter_ndjson_templates(chunks: Iterable[bytes]) -> Iterator[tuple[Any, Iterator[dict]]]:
+    return iter_record_templates(iter_ndjson_records(chunks))
+
+
+def iter_msgpack_templates(chunks: Iterable[bytes]) -> Iterator[tuple[Any, Iterator[dict]]]:
+    return iter_record_templates(iter_msgpack_records(chunks))
@@ -1,7 +1,7 @@
 import time
 from functools import wraps
 from datetime import date
-from typing import Iterator
+from typing import Any, Callable, Iterator
 
 
 def timeit(func):
@@ -19,6 +19,13 @@ def timeit(func):
     return wrapper
 
 
+def timed(func: Callable, *args, **kwargs) -> tuple[Any, float]:
+    """Вызов функции с замером: (результат, время в секундах)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
 def first_day(dt: date) -> date:
     return date(dt.year, dt.month, 1)
 
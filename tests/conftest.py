@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def db_engine():
+    """Движок dev/test-базы из настроек (.env); без доступной базы тест пропускается."""
+    try:
+        from src.db.db import engine
+
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+    except Exception as e:
+        pytest.skip(f"нет тестовой базы: {e}")
+    return engine
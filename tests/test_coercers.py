@@ -0,0 +1,89 @@
+"""
+Паритет скомпилированной нормализации (compile_coercer) с pydantic:
+на каждой модели REGISTRY случайные строки из обычных значений 1С и пограничных
+случаев должны давать тот же результат или ту же ошибку, что model_validate(...).dict(...).
+"""
+import random
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from pydantic import ValidationError
+
+from src.db.coercers import compile_coercer
+from src.db.registry import REGISTRY
+
+ROWS_PER_MODEL = 2000
+SEED = 1
+
+# эталон — прежний путь загрузки через устаревший .dict()
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+
+# значения-кандидаты по типу поля: обычный вид из 1С и пограничные случаи
+_SAMPLES = {
+    uuid.UUID: [
+        "a8407926-c666-11ef-9136-000c29ed8257", "A8407926-C666-11EF-9136-000C29ED8257",
+        "a8407926c66611ef9136000c29ed8257", "{a8407926-c666-11ef-9136-000c29ed8257}",
+        uuid.UUID("a8407926-c666-11ef-9136-000c29ed8257"), "not-a-uuid", 123,
+    ],
+    datetime: [
+        "2025-01-01T12:00:00", "2025-01-01 12:00:00", "2025-01-01T12:00:00.5", "0001-01-01T00:00:00",
+        "2025-13-01T00:00:00", "2025-01-01", "2025-01-01T12:00:00Z", "2025-01-01T12:00:00+03:00",
+        "2025-1-1T1:2:3", 1700000000, datetime(2025, 1, 1),
+    ],
+    Decimal: [71024, 1.5, 0.1, "12.30", " 7 ", "1e3", "abc", "NaN", True, Decimal("2.50"), 10**30],
+    bool: [True, False, 1, 0, "true", "no", 2],
+    int: [5, -1, True, "7", 5.0, 5.5, "x"],
+    float: [1.5, 3, "2.5", True, float("inf"), "x"],
+    str: ["abc", "Погрузка в машину", " a ", 123, 1.5, True, b"bytes"],
+}
+_BLANKS = ["", "   ", None]
+
+
+def _sample_value(rnd: random.Random, field):
+    if rnd.random() < 0.15:
+        return rnd.choice(_BLANKS)
+    tp = str if issubclass(field.type_, str) else field.type_
+    if tp is str and field.field_info.max_length and rnd.random() < 0.1:
+        return "ж" * (field.field_info.max_length + rnd.choice((0, 1)))
+    return rnd.choice(_SAMPLES[tp])
+
+
+def _sample_row(rnd: random.Random, dataModel) -> dict:
+    row = {}
+    for field in dataModel.__fields__.values():
+        if field.name == "created_at" or rnd.random() < 0.05:
+            continue
+        key = field.name if rnd.random() < 0.05 else field.alias
+        row[key] = _sample_value(rnd, field)
+    if rnd.random() < 0.1:
+        row["ЛишнееПоле"] = "x"
+    return row
+
+
+def _outcome(func, raw):
+    """Результат нормализации в сравнимом виде: значения с точностью до типа и repr."""
+    try:
+        out = func(raw)
+    except ValidationError:
+        return "ValidationError"
+    return {k: (type(v), repr(v)) for k, v in out.items()}
+
+
+@pytest.mark.parametrize("name_meta", list(REGISTRY))
+def test_compiled_coercer_matches_pydantic(name_meta):
+    dataModel = REGISTRY[name_meta]
+    fast = compile_coercer(dataModel)
+
+    def slow(raw):
+        return dataModel.model_validate(raw).dict(by_alias=False, exclude_unset=True)
+
+    rnd = random.Random(f"{SEED}:{name_meta}")
+    mismatches = []
+    for _ in range(ROWS_PER_MODEL):
+        raw = _sample_row(rnd, dataModel)
+        if _outcome(fast, raw) != _outcome(slow, raw):
+            mismatches.append(f"{raw!r}\n    fast={_outcome(fast, raw)}\n    slow={_outcome(slow, raw)}")
+    assert not mismatches, f"расхождений {len(mismatches)}, первые:\n" + "\n".join(mismatches[:10])
@@ -0,0 +1,112 @@
+"""
+Создание месячных партиций при загрузке в RANGE(date)-приёмник (IngestSession._month_partition):
+месяц, которого нет, встречается уже после того, как транзакция пакета прочитала родителя —
+следующая часть шаблона или второй шаблон той же таблицы. Партиция должна создаться сразу,
+а не ждать DEFAULT, которую держит сама загрузка, и не уводить строки месяца в DEFAULT.
+"""
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from src.db.registry import REGISTRY
+
+NAME_META = "МестонахождениеТовара"
+REGISTRAR_TYPE = "pytest"
+MONTHS = [(2023, 3), (2023, 4), (2023, 5), (2023, 6)]
+
+
+def _rows(month: tuple[int, int], registrars: int = 2, goods: int = 5) -> list[dict]:
+    year, m = month
+    return [
+        {
+            "Регистратор": str(registrar), "Период": f"{year}-{m:02d}-10T00:00:00",
+            "Товар": str(uuid.uuid4()), "ТипРегистратора": REGISTRAR_TYPE,
+        }
+        for registrar in (uuid.uuid4() for _ in range(registrars))
+        for _ in range(goods)
+    ]
+
+
+def _partition(conn, year: int, month: int) -> str | None:
+    return conn.execute(
+        text("SELECT to_regclass(:p)::text"), {"p": f"partitions.reg_goods_location_{year}_{month:02d}"},
+    ).scalar()
+
+
+def _rows_in_default(conn) -> int:
+    return conn.execute(
+        text("SELECT count(*) FROM partitions.reg_goods_location_default WHERE registrar_type = :t"),
+        {"t": REGISTRAR_TYPE},
+    ).scalar()
+
+
+def _cleanup(engine) -> None:
+    from src.db import db as db_module
+
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM reg_goods_location WHERE registrar_type = :t"), {"t": REGISTRAR_TYPE})
+        for year, month in MONTHS:
+            part = _partition(conn, year, month)
+            if part is not None:
+                conn.exec_driver_sql(f"ALTER TABLE reg_goods_location DETACH PARTITION {part}")
+                conn.exec_driver_sql(f"DROP TABLE {part}")
+            db_module._partition_failures.pop(("reg_goods_location", year, month), None)
+
+
+@pytest.fixture
+def engine(db_engine):
+    _cleanup(db_engine)
+    yield db_engine
+    _cleanup(db_engine)
+
+
+def test_new_month_in_later_chunk(engine, monkeypatch):
+    from src.db import db as db_module
+
+    monkeypatch.setattr(db_module, "INSERT_BATCH_SIZE", 10)
+    rows = _rows(MONTHS[0]) + _rows(MONTHS[1])
+    stats = db_module.replace_scope(REGISTRY[NAME_META], rows, chunk_rows=10)
+
+    assert stats.inserted == len(rows)
+    with engine.connect() as conn:
+        assert _partition(conn, *MONTHS[1]) is not None
+        assert _rows_in_default(conn) == 0
+    assert not db_module._partition_failures
+
+
+def test_new_month_in_second_template(engine):
+    from src.db import db as db_module
+
+    with db_module.ingest_session() as session:
+        session.replace_scope(REGISTRY[NAME_META], _rows(MONTHS[0]))
+        session.replace_scope(REGISTRY[NAME_META], _rows(MONTHS[2]))
+
+    with engine.connect() as conn:
+        assert _partition(conn, *MONTHS[2]) is not None
+        assert _rows_in_default(conn) == 0
+    assert not db_module._partition_failures
+
+
+def test_failed_month_is_not_retried(engine, monkeypatch):
+    from src.db import db as db_module
+    from src.db.utils import partition_manager
+
+    month = MONTHS[3]
+    # строка месяца уже в DEFAULT: прикрепить партицию месяца нельзя
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO partitions.reg_goods_location_default (registrar_id, date, goods_id, registrar_type)
+            VALUES (gen_random_uuid(), make_date(:y, :m, 10), gen_random_uuid(), :t)
+        """), {"y": month[0], "m": month[1], "t": REGISTRAR_TYPE})
+    db_module.replace_scope(REGISTRY[NAME_META], _rows(month))
+    with engine.connect() as conn:
+        assert _partition(conn, *month) is None
+    assert ("reg_goods_location", *month) in db_module._partition_failures
+
+    calls = []
+    monkeypatch.setattr(
+        partition_manager, "ensure_month_partition_with_indexes", lambda *a, **kw: calls.append(kw),
+    )
+    db_module.replace_scope(REGISTRY[NAME_META], _rows(month))
+    assert calls == []
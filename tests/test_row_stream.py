@@ -0,0 +1,29 @@
+"""
+Построчный формат пакета (row_stream): строка-массив раскладывается по "Колонки"
+заголовка; строка другой длины — ошибка формата, а не обрезанная или неполная строка.
+"""
+import json
+
+import pytest
+
+from src.handlers.json_stream import JSONStreamError
+from src.handlers.row_stream import COLUMNS_KEY, iter_ndjson_templates
+
+HEADER = {"НаименованиеМетаданных": "ПрямыеЗатраты", COLUMNS_KEY: ["Регистратор", "Период", "Сумма"]}
+
+
+def _rows(*records) -> list[tuple[str, list[dict]]]:
+    body = "\n".join(json.dumps(r, ensure_ascii=False) for r in records).encode("utf-8")
+    return [(name, list(rows)) for name, rows in iter_ndjson_templates([body])]
+
+
+def test_columnar_rows():
+    assert _rows(HEADER, ["r1", "2025-01-31T00:00:00", 10], {"Регистратор": "r2"}) == [
+        ("ПрямыеЗатраты", [{"Регистратор": "r1", "Период": "2025-01-31T00:00:00", "Сумма": 10}, {"Регистратор": "r2"}]),
+    ]
+
+
+@pytest.mark.parametrize("row", [["r1", "2025-01-31T00:00:00"], ["r1", "2025-01-31T00:00:00", 10, "лишнее"]])
+def test_row_length_mismatch(row):
+    with pytest.raises(JSONStreamError, match="при 3 колонках"):
+        _rows(HEADER, row)
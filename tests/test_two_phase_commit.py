@@ -0,0 +1,109 @@
+"""
+Фиксация пакета двухфазным коммитом (parallel_ingest): после записи решения в задаче
+(prepared_gids) пакет считается загруженным — сбой COMMIT PREPARED не превращает задачу
+в ошибку, а recover_prepared при старте фиксирует транзакции и завершает задачу, чтобы
+requeue_stale_jobs не загрузил пакет повторно. Нужен max_prepared_transactions > 0.
+"""
+import copy
+import json
+import uuid
+from pathlib import Path
+
+import pytest
+from sqlalchemy import text
+
+from src.db import parallel_ingest as pi
+from src.db.jobs import JOB_DONE, claim_job, enqueue_job, get_job, requeue_stale_jobs
+from src.handlers.handel_message import handle_json_stream
+
+JOB_KIND = "pytest-2pc"
+TEST_DATA_PATH = Path(__file__).parent / "testData"
+
+
+def _body(registrar: str) -> bytes:
+    with open(TEST_DATA_PATH / "ПрямыеРасходы.json", encoding="utf-8-sig") as f:
+        rows = copy.deepcopy(json.load(f)[0]["Данные"][:5])
+    for row in rows:
+        row["Регистратор"] = registrar
+    with open(TEST_DATA_PATH / "Дополнительные справочники.json", encoding="utf-8-sig") as f:
+        refs = json.load(f)[0]["Данные"]
+    return json.dumps([
+        {"НаименованиеМетаданных": "ПрямыеЗатраты", "Данные": rows},
+        {"НаименованиеМетаданных": "Справочник.тп_СтатьиЗатрат", "Данные": refs},
+    ]).encode()
+
+
+def _count(engine, registrar: str) -> int:
+    with engine.connect() as conn:
+        return conn.execute(
+            text("select count(*) from reg_direct_expenses where registrar_id = :r"), {"r": registrar},
+        ).scalar()
+
+
+def _prepared(engine) -> list[str]:
+    with engine.connect() as conn:
+        return conn.execute(
+            text("select gid from pg_prepared_xacts where starts_with(gid, :p)"), {"p": f"{pi.GID_PREFIX}:"},
+        ).scalars().all()
+
+
+def _lost_commit(self) -> None:
+    """COMMIT PREPARED не дошёл: соединение потеряно, транзакция осталась подготовленной."""
+    self.conn.invalidate()
+    raise RuntimeError("COMMIT PREPARED не выполнен")
+
+
+@pytest.fixture
+def engine(db_engine):
+    if not pi.two_phase_available():
+        pytest.skip("на сервере max_prepared_transactions = 0")
+    registrar = str(uuid.uuid4())
+    yield db_engine, registrar
+    for gid in _prepared(db_engine):
+        pi._finish_prepared(gid, commit=False)
+    with db_engine.begin() as conn:
+        conn.execute(text("delete from reg_direct_expenses where registrar_id = :r"), {"r": registrar})
+        conn.execute(text("delete from bg_job where kind = :k"), {"k": JOB_KIND})
+
+
+def test_commit_failure_after_decision_is_recovered(engine, monkeypatch):
+    engine, registrar = engine
+    job_id = enqueue_job(JOB_KIND, params={})
+    assert claim_job(JOB_KIND)[0] == job_id
+    monkeypatch.setattr(pi._Lane, "commit", _lost_commit)
+
+    stats = handle_json_stream([_body(registrar)], parallel=2, atomic=True, package_id=job_id)
+
+    assert stats.templates == 2
+    assert len(_prepared(engine)) == 2
+    monkeypatch.undo()
+
+    counts = pi.recover_prepared()
+    assert counts["committed"] == 2 and counts["jobs_done"] == 1
+    assert _count(engine, registrar) == 5
+    assert get_job(job_id)["status"] == JOB_DONE
+    assert requeue_stale_jobs(JOB_KIND) == {}
+
+
+def test_job_committed_before_crash_is_not_requeued(engine):
+    engine, registrar = engine
+    job_id = enqueue_job(JOB_KIND, params={})
+    claim_job(JOB_KIND)
+    handle_json_stream([_body(registrar)], parallel=2, atomic=True, package_id=job_id)
+    # процесс упал после COMMIT PREPARED, но до завершения задачи
+
+    assert pi.recover_prepared()["jobs_done"] == 1
+    assert get_job(job_id)["status"] == JOB_DONE
+    assert requeue_stale_jobs(JOB_KIND) == {}
+
+
+def test_commit_failure_without_job_is_raised(engine, monkeypatch):
+    engine, registrar = engine
+    monkeypatch.setattr(pi._Lane, "commit", _lost_commit)
+
+    with pytest.raises(RuntimeError):
+        handle_json_stream([_body(registrar)], parallel=2, atomic=True, package_id=uuid.uuid4())
+    monkeypatch.undo()
+
+    assert pi.recover_prepared()["rolled_back"] == 2
+    assert _count(engine, registrar) == 0